@@ -3,13 +3,14 @@ import decimal
 import json
 from typing import Any, ClassVar, Dict, Optional, Union
 
-import jmespath
 from aws_lambda_powertools.utilities.data_classes import APIGatewayProxyEvent
 from jsonschema import Draft202012Validator
 from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
 from pydantic_core import ErrorDetails
 from ulid import ULID
 
+from transforms.core import compile_expression
+
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -128,7 +129,8 @@ def json_schema_validation(
         error_path = json_schema_validation_error_path(error)
         # If the error was caused by a string that started with an expression token skip
         if isinstance(
-            error_value := jmespath.search(error_path, data=data), str
+            error_value := compile_expression(error_path, options=None).search(data),
+            str,
         ) and error_value.startswith("::"):
             print(f"Skipping error: {error.message}")
             continue
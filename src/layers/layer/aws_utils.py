@@ -1,7 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from typing import Optional
+import logging
+from typing import Hashable, Optional
 
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
 
 
 @lru_cache
@@ -21,3 +26,84 @@ def get_boto3_resource(service_name: str, session: Optional[boto3.Session] = Non
     if not session:
         session = get_boto3_session()
     return session.resource(service_name)
+
+
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 262_144
+
+
+def pack_message_batches(
+    messages: list[tuple[Hashable, str]],
+    max_entries: int = SQS_BATCH_MAX_ENTRIES,
+    max_bytes: int = SQS_BATCH_MAX_BYTES,
+) -> tuple[list[list[tuple[Hashable, str]]], list[Hashable]]:
+    """Pack ``(key, body)`` messages into batches for ``SendMessageBatch``. A batch holds at most
+    ``max_entries`` messages and ``max_bytes`` of message bodies.
+
+    Returns the batches and the keys of any messages that are too large to send.
+    """
+    batches, oversized = [], []
+    batch, batch_bytes = [], 0
+
+    for key, body in messages:
+        body_bytes = len(body.encode("utf-8"))
+        if body_bytes > max_bytes:
+            oversized.append(key)
+            continue
+
+        if len(batch) == max_entries or batch_bytes + body_bytes > max_bytes:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+
+        batch.append((key, body))
+        batch_bytes += body_bytes
+
+    if batch:
+        batches.append(batch)
+
+    return batches, oversized
+
+
+def send_message_batches(
+    queue_url: str,
+    messages: list[tuple[Hashable, str]],
+    sqs_client=None,
+    max_workers: int = 4,
+) -> list[Hashable]:
+    """Send ``(key, body)`` messages to a queue with ``SendMessageBatch`` calls. Batches are sent
+    concurrently. The key is any identifier the caller uses to track the origin of the message
+    (it is not sent) and keys can be repeated.
+
+    Returns the keys of the messages that failed to send.
+    """
+    if not sqs_client:
+        sqs_client = get_boto3_client("sqs")
+
+    batches, failed_keys = pack_message_batches(messages)
+
+    def send_batch(batch: list[tuple[Hashable, str]]) -> list[Hashable]:
+        try:
+            response = sqs_client.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": str(idx), "MessageBody": body}
+                    for idx, (_, body) in enumerate(batch)
+                ],
+            )
+        # Connection errors and timeouts fail the batch's messages only
+        except (ClientError, BotoCoreError):
+            logger.exception("Failed to send message batch")
+            return [key for key, _ in batch]
+
+        return [batch[int(i["Id"])][0] for i in response.get("Failed", [])]
+
+    if len(batches) == 1 or max_workers < 2:
+        results = map(send_batch, batches)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            results = list(executor.map(send_batch, batches))
+
+    for batch_failed_keys in results:
+        failed_keys.extend(batch_failed_keys)
+
+    return failed_keys
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+import time
+from typing import Any, Callable, Hashable
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    maxsize: int
+
+
+class LRUCache:
+    """A size-bounded, thread-safe least recently used cache.
+
+    Unlike ``functools.lru_cache`` the cache is an object that can be shared between modules,
+    cleared, and inspected for hit/miss/eviction counters.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        if maxsize < 1:
+            raise ValueError("'maxsize' must be greater than 0")
+
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the cached value for ``key``. On a miss the ``factory`` is called and the
+        result is cached. The factory is called outside the lock so a slow factory does not
+        block readers of other keys.
+        """
+        sentinel = object()
+        if (value := self.get(key, sentinel)) is not sentinel:
+            return value
+
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._data),
+            maxsize=self.maxsize,
+        )
+
+
+class TTLCache(LRUCache):
+    """A size-bounded least recently used cache where entries also expire ``ttl`` seconds after
+    they are set. An expired entry is removed on read and counted as a miss.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 60,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if ttl <= 0:
+            raise ValueError("'ttl' must be greater than 0")
+
+        super().__init__(maxsize=maxsize)
+        self.ttl = ttl
+        self.timer = timer
+
+    def __contains__(self, key: Hashable) -> bool:
+        try:
+            expires_at, _ = self._data[key]
+        except KeyError:
+            return False
+        return expires_at > self.timer()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at <= self.timer():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        super().set(key, (self.timer() + self.ttl, value))
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
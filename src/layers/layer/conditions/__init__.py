@@ -1,202 +1,313 @@
 from datetime import date, datetime, timedelta
-from typing import Iterable
+from decimal import Decimal
+from functools import lru_cache
+import json
+import os
+import re
+from typing import Any, Callable, Iterable, Optional, Sequence
 
 import dateutil.parser
 from dateutil.tz import tzutc
 from dateutil.utils import default_tzinfo
-import jmespath
+from pydantic import TypeAdapter, ValidationError
 
-from .models import Condition, Criteria, CriteriaAttributes
+from caching import LRUCache
+from transforms.core import CompiledExpression, compile_expression
+from .models import VALUE_TYPES, Condition, Criteria, CriteriaAttributes
+
+CONDITION_CACHE_SIZE = int(os.getenv("CONDITION_CACHE_SIZE", 1024))
+
+_MISSING = object()
+_VERSION_PARTS = re.compile(r"\d+|[A-Za-z]+")
+
+
+def offset_datetime(days_ago=0) -> datetime:
+    """Return timezone aware UTC datetime object offset by X days in the past."""
+    return (datetime.utcnow() - timedelta(days=days_ago)).replace(tzinfo=tzutc())
+
+
+def make_datetime(timestamp) -> datetime:
+    """Converts an epoch or ISO 8601 date string to a UTC datetime object.
+
+    Jamf Pro stores epoch timestamps as 13 digit integers and not floats. These
+    values have to be converted to floats before conversion.
+    """
+    if isinstance(timestamp, datetime):
+        date_obj = timestamp
+    elif isinstance(timestamp, date):
+        date_obj = datetime.fromordinal(timestamp.toordinal())
+    elif isinstance(timestamp, (int, float)):
+        date_obj = (
+            datetime.utcfromtimestamp(timestamp / 1000)
+            if timestamp > 1000000000000
+            else datetime.utcfromtimestamp(timestamp)
+        )
+    else:
+        date_obj = dateutil.parser.parse(timestamp)
+    return default_tzinfo(date_obj, tzutc())
+
+
+def version_key(version: str) -> tuple:
+    """Converts a version string into a tuple that compares numerically by part:
+    ``"10.9.1" < "10.10"``. Letter parts compare before number parts at the same position.
+    """
+    return tuple(
+        (1, int(part)) if part.isdigit() else (0, part)
+        for part in _VERSION_PARTS.findall(version)
+    )
+
+
+def _parse_number(value) -> Any:
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return value
+    return _MISSING
+
+
+def _parse_string(value) -> Any:
+    return value if isinstance(value, str) else _MISSING
+
+
+def _parse_boolean(value) -> Any:
+    return value if isinstance(value, bool) else _MISSING
+
+
+def _parse_date(value) -> Any:
+    if value is None or isinstance(value, bool):
+        return _MISSING
+    try:
+        return make_datetime(value)
+    except (ValueError, TypeError, OverflowError):
+        return _MISSING
+
+
+def _parse_version(value) -> Any:
+    return version_key(value) if isinstance(value, str) else _MISSING
+
+
+# Each attribute type parses both sides of a comparison. A value that can't be parsed as the
+# attribute's type returns ``_MISSING`` and never matches.
+PARSERS: dict[str, Callable[[Any], Any]] = {
+    "Number": _parse_number,
+    "String": _parse_string,
+    "Boolean": _parse_boolean,
+    "Date": _parse_date,
+    "Version": _parse_version,
+}
+
+
+@lru_cache
+def value_coercer(attribute_type: str) -> TypeAdapter:
+    """Return the shared ``TypeAdapter`` that validates a value expression's result for the
+    attribute type. Adapters are built once per type and are safe to use from any thread.
+    """
+    return TypeAdapter(VALUE_TYPES[attribute_type])
+
+
+# Operators are matched when any resource value compares true against the condition value. The
+# exception is ``ne`` where no resource value can equal the condition value.
+COMPARATORS: dict[str, Callable[[tuple, Any], bool]] = {
+    "eq": lambda values, other: any(v == other for v in values),
+    "ne": lambda values, other: all(v != other for v in values),
+    "lt": lambda values, other: any(v < other for v in values),
+    "lte": lambda values, other: any(v <= other for v in values),
+    "gt": lambda values, other: any(v > other for v in values),
+    "gte": lambda values, other: any(v >= other for v in values),
+    "starts_with": lambda values, other: any(v.startswith(other) for v in values),
+    "before": lambda values, other: any(v <= other for v in values),
+    "after": lambda values, other: any(v > other for v in values),
+}
 
 
 class ConditionEvaluator:
+    """A compiled condition. Evaluation is pure: evaluators and their (frozen) models are never
+    modified after they are created, so one evaluator can be shared across any number of
+    resources and threads. Use ``compile_condition()`` to share evaluators for the same
+    condition.
+    """
+
+    __slots__ = ("model", "operator", "criteria", "expressions")
+
     def __init__(self, condition: dict):
         self.model = Condition.model_validate(condition)
-        self.criteria = [CriteriaEvaluator(c) for c in self.model.criteria]
+        self.operator = all if self.model.operator == "and" else any
+        self.criteria = tuple(CriteriaEvaluator(c) for c in self.model.criteria)
+        # Every distinct expression the condition searches
+        self.expressions: tuple[CompiledExpression, ...] = tuple(
+            {
+                e.expression: e
+                for c in self.criteria
+                for a in c.attributes
+                for e in a.expressions
+            }.values()
+        )
 
     def evaluate(self, resource: dict) -> bool:
-        if self.model.operator == "and":
-            return all([a.evaluate(resource) for a in self.criteria])
-        elif self.model.operator == "or":
-            return any([a.evaluate(resource) for a in self.criteria])
+        return self.operator(c.evaluate(resource) for c in self.criteria)
+
+    def evaluate_extracted(self, extracted: dict) -> bool:
+        """Evaluate using the results of ``expressions`` already searched on a resource. The
+        results are keyed by expression.
+        """
+        return self.operator(c.evaluate_extracted(extracted) for c in self.criteria)
 
 
 class CriteriaEvaluator:
+    __slots__ = ("model", "operator", "attributes")
+
     def __init__(self, model: Criteria):
         self.model = model
-        self.attributes = [AttributeEvaluator(a) for a in model.attributes]
+        self.operator = all if self.model.operator == "and" else any
+        self.attributes = tuple(AttributeEvaluator(a) for a in model.attributes)
 
     def evaluate(self, resource: dict) -> bool:
-        if self.model.operator == "and":
-            return all([a.evaluate(resource) for a in self.attributes])
-        elif self.model.operator == "or":
-            return any([a.evaluate(resource) for a in self.attributes])
+        return self.operator(a.evaluate(resource) for a in self.attributes)
+
+    def evaluate_extracted(self, extracted: dict) -> bool:
+        return self.operator(a.evaluate_extracted(extracted) for a in self.attributes)
 
 
 class AttributeEvaluator:
+    """Evaluates a single attribute of a resource. The attribute's expression, and the value's
+    expression if it has one, are compiled once. A constant value is parsed to the attribute's
+    type once.
+    """
+
+    __slots__ = (
+        "model",
+        "attribute",
+        "parse",
+        "compare",
+        "coerce",
+        "keep_unparsed",
+        "value",
+        "value_expression",
+        "expressions",
+    )
+
     def __init__(self, model: CriteriaAttributes):
         self.model = model
-        self.value = self.model.value
-        self.operator = getattr(self, f"{model.operator}_")
+        self.attribute: CompiledExpression = compile_expression(
+            model.attribute[2:], options=None
+        )
+        self.parse = PARSERS[model.type]
+        self.coerce = value_coercer(model.type)
+        self.compare = COMPARATORS[model.operator.value]
+        # A resource value that isn't of the attribute's type is never equal to the value
+        self.keep_unparsed = model.operator.value == "ne"
+
+        self.value_expression: Optional[CompiledExpression] = None
+        if isinstance(model.value, str) and model.value.startswith("::"):
+            self.value_expression = compile_expression(model.value[2:], options=None)
+            self.value = _MISSING
+        else:
+            self.value = self.parse(model.value)
+
+        self.expressions = tuple(
+            e for e in (self.attribute, self.value_expression) if e is not None
+        )
 
     def __repr__(self) -> str:
-        return f"<Attribute: '{self.model.attribute}' {self.model.operator} '{self.value}'>"
+        return f"<Attribute: '{self.model.attribute}' {self.model.operator.value} '{self.model.value}'>"
 
     def evaluate(self, resource: dict) -> bool:
+        return self._evaluate(
+            self.attribute.search(resource),
+            self.value_expression.search(resource) if self.value_expression else None,
+        )
+
+    def evaluate_extracted(self, extracted: dict) -> bool:
+        return self._evaluate(
+            extracted[self.attribute.expression],
+            (
+                extracted[self.value_expression.expression]
+                if self.value_expression
+                else None
+            ),
+        )
+
+    def _evaluate(self, attribute_result, value_result) -> bool:
         """Validate that the values returned at the resource's 'attribute' evaluate to
         'True' when compared to the set 'operator' and 'value.'
 
-        The 'operator' will map to a method that implements it:
-          * eq -> eq_()
-          * before -> before_()
-
         No returned values for the 'attribute' will return 'False.'
 
-        'TypeError' exceptions thrown by a mismatch between the type of the returned
-        value and the type of the matching value will return 'False.'
+        A 'value' that is not of the attribute's type will return 'False.' Resource values that
+        are not of the attribute's type do not match the 'value' (they satisfy 'ne').
         """
-        if not (attr_values := self._find_values(resource, self.model.attribute)):
+        if (value := self._evaluator_value(value_result)) is _MISSING:
             return False
-        try:
-            self.operator(
-                attr_values=attr_values,
-                value_to_compare=self._evaluator_value(resource),
-            )
-        except (AssertionError, TypeError, AttributeError) as error:
-            # TODO: This is way too broad
-            print(error)
+
+        parsed_values = tuple(map(self.parse, self._find_values(attribute_result)))
+        if not self.keep_unparsed:
+            parsed_values = tuple(v for v in parsed_values if v is not _MISSING)
+        if not parsed_values:
             return False
-        else:
-            return True
 
-    def _evaluator_value(self, source: dict):
-        """If 'value' is a JMESPath expression search and return that path."""
-        if isinstance(self.value, str) and self.value.startswith("::"):
-            result = jmespath.search(self.value[2:], source)
-            # This should trigger validation and cast to the correct type!
-            self.model.value = result
-            self.value = self.model.value
+        return self.compare(parsed_values, value)
 
-        return self.value
+    def _evaluator_value(self, value_result):
+        """If 'value' is a JMESPath expression coerce the expression's result to the
+        attribute's type. The result is local to this call.
+        """
+        if not self.value_expression:
+            return self.value
+
+        try:
+            value = self.coerce.validate_python(value_result)
+        except ValidationError:
+            return _MISSING
+        return self.parse(value)
 
     @staticmethod
-    def _find_values(source: dict, expression: str) -> tuple:
-        """'expression' will begin with '::'"""
-        values = jmespath.search(expression[2:], source)
+    def _find_values(values) -> tuple:
         if isinstance(values, Iterable) and not isinstance(values, str):
             return tuple(values)
         else:
-            return tuple((values,))
+            return (values,)
 
-    @staticmethod
-    def eq_(attr_values: tuple, value_to_compare) -> None:
-        """At least one of the resource values must equal the matching value"""
-        assert any([v == value_to_compare for v in attr_values])
 
-    @staticmethod
-    def ne_(attr_values: tuple, value_to_compare) -> None:
-        """None of the resource values can equal the matching value."""
-        assert all([v != value_to_compare for v in attr_values])
+condition_cache = LRUCache(maxsize=CONDITION_CACHE_SIZE)
 
-    @staticmethod
-    def lt_(attr_values: tuple, value_to_compare) -> None:
-        assert any([v < value_to_compare for v in attr_values])
 
-    @staticmethod
-    def gt_(attr_values: tuple, value_to_compare) -> None:
-        assert any([v > value_to_compare for v in attr_values])
+def compile_condition(condition: dict) -> ConditionEvaluator:
+    """Return a cached ``ConditionEvaluator`` for the condition. Conditions are cached by their
+    content so identical conditions on different workflows share an evaluator.
+    """
+    key = json.dumps(condition, sort_keys=True, default=repr)
+    return condition_cache.get_or_set(key, lambda: ConditionEvaluator(condition))
 
-    @staticmethod
-    def lte_(attr_values: tuple, value_to_compare) -> None:
-        assert any([v <= value_to_compare for v in attr_values])
 
-    @staticmethod
-    def gte_(attr_values: tuple, value_to_compare) -> None:
-        assert any([v >= value_to_compare for v in attr_values])
+def evaluate_batch(
+    conditions: Sequence[Optional[ConditionEvaluator]], resources: Sequence[dict]
+) -> list[list[bool]]:
+    """Evaluate every condition against every resource. Returns a matrix with a row for each
+    resource and a column for each condition. A ``None`` condition is always 'True.'
 
-    @staticmethod
-    def starts_with_(attr_values: tuple[str, ...], value_to_compare) -> None:
-        """String only operator method."""
-        assert any([v.startswith(value_to_compare) for v in attr_values])
+    Each distinct expression across all of the conditions is searched once per resource and
+    each distinct condition (by identity, see ``compile_condition()``) is evaluated once per
+    resource.
+    """
+    distinct = list({id(c): c for c in conditions if c is not None}.values())
+    expressions = {e.expression: e for c in distinct for e in c.expressions}
 
-    @staticmethod
-    def offset_datetime(days_ago=0) -> datetime:
-        """Return timezone aware UTC datetime object offset by X days in the past."""
-        return (datetime.utcnow() - timedelta(days=days_ago)).replace(tzinfo=tzutc())
+    extracted_rows = [
+        {key: expression.search(resource) for key, expression in expressions.items()}
+        for resource in resources
+    ]
 
-    @staticmethod
-    def make_datetime(timestamp) -> datetime:
-        """Converts an epoch or ISO 8601 date string to a UTC datetime object.
+    columns = {
+        id(c): [c.evaluate_extracted(extracted) for extracted in extracted_rows]
+        for c in distinct
+    }
+    always_true = [True] * len(resources)
 
-        Jamf Pro stores epoch timestamps as 13 digit integers and not floats. These
-        values have to be converted to floats before conversion.
-        """
-        if isinstance(timestamp, datetime):
-            date_obj = timestamp
-        elif isinstance(timestamp, date):
-            date_obj = datetime.fromordinal(timestamp.toordinal())
-        elif isinstance(timestamp, (int, float)):
-            date_obj = (
-                datetime.utcfromtimestamp(timestamp / 1000)
-                if timestamp > 1000000000000
-                else datetime.utcfromtimestamp(timestamp)
-            )
-        else:
-            date_obj = dateutil.parser.parse(timestamp)
-        return default_tzinfo(date_obj, tzutc())
-
-    def before_(self, attr_values: tuple, value_to_compare) -> None:
-        """Date only operator method.
-        Assert the resource value timestamp occurs before the 'Value' timestamp.
-        """
-        assert any(
-            [
-                self.make_datetime(v) <= self.make_datetime(value_to_compare)
-                for v in attr_values
-            ]
-        )
-
-    def after_(self, attr_values: tuple, value_to_compare) -> None:
-        """Date only operator method.
-        Assert the resource value timestamp occurs after the 'Value' timestamp.
-        """
-        assert any(
-            [
-                self.make_datetime(v) > self.make_datetime(value_to_compare)
-                for v in attr_values
-            ]
-        )
-
-    def less_than_x_days_(self, attr_values: tuple, value_to_compare) -> None:
-        """Compares the timestamp values against the current date offset by a number of
-        days (the 'Value'). Asserts 'True' if the value is later than (greater than)
-        the offset time.
-        """
-        # TODO: Implement
-        print(attr_values)
-        print(repr(self.make_datetime(attr_values[0])))
-        print(repr(self.offset_datetime(value_to_compare)))
-        assert any(
-            [
-                self.make_datetime(v) > self.offset_datetime(value_to_compare)
-                for v in attr_values
-            ]
-        )
-
-    def more_than_x_days_(self, attr_values: tuple, value_to_compare) -> None:
-        """Compares the timestamp values against the current date offset by a number of
-        days (the 'Value'). Asserts 'True' if the value is earlier than (less than) the
-        offset time.
-        """
-        # TODO: Implement
-        assert any(
-            [
-                self.make_datetime(v) < self.offset_datetime(value_to_compare)
-                for v in attr_values
-            ]
+    return [
+        list(row)
+        for row in zip(
+            *(columns[id(c)] if c is not None else always_true for c in conditions)
         )
+    ] or [[] for _ in resources]
 
 
 def evaluate_condition(condition: dict, source: dict) -> bool:
-    condition_evaluator = ConditionEvaluator(condition)
-    return condition_evaluator.evaluate(source)
+    return compile_condition(condition).evaluate(source)
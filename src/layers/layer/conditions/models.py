@@ -44,7 +44,7 @@ class StringAttribute(BaseModel):
 
     _attr_is_expression = field_validator("attribute")(attr_is_expression)
 
-    model_config = ConfigDict(extra="forbid", validate_assignment=True)
+    model_config = ConfigDict(extra="forbid", frozen=True)
 
 
 class NumberOperators(str, Enum):
@@ -65,7 +65,7 @@ class NumberAttribute(BaseModel):
     _attr_is_expression = field_validator("attribute")(attr_is_expression)
     _value_is_expression = field_validator("value")(value_is_expression)
 
-    model_config = ConfigDict(extra="forbid", validate_assignment=True)
+    model_config = ConfigDict(extra="forbid", frozen=True)
 
 
 class BooleanOperators(str, Enum):
@@ -82,7 +82,7 @@ class BooleanAttribute(BaseModel):
     _attr_is_expression = field_validator("attribute")(attr_is_expression)
     _value_is_expression = field_validator("value")(value_is_expression)
 
-    model_config = ConfigDict(extra="forbid", validate_assignment=True)
+    model_config = ConfigDict(extra="forbid", frozen=True)
 
 
 class DateOperators(str, Enum):
@@ -99,7 +99,7 @@ class DateAttribute(BaseModel):
     _attr_is_expression = field_validator("attribute", mode="after")(attr_is_expression)
     _value_is_expression = field_validator("value", mode="after")(value_is_expression)
 
-    model_config = ConfigDict(extra="forbid", validate_assignment=True)
+    model_config = ConfigDict(extra="forbid", frozen=True)
 
 
 class VersionOperators(str, Enum):
@@ -115,13 +115,23 @@ class VersionAttribute(BaseModel):
     type: Literal["Version"]
     attribute: str
     operator: VersionOperators
-    value: str  # TODO: make this a version (packaging)
+    value: str  # Version literals are parsed by the evaluator
 
     _attr_is_expression = field_validator("attribute")(attr_is_expression)
-    _value_is_expression = field_validator("value")(value_is_expression)
 
-    model_config = ConfigDict(extra="forbid", validate_assignment=True)
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
 
+# The types a value expression's result is coerced to for each attribute type
+VALUE_TYPES = {
+    "String": StrictStr,
+    "Number": Annotated[
+        Union[StrictInt, StrictFloat], Field(union_mode="left_to_right")
+    ],
+    "Boolean": StrictBool,
+    "Date": Annotated[Union[date, datetime], Field(union_mode="left_to_right")],
+    "Version": StrictStr,
+}
 
 CriteriaAttributes = Annotated[
     Union[
@@ -144,7 +154,7 @@ class Criteria(BaseModel):
     operator: CriteriaOperators = CriteriaOperators.AND
     attributes: list[CriteriaAttributes] = Field(min_length=1, max_length=10)
 
-    model_config = ConfigDict(use_enum_values=True)
+    model_config = ConfigDict(use_enum_values=True, frozen=True)
 
 
 class OnFailOptions(str, Enum):
@@ -158,4 +168,4 @@ class Condition(BaseModel):
     criteria: list[Criteria] = Field(min_length=1, max_length=10)
     on_fail: OnFailOptions = OnFailOptions.FAIL
 
-    model_config = ConfigDict(extra="forbid", use_enum_values=True)
+    model_config = ConfigDict(extra="forbid", use_enum_values=True, frozen=True)
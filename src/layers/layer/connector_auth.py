@@ -0,0 +1,256 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+from threading import Lock, Thread
+import time
+from types import MappingProxyType
+from typing import Mapping, Optional, Union
+
+import requests
+
+from aws_utils import get_boto3_client
+from caching import TTLCache
+
+AUTH_HEADER_CACHE_SIZE = int(os.getenv("AUTH_HEADER_CACHE_SIZE", 256))
+AUTH_HEADER_CACHE_TTL = int(os.getenv("AUTH_HEADER_CACHE_TTL", 300))
+OAUTH2_REFRESH_MARGIN = int(os.getenv("OAUTH2_REFRESH_MARGIN", 60))
+OAUTH2_TOKEN_TIMEOUT = int(os.getenv("OAUTH2_TOKEN_TIMEOUT", 10))
+
+logger = logging.getLogger(__name__)
+
+kms_client = get_boto3_client("kms")
+token_session = requests.Session()
+
+# Decrypted auth headers keyed by a hash of the encrypted credentials. Only the headers built
+# from the credentials are cached: the decrypted credentials are discarded as soon as the headers
+# are built and the ciphertext itself is never held as a key. Entries expire after
+# AUTH_HEADER_CACHE_TTL seconds so rotated keys and credentials are not held for long.
+#
+# OAuth2 client credentials are the exception. They are needed to request new tokens and are
+# cached (for the same TTL) as an ``OAuth2ClientAuth``.
+auth_header_cache = TTLCache(maxsize=AUTH_HEADER_CACHE_SIZE, ttl=AUTH_HEADER_CACHE_TTL)
+
+
+class OAuth2TokenError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class OAuth2Token:
+    access_token: str
+    token_type: str
+    expires_at: float
+
+    def expires_in(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def header(self) -> Mapping[str, str]:
+        token_type = (
+            "Bearer" if self.token_type.lower() == "bearer" else self.token_type
+        )
+        return MappingProxyType({"Authorization": f"{token_type} {self.access_token}"})
+
+
+def request_oauth2_token(credentials: dict) -> OAuth2Token:
+    """Request an access token with the OAuth2 client credentials grant."""
+    data = {"grant_type": "client_credentials"}
+    if scope := credentials.get("scope"):
+        data["scope"] = scope
+
+    if credentials["basic_auth"]:
+        auth = (credentials["client_id"], credentials["client_secret"])
+    else:
+        auth = None
+        data["client_id"] = credentials["client_id"]
+        data["client_secret"] = credentials["client_secret"]
+
+    try:
+        response = token_session.post(
+            credentials["token_url"],
+            data=data,
+            auth=auth,
+            headers={"Accept": "application/json"},
+            timeout=OAUTH2_TOKEN_TIMEOUT,
+        )
+        response.raise_for_status()
+        token = response.json()
+        return OAuth2Token(
+            access_token=token["access_token"],
+            token_type=token.get("token_type", "Bearer"),
+            expires_at=time.monotonic() + int(token.get("expires_in", 3600)),
+        )
+    except (requests.RequestException, ValueError, KeyError) as error:
+        raise OAuth2TokenError(
+            f"Failed to obtain an OAuth2 token: {type(error).__name__}"
+        ) from None
+
+
+class OAuth2TokenCache:
+    """Access tokens keyed by connector credentials and scope, shared by all runs.
+
+    * Only one request for a token is made at a time for a key (single-flight). Other callers
+      wait for and use the result.
+    * A token that expires within ``refresh_margin`` seconds is refreshed in a background
+      thread while callers continue to use it.
+    * ``get_token(..., stale_token=...)`` forces a refresh unless the cached token has already
+      replaced the stale one.
+    """
+
+    def __init__(self, refresh_margin: float = OAUTH2_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._tokens: dict[tuple, OAuth2Token] = {}
+        self._key_locks: dict[tuple, Lock] = {}
+        self._refreshing: set[tuple] = set()
+        self._lock = Lock()
+
+    def _key_lock(self, key: tuple) -> Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, Lock())
+
+    def _fetch(self, key: tuple, credentials: dict) -> OAuth2Token:
+        token = request_oauth2_token(credentials)
+        with self._lock:
+            self._tokens[key] = token
+        return token
+
+    def _refresh_in_background(self, key: tuple, credentials: dict) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                with self._key_lock(key):
+                    if self._tokens[key].expires_in() <= self.refresh_margin:
+                        self._fetch(key, credentials)
+            except Exception:
+                logger.exception("Background OAuth2 token refresh failed")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        Thread(target=refresh, daemon=True).start()
+
+    def get_token(
+        self, key: tuple, credentials: dict, stale_token: Optional[str] = None
+    ) -> OAuth2Token:
+        token = self._tokens.get(key)
+        if token and token.access_token != stale_token and token.expires_in() > 0:
+            if token.expires_in() <= self.refresh_margin:
+                self._refresh_in_background(key, credentials)
+            return token
+
+        with self._key_lock(key):
+            # Another caller may have obtained a token while this one waited
+            token = self._tokens.get(key)
+            if token and token.access_token != stale_token and token.expires_in() > 0:
+                return token
+            return self._fetch(key, credentials)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+
+oauth2_token_cache = OAuth2TokenCache()
+
+
+class OAuth2ClientAuth:
+    """Auth headers for OAuth2 client credentials backed by the shared token cache."""
+
+    __slots__ = ("key", "credentials")
+
+    def __init__(self, key: str, credentials: dict):
+        self.key = (key, credentials.get("scope"))
+        self.credentials = credentials
+
+    def headers(
+        self, stale_headers: Optional[Mapping[str, str]] = None
+    ) -> Mapping[str, str]:
+        stale_token = None
+        if stale_headers and (authorization := stale_headers.get("Authorization")):
+            stale_token = authorization.partition(" ")[-1]
+
+        return oauth2_token_cache.get_token(
+            self.key, self.credentials, stale_token=stale_token
+        ).header()
+
+
+def _ciphertext(credentials: dict) -> bytes:
+    # DynamoDB binary attributes are read as ``boto3.dynamodb.types.Binary``
+    return getattr(
+        credentials["CiphertextBlob"], "value", credentials["CiphertextBlob"]
+    )
+
+
+def credentials_cache_key(credentials: dict) -> str:
+    """Return a SHA-256 digest of the encrypted credentials to key the auth header cache."""
+    return hashlib.sha256(
+        credentials["KeyId"].encode("utf-8") + b"\x00" + _ciphertext(credentials)
+    ).hexdigest()
+
+
+def build_auth_headers(connector_credentials: dict) -> dict:
+    match connector_credentials["type"]:
+        case "ApiKey":
+            return {
+                connector_credentials["api_key_header"]: connector_credentials[
+                    "api_key"
+                ]
+            }
+        case "BearerToken":
+            return {"Authorization": f"Bearer {connector_credentials['bearer_token']}"}
+        case _:
+            raise Exception("Unsupported Auth Type")
+
+
+def decrypt_auth(credentials: dict) -> Union[Mapping[str, str], OAuth2ClientAuth]:
+    decrypted_credentials = kms_client.decrypt(
+        CiphertextBlob=_ciphertext(credentials),
+        KeyId=credentials["KeyId"],
+    )
+    connector_credentials = json.loads(decrypted_credentials.pop("Plaintext"))
+    del decrypted_credentials
+
+    if connector_credentials["type"] == "OAuth2Client":
+        return OAuth2ClientAuth(
+            key=credentials_cache_key(credentials), credentials=connector_credentials
+        )
+
+    try:
+        return MappingProxyType(build_auth_headers(connector_credentials))
+    finally:
+        connector_credentials.clear()
+
+
+def auth_headers(credentials: dict) -> Mapping[str, str]:
+    """Return the auth headers for a connector's encrypted credentials. Credentials are only
+    decrypted with KMS on a cache miss. The returned headers are shared and read-only.
+    """
+    auth = auth_header_cache.get_or_set(
+        credentials_cache_key(credentials), lambda: decrypt_auth(credentials)
+    )
+    if isinstance(auth, OAuth2ClientAuth):
+        return auth.headers()
+    return auth
+
+
+def refresh_auth_headers(
+    credentials: dict, stale_headers: Mapping[str, str]
+) -> Optional[Mapping[str, str]]:
+    """Return new auth headers after the ``stale_headers`` were rejected, or ``None`` if the
+    credentials can't be refreshed (only OAuth2 client credentials can be).
+    """
+    auth = auth_header_cache.get_or_set(
+        credentials_cache_key(credentials), lambda: decrypt_auth(credentials)
+    )
+    if isinstance(auth, OAuth2ClientAuth):
+        return auth.headers(stale_headers=stale_headers)
+    return None
+
+
+def clear_auth_header_cache() -> None:
+    auth_header_cache.clear()
@@ -1,6 +1,9 @@
-from functools import lru_cache
+from dataclasses import dataclass
 import os
 import time
+from types import MappingProxyType
+from typing import Mapping, Optional
+from urllib.parse import urlunparse
 
 from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
@@ -8,11 +11,69 @@ from ulid import ULID
 
 from apis.models import BadRequest, NotFound
 from aws_utils import get_boto3_resource
+from caching import TTLCache
 
 TABLE_NAME = os.getenv("TABLE_NAME")
+CONNECTOR_CACHE_SIZE = int(os.getenv("CONNECTOR_CACHE_SIZE", 256))
+CONNECTOR_CACHE_TTL = int(os.getenv("CONNECTOR_CACHE_TTL", 300))
 
 dynamodb_table = get_boto3_resource("dynamodb").Table(TABLE_NAME)
 
+# Connector indexes keyed by ``(tenant_id, connector_id)``. Cached connectors are shared and must
+# not be modified by callers.
+connector_cache = TTLCache(maxsize=CONNECTOR_CACHE_SIZE, ttl=CONNECTOR_CACHE_TTL)
+
+
+@dataclass(frozen=True)
+class ConnectorIndex:
+    """A connector indexed for lookups: actions and events by type, and the base URL of its
+    actions built from ``config.host`` and ``config.base_path``. Indexes are built once per
+    connector version and shared; neither the index nor the connector may be modified.
+    """
+
+    connector: dict
+    actions: Mapping[str, dict]
+    events: Mapping[str, dict]
+    base_url: Optional[str]
+    default_headers: Mapping[str, str]
+
+    @classmethod
+    def from_connector(cls, connector: dict) -> "ConnectorIndex":
+        config = connector.get("config") or {}
+        base_url = None
+        if host := config.get("host"):
+            base_url = urlunparse(
+                ("https", host, config.get("base_path") or "", None, None, None)
+            )
+
+        return cls(
+            connector=connector,
+            actions=MappingProxyType(
+                {i["type"]: i for i in connector.get("actions") or []}
+            ),
+            events=MappingProxyType(
+                {i["type"]: i for i in connector.get("events") or []}
+            ),
+            base_url=base_url,
+            default_headers=MappingProxyType(dict(config.get("default_headers") or {})),
+        )
+
+    @property
+    def id(self) -> str:
+        return self.connector["id"]
+
+    @property
+    def type(self) -> Optional[str]:
+        return self.connector.get("type")
+
+    @property
+    def version(self) -> int:
+        return self.connector["version"]
+
+    @property
+    def credentials(self) -> Optional[dict]:
+        return self.connector.get("credentials")
+
 
 def create_connector(tenant_id: str, data: dict) -> str:
     """Write a new connector for a tenant to the database.
@@ -58,8 +119,11 @@ def create_connector(tenant_id: str, data: dict) -> str:
 
 def read_connector(tenant_id: str, connector_id: str) -> dict:
     """Read a connector for a tenant from the database."""
-    response = dynamodb_table.get_item(
-        Key={"pk": f"T#{tenant_id}#C#{connector_id}", "sk": "A"}
+    # Workflow runs read connectors from several threads: the client is thread-safe, the
+    # table resource is not
+    response = dynamodb_table.meta.client.get_item(
+        TableName=dynamodb_table.name,
+        Key={"pk": f"T#{tenant_id}#C#{connector_id}", "sk": "A"},
     )
     try:
         return response["Item"]
@@ -67,10 +131,46 @@ def read_connector(tenant_id: str, connector_id: str) -> dict:
         raise NotFound("Connector not found", details={"id": connector_id})
 
 
-# TODO: Switch to TLRU caching
-@lru_cache
-def read_connector_cached(tenant_id: str, connector_id: str) -> dict:
-    return read_connector(tenant_id=tenant_id, connector_id=connector_id)
+def read_connector_index(
+    tenant_id: str, connector_id: str, min_version: Optional[int] = None
+) -> ConnectorIndex:
+    """Read a connector for a tenant through the connector cache and return its index.
+    Connectors are re-read after ``CONNECTOR_CACHE_TTL`` seconds, or immediately if the cached
+    version is older than ``min_version``.
+    """
+    key = (tenant_id, connector_id)
+    index = connector_cache.get(key)
+    if index is None or (min_version is not None and index.version < min_version):
+        index = ConnectorIndex.from_connector(
+            read_connector(tenant_id=tenant_id, connector_id=connector_id)
+        )
+        # A concurrent read may have already cached a newer version
+        cached = connector_cache.get(key)
+        if cached is None or cached.version <= index.version:
+            connector_cache.set(key, index)
+        else:
+            index = cached
+
+    return index
+
+
+def read_connector_cached(
+    tenant_id: str, connector_id: str, min_version: Optional[int] = None
+) -> dict:
+    """Read a connector for a tenant through the connector cache. See
+    ``read_connector_index()``.
+    """
+    return read_connector_index(
+        tenant_id=tenant_id, connector_id=connector_id, min_version=min_version
+    ).connector
+
+
+def invalidate_connector(tenant_id: str, connector_id: str) -> None:
+    """Remove a connector from this process's connector cache. Other processes read the
+    connector again after ``CONNECTOR_CACHE_TTL`` seconds, or when a workflow action needs a
+    newer version (the action's ``connector_version``).
+    """
+    connector_cache.pop((tenant_id, connector_id))
 
 
 def delete_connector(tenant_id: str, connector_id: str) -> None:
@@ -86,6 +186,8 @@ def delete_connector(tenant_id: str, connector_id: str) -> None:
             raise NotFound("Connector not found", details={"id": connector_id})
         else:
             raise
+    finally:
+        invalidate_connector(tenant_id=tenant_id, connector_id=connector_id)
 
 
 def list_connectors(tenant_id: str) -> list[dict]:
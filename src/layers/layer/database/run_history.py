@@ -1,6 +1,12 @@
+import logging
+import threading
+import time
 from typing import Optional
 
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
 
 
 def list_run_history(
@@ -52,3 +58,319 @@ def list_run_history_by_id(
     response = table_resource.query(**query_params)
 
     return response["Items"]
+
+
+def diff_state(old, new) -> list[dict]:
+    """Return the operations that change the ``old`` state into the ``new`` state, in the style
+    of a JSON patch: ``{"op": "add" | "remove" | "replace", "path": [...], "value": ...}``.
+
+    Paths are lists of keys and list indexes. The state is copy-on-write so a value that is the
+    same object in both states is unchanged and is not compared.
+    """
+    ops = []
+    _diff(old, new, [], ops)
+    return ops
+
+
+def _diff(old, new, path: list, ops: list) -> None:
+    if old is new:
+        return
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": path + [key]})
+        for key, value in new.items():
+            if key in old:
+                _diff(old[key], value, path + [key], ops)
+            else:
+                ops.append({"op": "add", "path": path + [key], "value": value})
+
+    elif isinstance(old, list) and isinstance(new, list):
+        common = min(len(old), len(new))
+        for index in range(common):
+            _diff(old[index], new[index], path + [index], ops)
+        for index in range(common, len(new)):
+            ops.append({"op": "add", "path": path + [index], "value": new[index]})
+        for index in reversed(range(common, len(old))):
+            ops.append({"op": "remove", "path": path + [index]})
+
+    elif type(old) is not type(new) or old != new:
+        ops.append({"op": "replace", "path": path, "value": new})
+
+
+def apply_state_diff(state, ops: list[dict]):
+    """Return a new state with the operations from ``diff_state()`` applied. The ``state`` is
+    not modified: only the containers on the path of an operation are copied.
+    """
+    for op in ops:
+        state = _apply(state, list(op["path"]), op)
+    return state
+
+
+def _apply(node, path: list, op: dict):
+    if not path:
+        return op.get("value")
+
+    node = list(node) if isinstance(node, list) else dict(node)
+    # List indexes are read from DynamoDB as ``Decimal``
+    key = int(path[0]) if isinstance(node, list) else path[0]
+
+    if len(path) > 1:
+        node[key] = _apply(node[key], path[1:], op)
+    elif op["op"] == "remove":
+        del node[key]
+    elif op["op"] == "add" and isinstance(node, list):
+        node.insert(key, op["value"])
+    else:
+        node[key] = op["value"]
+
+    return node
+
+
+def rebuild_history_states(items: list[dict]) -> list[dict]:
+    """Return the history items with the full ``state`` of items written with a
+    ``state_diff``. Items are returned in the same order.
+
+    The updates of a run, and of each nested run, are numbered by ``seq``. A diff applies to the
+    state of the run's update whose ``seq`` is the diff's ``state_base``. An item whose base
+    state isn't in ``items`` is returned without a state.
+    """
+    rebuilt = list(items)
+    states = {}
+
+    for index in sorted(
+        range(len(items)),
+        key=lambda i: (items[i].get("nested_run_id", ""), items[i].get("seq", 0)),
+    ):
+        item = items[index]
+        run_id = item.get("nested_run_id")
+
+        if "state" in item:
+            states[run_id] = (item.get("seq"), item["state"])
+        elif "state_diff" in item:
+            base_seq, base_state = states.pop(run_id, (None, None))
+            if base_seq is not None and base_seq == item["state_base"]:
+                state = apply_state_diff(base_state, item["state_diff"])
+                rebuilt[index] = {**item, "state": state}
+                states[run_id] = (item["seq"], state)
+
+    return rebuilt
+
+
+# Errors of ``BatchWriteItem`` requests that are rejected for their items. They are not retried.
+INVALID_ITEM_ERRORS = frozenset({"ValidationException"})
+
+
+class HistoryWriteError(Exception):
+    def __init__(self, message: str, items: list[dict]):
+        super().__init__(message)
+        self.items = items
+
+
+class HistoryWriter:
+    """Buffers run history items in memory and writes them with ``BatchWriteItem``.
+
+    Items are written by a background thread when ``batch_size`` items are pending or every
+    ``flush_interval`` seconds. ``flush()`` writes everything that is pending and blocks until
+    it is written: call it before a run or invocation ends.
+
+    A batch never contains two items with the same ``pk`` and ``sk`` (``BatchWriteItem`` rejects
+    the request). The later item is written in a later batch and replaces the earlier one, as
+    it would with ``PutItem``.
+
+    Unprocessed items are retried with exponential backoff. Items that can't be written are
+    returned to the buffer and ``flush()`` raises ``HistoryWriteError``. An item that is not
+    written by ``max_item_failures`` writes, or that DynamoDB rejects (``ValidationException``,
+    such as an item that is too large), is logged and dropped so it never blocks later items.
+    """
+
+    def __init__(
+        self,
+        table_resource,
+        batch_size: int = 25,
+        flush_interval: float = 1.0,
+        max_attempts: int = 5,
+        backoff: float = 0.05,
+        max_item_failures: int = 3,
+    ):
+        if not 0 < batch_size <= 25:
+            raise ValueError("'batch_size' must be between 1 and 25")
+
+        self.table = table_resource
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_item_failures = max_item_failures
+
+        self._pending: list[dict] = []
+        # The failed writes of items that were returned to the buffer, by ``(pk, sk)``
+        self._failures: dict[tuple, int] = {}
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def put(self, item: dict) -> None:
+        with self._condition:
+            self._pending.append(item)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def _take(self) -> list[dict]:
+        """Remove and return every pending item. Must be called holding the condition."""
+        items = self._pending
+        self._pending = []
+        self._in_flight += 1
+        return items
+
+    def _requeue(self, items: list[dict]) -> None:
+        """Return items to the front of the buffer, ahead of newer items. Items that failed
+        ``max_item_failures`` times are dropped. Must be called holding the condition.
+        """
+        requeued = []
+        for item in items:
+            key = (item["pk"], item["sk"])
+            failures = self._failures.get(key, 0) + 1
+            if failures < self.max_item_failures:
+                self._failures[key] = failures
+                requeued.append(item)
+            else:
+                self._failures.pop(key, None)
+                self._drop(item, f"The item failed {failures} writes")
+        self._pending[:0] = requeued
+
+    @staticmethod
+    def _drop(item: dict, reason: str) -> None:
+        logger.error(
+            "Dropped a run history item: %s (pk=%s, sk=%s)",
+            reason,
+            item["pk"],
+            item["sk"],
+        )
+
+    def _written(self, items: list[dict]) -> None:
+        """Forget the failures of written items."""
+        with self._condition:
+            if self._failures:
+                for item in items:
+                    self._failures.pop((item["pk"], item["sk"]), None)
+
+    def _batches(self, items: list[dict]) -> list[list[dict]]:
+        batches = []
+        batch, keys = [], set()
+        for item in items:
+            key = (item["pk"], item["sk"])
+            if len(batch) == self.batch_size or key in keys:
+                batches.append(batch)
+                batch, keys = [], set()
+            batch.append(item)
+            keys.add(key)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _done(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _write_batch(self, items: list[dict]) -> None:
+        requests = [{"PutRequest": {"Item": item}} for item in items]
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            response = self.table.meta.client.batch_write_item(
+                RequestItems={self.table.name: requests}
+            )
+            if not (
+                requests := response.get("UnprocessedItems", {}).get(self.table.name)
+            ):
+                return
+
+        raise HistoryWriteError(
+            f"{len(requests)} history items were not processed",
+            items=[i["PutRequest"]["Item"] for i in requests],
+        )
+
+    def _write(self, items: list[dict]) -> None:
+        """Write the items in order. Writing stops at the first batch that fails so an earlier
+        item is never written after a later item with the same key; the error holds every item
+        that was not written.
+        """
+        batches = self._batches(items)
+        for index, batch in enumerate(batches):
+            try:
+                try:
+                    self._write_batch(batch)
+                except ClientError as error:
+                    if error.response["Error"]["Code"] not in INVALID_ITEM_ERRORS:
+                        raise
+                    self._write_valid(batch)
+                self._written(batch)
+            except Exception as error:
+                failed = error.items if isinstance(error, HistoryWriteError) else batch
+                raise HistoryWriteError(
+                    str(error), items=failed + sum(batches[index + 1 :], [])
+                ) from error
+
+    def _write_valid(self, batch: list[dict]) -> None:
+        """Write the items of a rejected batch one at a time. The items that are rejected are
+        dropped.
+        """
+        for item in batch:
+            try:
+                self._write_batch([item])
+            except ClientError as error:
+                if error.response["Error"]["Code"] not in INVALID_ITEM_ERRORS:
+                    raise
+                self._drop(item, str(error))
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= self.batch_size
+                    and not self._in_flight,
+                    timeout=self.flush_interval,
+                )
+                # Only one write is in flight at a time so items are written in order
+                if not self._pending or self._in_flight:
+                    continue
+                items = self._take()
+
+            try:
+                self._write(items)
+            except HistoryWriteError as error:
+                logger.exception("Failed to write run history in the background")
+                with self._condition:
+                    self._requeue(error.items)
+            finally:
+                self._done()
+
+    def flush(self) -> None:
+        """Write every pending item, including items the background thread is writing."""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._in_flight == 0)
+                if not self._pending:
+                    return
+                items = self._take()
+
+            try:
+                self._write(items)
+            except HistoryWriteError as error:
+                with self._condition:
+                    self._requeue(error.items)
+                raise
+            finally:
+                self._done()
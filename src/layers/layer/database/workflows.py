@@ -1,7 +1,7 @@
 import logging
 import os
 import time
-from typing import Optional, Union
+from typing import Iterable, Optional, Union
 
 from boto3.dynamodb.conditions import Attr, Key
 from boto3.dynamodb.types import TypeSerializer
@@ -10,14 +10,26 @@ from ulid import ULID
 
 from apis.models import Conflict, NotFound
 from aws_utils import get_boto3_client, get_boto3_resource
+from caching import TTLCache
 
 TABLE_NAME = os.getenv("TABLE_NAME")
+WORKFLOW_DEFINITION_CACHE_SIZE = int(os.getenv("WORKFLOW_DEFINITION_CACHE_SIZE", 512))
+WORKFLOW_DEFINITION_CACHE_TTL = int(os.getenv("WORKFLOW_DEFINITION_CACHE_TTL", 300))
+BATCH_GET_MAX_KEYS = 100
 
 dynamodb_client = get_boto3_client("dynamodb")
 dynamodb_table = get_boto3_resource("dynamodb").Table(TABLE_NAME)
 
 type_serializer = TypeSerializer()
 
+# Workflow versions keyed by ``(tenant_id, workflow_id, version)``. A version is never modified
+# after it is created but it can be deleted: a deleted version is removed from this process's
+# cache, and other processes drop it after ``WORKFLOW_DEFINITION_CACHE_TTL`` seconds. Cached
+# versions are shared and must not be modified by callers.
+workflow_definition_cache = TTLCache(
+    maxsize=WORKFLOW_DEFINITION_CACHE_SIZE, ttl=WORKFLOW_DEFINITION_CACHE_TTL
+)
+
 
 def create_workflow(tenant_id: str, data: dict) -> str:
     """Write a new workflow for a tenant to the database."""
@@ -117,6 +129,65 @@ def read_workflow_version(
         )
 
 
+def read_workflow_definitions(
+    keys: Iterable[tuple[str, str, int]], max_attempts: int = 5
+) -> dict[tuple[str, str, int], dict]:
+    """Read workflow versions by ``(tenant_id, workflow_id, version)`` through the definition
+    cache. Versions that are not cached are read with ``BatchGetItem``.
+
+    Returns the versions keyed as requested. Versions that were not found are not returned.
+    """
+    versions = {}
+    missing = {}
+    for tenant_id, workflow_id, version in keys:
+        key = (tenant_id, workflow_id, int(version))
+        if (item := workflow_definition_cache.get(key)) is not None:
+            versions[key] = item
+        else:
+            missing[(f"T#{tenant_id}#W#{workflow_id}", f"V#{int(version)}")] = key
+
+    primary_keys = [{"pk": pk, "sk": sk} for pk, sk in missing]
+    for start in range(0, len(primary_keys), BATCH_GET_MAX_KEYS):
+        request = {
+            TABLE_NAME: {"Keys": primary_keys[start : start + BATCH_GET_MAX_KEYS]}
+        }
+
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** (attempt - 1))
+            response = dynamodb_table.meta.client.batch_get_item(RequestItems=request)
+
+            for item in response["Responses"].get(TABLE_NAME, []):
+                key = missing[(item["pk"], item["sk"])]
+                workflow_definition_cache.set(key, item)
+                versions[key] = item
+
+            if not (request := response.get("UnprocessedKeys")):
+                break
+        else:
+            raise Exception(
+                "Workflow versions could not be read: keys were unprocessed"
+            )
+
+    return versions
+
+
+def read_workflow_definition(
+    tenant_id: str, workflow_id: str, workflow_version: int
+) -> dict:
+    """Read a workflow version for a tenant through the definition cache. See
+    ``read_workflow_definitions()``.
+    """
+    key = (tenant_id, workflow_id, int(workflow_version))
+    try:
+        return read_workflow_definitions([key])[key]
+    except KeyError:
+        raise NotFound(
+            "Workflow version not found",
+            details={"id": workflow_id, "version": workflow_version},
+        )
+
+
 def read_workflow_release_version(
     tenant_id: str, workflow_id: str
 ) -> Union[dict, None]:
@@ -176,6 +247,8 @@ def delete_workflow_version(
             )
         else:
             raise
+    finally:
+        workflow_definition_cache.pop((tenant_id, workflow_id, int(workflow_version)))
 
 
 def list_workflows(
@@ -1,8 +1,9 @@
+from contextvars import ContextVar
 from typing import Any
 
-ITERATOR_VALUE: Any = None
+# Context variables are isolated per thread/task: each run sets its own values
+ITERATOR_VALUE: ContextVar[Any] = ContextVar("ITERATOR_VALUE", default=None)
 
 
 def reset() -> None:
-    global ITERATOR_VALUE
-    ITERATOR_VALUE = None
+    ITERATOR_VALUE.set(None)
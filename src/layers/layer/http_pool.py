@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from http.cookiejar import DefaultCookiePolicy
+from threading import BoundedSemaphore, Lock
+import time
+from typing import Optional, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PoolTimeout(requests.Timeout):
+    """No request slot for the host was free before the request's ``max_time``. Like other
+    request timeouts, the request was not sent and can be retried.
+    """
+
+
+def shorten_timeout(
+    timeout: Union[None, float, tuple], max_time: float
+) -> Union[float, tuple]:
+    """Return a ``requests`` timeout (seconds, or connect and read seconds) that is at most
+    ``max_time`` seconds.
+    """
+    if isinstance(timeout, tuple):
+        return tuple(max_time if i is None else min(i, max_time) for i in timeout)
+    return max_time if timeout is None else min(timeout, max_time)
+
+
+@dataclass(frozen=True)
+class HostPoolStats:
+    host: str
+    requests: int
+    errors: int
+    active: int
+    waiting: int
+    max_concurrency: int
+    pool_maxsize: int
+    connections_opened: int
+    connections_idle: int
+
+
+class HostPool:
+    """A session with a connection pool for a single host. The number of requests in flight to
+    the host is capped by a semaphore so a burst of concurrent actions queues instead of opening
+    more connections than the pool keeps alive.
+    """
+
+    def __init__(self, host: str, pool_maxsize: int, max_concurrency: int):
+        self.host = host
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency = max_concurrency
+
+        self.adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        # Sessions are shared by every run and tenant: never persist cookies between requests
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        self._semaphore = BoundedSemaphore(max_concurrency)
+        self._lock = Lock()
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+        self.waiting = 0
+
+    def request(self, max_time: Optional[float] = None, **kwargs) -> requests.Response:
+        """Send a request when a slot for the host is free. A request with a ``max_time`` waits
+        for a slot for at most that many seconds, then raises ``PoolTimeout``, and its
+        ``timeout`` is shortened to the time that is left.
+        """
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            acquired = self._semaphore.acquire(timeout=max_time)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        if not acquired:
+            with self._lock:
+                self.errors += 1
+            raise PoolTimeout(
+                f"No request slot for {self.host} was free within {max_time:.1f} seconds"
+            )
+
+        try:
+            with self._lock:
+                self.active += 1
+                self.requests += 1
+            if max_time is not None:
+                kwargs["timeout"] = shorten_timeout(
+                    kwargs.get("timeout"),
+                    max(max_time - (time.monotonic() - started), 0.001),
+                )
+            return self.session.request(**kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> HostPoolStats:
+        connections_opened = connections_idle = 0
+        for key in self.adapter.poolmanager.pools.keys():
+            if (pool := self.adapter.poolmanager.pools.get(key)) is not None:
+                connections_opened += pool.num_connections
+                # The pool's queue is filled with ``None`` until connections are returned to it
+                if pool.pool:
+                    connections_idle += sum(
+                        1 for i in list(pool.pool.queue) if i is not None
+                    )
+
+        return HostPoolStats(
+            host=self.host,
+            requests=self.requests,
+            errors=self.errors,
+            active=self.active,
+            waiting=self.waiting,
+            max_concurrency=self.max_concurrency,
+            pool_maxsize=self.pool_maxsize,
+            connections_opened=connections_opened,
+            connections_idle=connections_idle,
+        )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class HttpPoolManager:
+    """Process-wide HTTP connection pools keyed by host. Connections are kept alive and reused
+    by every request to a host from any runner or thread.
+
+    ``request()`` takes the same arguments as ``requests.Session.request()``, and a
+    ``max_time`` (see ``HostPool.request()``).
+
+    HTTP/2 is not supported by ``requests``; connections are HTTP/1.1 with keep-alive.
+    """
+
+    def __init__(self, pool_maxsize: int = 10, max_concurrency: int = 10):
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency = max_concurrency
+        self._pools: dict[str, HostPool] = {}
+        self._lock = Lock()
+
+    def pool(self, host: str) -> HostPool:
+        if (pool := self._pools.get(host)) is None:
+            with self._lock:
+                if (pool := self._pools.get(host)) is None:
+                    pool = self._pools[host] = HostPool(
+                        host=host,
+                        pool_maxsize=self.pool_maxsize,
+                        max_concurrency=self.max_concurrency,
+                    )
+        return pool
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self.pool(urlsplit(url).netloc.lower()).request(
+            method=method, url=url, **kwargs
+        )
+
+    def stats(self) -> list[HostPoolStats]:
+        return [i.stats() for i in list(self._pools.values())]
+
+    def close(self) -> None:
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
@@ -0,0 +1,174 @@
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from apis.models import DecimalEncoder
+from aws_utils import get_boto3_client
+from caching import LRUCache, TTLCache
+
+PAYLOAD_BUCKET_NAME = os.getenv("PAYLOAD_BUCKET_NAME")
+PAYLOAD_STORE_PATH = os.getenv("PAYLOAD_STORE_PATH")
+PAYLOAD_OFFLOAD_THRESHOLD = int(os.getenv("PAYLOAD_OFFLOAD_THRESHOLD", 32_768))
+PAYLOAD_CACHE_SIZE = int(os.getenv("PAYLOAD_CACHE_SIZE", 64))
+
+# Run message fields that can be large enough to offload
+OFFLOADED_FIELDS = ("source_input", "actions", "checkpoint")
+
+# Run payloads expire (see the bucket's lifecycle rules). Payloads referenced by schedules must
+# not expire and are written with the schedules prefix.
+RUNS_PREFIX = "runs/"
+SCHEDULES_PREFIX = "schedules/"
+
+
+class PayloadNotFound(Exception):
+    pass
+
+
+class PayloadStore(ABC):
+    """A content-addressed store of compressed JSON payloads. The key of a payload is the
+    SHA-256 digest of its serialized JSON so identical payloads (the actions of a workflow
+    version sent with every run) are stored once.
+
+    Payloads are immutable: payloads that were written or read are cached by key.
+    """
+
+    def __init__(self, prefix: str = RUNS_PREFIX):
+        self.prefix = prefix
+        self._cache = LRUCache(maxsize=PAYLOAD_CACHE_SIZE)
+        # Keys are forgotten well before a run payload can expire so an expired payload is
+        # always written again
+        self._written = TTLCache(maxsize=1024, ttl=3600)
+
+    @abstractmethod
+    def _write(self, key: str, data: bytes) -> None:
+        """Store compressed payload data at the key."""
+
+    @abstractmethod
+    def _read(self, key: str) -> bytes:
+        """Return the data stored at the key. Raises ``PayloadNotFound``."""
+
+    def put(self, raw: bytes) -> str:
+        """Store serialized JSON and return its key."""
+        key = f"{self.prefix}sha256/{hashlib.sha256(raw).hexdigest()}.json.gz"
+        if key not in self._written:
+            data = gzip.compress(raw)
+            self._write(key, data)
+            self._written.set(key, True)
+            self._cache.set(key, data)
+        return key
+
+    def get(self, key: str):
+        """Return the payload stored at the key. A new object is returned for every call."""
+        data = self._cache.get_or_set(key, lambda: self._read(key))
+        return json.loads(gzip.decompress(data))
+
+
+class S3PayloadStore(PayloadStore):
+    def __init__(self, bucket_name: str, prefix: str = RUNS_PREFIX, s3_client=None):
+        super().__init__(prefix=prefix)
+        self.bucket_name = bucket_name
+        self.s3_client = s3_client or get_boto3_client("s3")
+
+    def _write(self, key: str, data: bytes) -> None:
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Body=data,
+            ContentType="application/json",
+            ContentEncoding="gzip",
+        )
+
+    def _read(self, key: str) -> bytes:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "NoSuchKey":
+                raise PayloadNotFound(f"Payload not found: {key}")
+            raise
+        return response["Body"].read()
+
+
+class LocalPayloadStore(PayloadStore):
+    """Stores payloads as files in a directory. For local development and tests."""
+
+    def __init__(self, directory: str, prefix: str = RUNS_PREFIX):
+        super().__init__(prefix=prefix)
+        self.directory = Path(directory)
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = self.directory / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temp_path.write_bytes(data)
+        temp_path.replace(path)
+
+    def _read(self, key: str) -> bytes:
+        try:
+            return (self.directory / key).read_bytes()
+        except FileNotFoundError:
+            raise PayloadNotFound(f"Payload not found: {key}")
+
+
+@lru_cache
+def get_payload_store(prefix: str = RUNS_PREFIX) -> Optional[PayloadStore]:
+    """Return the configured payload store, or ``None`` if payloads are never offloaded."""
+    if PAYLOAD_BUCKET_NAME:
+        return S3PayloadStore(PAYLOAD_BUCKET_NAME, prefix=prefix)
+    elif PAYLOAD_STORE_PATH:
+        return LocalPayloadStore(PAYLOAD_STORE_PATH, prefix=prefix)
+    return None
+
+
+def run_message_body(
+    message: dict,
+    store: Optional[PayloadStore] = None,
+    threshold: int = PAYLOAD_OFFLOAD_THRESHOLD,
+) -> str:
+    """Serialize a run message. Fields in ``OFFLOADED_FIELDS`` larger than ``threshold`` bytes
+    are written to the payload store (claim check) and only their keys are sent, in
+    ``payloads``. See ``load_run_message()``.
+    """
+    if store is None:
+        store = get_payload_store()
+
+    if store is not None:
+        payloads = {}
+        for field in OFFLOADED_FIELDS:
+            if field not in message:
+                continue
+            raw = json.dumps(
+                message[field],
+                cls=DecimalEncoder,
+                sort_keys=True,
+                separators=(",", ":"),
+            ).encode("utf-8")
+            if len(raw) > threshold:
+                payloads[field] = store.put(raw)
+
+        if payloads:
+            message = {k: v for k, v in message.items() if k not in payloads}
+            message["payloads"] = payloads
+
+    return json.dumps(message, cls=DecimalEncoder)
+
+
+def load_run_message(body: str, store: Optional[PayloadStore] = None) -> dict:
+    """Deserialize a run message and read any offloaded fields from the payload store."""
+    message: dict = json.loads(body)
+
+    if payloads := message.pop("payloads", None):
+        if store is None:
+            store = get_payload_store()
+        if store is None:
+            raise PayloadNotFound("The run message has payloads but no payload store")
+        for field, key in payloads.items():
+            message[field] = store.get(key)
+
+    return message
@@ -0,0 +1,164 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import email.utils
+import os
+import random
+from threading import Lock
+from typing import Optional
+
+import requests
+
+from caching import LRUCache
+
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_CAPACITY = int(os.getenv("RETRY_BUDGET_CAPACITY", 10))
+RETRY_BUDGET_CACHE_SIZE = int(os.getenv("RETRY_BUDGET_CACHE_SIZE", 1024))
+# The longest wait before a retry: backoffs are capped, and a longer ``Retry-After`` delay is not
+# waited
+RETRY_MAX_DELAY = int(os.getenv("RETRY_MAX_DELAY", 900))
+
+# Errors that are retried when an action's ``retry_on`` is not set
+TRANSIENT_ERRORS = frozenset(
+    {"429", "500", "502", "503", "504", "TIMEOUT", "CONNECTIONERROR"}
+)
+
+
+def error_codes(error: Exception) -> tuple[str, ...]:
+    """Return the codes an action error is matched with by ``retry_on``: the status code and
+    its class (``"503"``, ``"5XX"``) of an HTTP error, ``"Timeout"`` or ``"ConnectionError"``
+    for requests that did not get a response, or the name of the exception's class.
+    """
+    if isinstance(error, requests.Timeout):
+        return ("Timeout",)
+    elif isinstance(error, requests.ConnectionError):
+        return ("ConnectionError",)
+    elif status_code := getattr(getattr(error, "response", None), "status_code", None):
+        return (str(status_code), f"{int(status_code) // 100}XX")
+    return (type(error).__name__,)
+
+
+def error_type(error: Exception) -> str:
+    """Classify an action error for run history: ``timeout`` (no response in time),
+    ``connection``, ``http`` (an error response), or ``error``.
+    """
+    if isinstance(error, requests.Timeout):
+        return "timeout"
+    elif isinstance(error, requests.ConnectionError):
+        return "connection"
+    elif getattr(error, "response", None) is not None:
+        return "http"
+    return "error"
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the seconds to wait from the ``Retry-After`` header of an HTTP error's response
+    (delay-seconds or an HTTP date), or ``None``.
+    """
+    if (response := getattr(error, "response", None)) is None:
+        return None
+    if not (value := (response.headers or {}).get("Retry-After")):
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """The ``on_error`` options of an action. Backoffs grow by ``rate`` from ``wait`` seconds up
+    to ``RETRY_MAX_DELAY`` and are drawn with full jitter so runs that failed together don't
+    retry together.
+    """
+
+    max_retries: int = 0
+    retry_on: Optional[frozenset[str]] = None
+    wait: float = 3
+    rate: float = 1.5
+    on_fail: Optional[str] = None
+
+    @classmethod
+    def from_on_error(
+        cls, on_error: Optional[dict], wait: float = 3, rate: float = 1.5
+    ) -> "RetryPolicy":
+        if not on_error:
+            return cls()
+
+        backoff = on_error.get("backoff") or {}
+        retry_on = on_error.get("retry_on")
+        return cls(
+            max_retries=int(on_error.get("max_retries") or 0),
+            retry_on=frozenset(str(i).upper() for i in retry_on) if retry_on else None,
+            wait=float(backoff.get("wait") or wait),
+            rate=float(backoff.get("rate") or rate),
+            on_fail=on_error.get("on_fail"),
+        )
+
+    def to_on_error(self) -> dict:
+        """Return the ``on_error`` options of the policy, to send it with a run message."""
+        return {
+            "max_retries": self.max_retries,
+            "retry_on": sorted(self.retry_on) if self.retry_on is not None else None,
+            "backoff": {"wait": self.wait, "rate": self.rate},
+            "on_fail": self.on_fail,
+        }
+
+    def retries(self, error: Exception, attempt: int) -> bool:
+        """Return whether the error of the ``attempt``-th retry (0 for the first request) is
+        retried.
+        """
+        if attempt >= self.max_retries:
+            return False
+        retry_on = self.retry_on if self.retry_on is not None else TRANSIENT_ERRORS
+        return any(i.upper() in retry_on for i in error_codes(error))
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(RETRY_MAX_DELAY, self.wait * self.rate**attempt))
+
+
+class RetryBudget:
+    """Limits the retries sent to a connector. Every first attempt deposits ``ratio`` of a
+    retry (up to ``capacity``) and every retry withdraws one, so during an outage retries add
+    at most ``ratio`` to the requests a connector receives instead of multiplying them.
+
+    Budgets are kept per execution environment and shared by every run in it.
+    """
+
+    def __init__(
+        self, ratio: float = RETRY_BUDGET_RATIO, capacity: int = RETRY_BUDGET_CAPACITY
+    ):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._balance = float(capacity)
+        self._lock = Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._balance = min(self._balance + self.ratio, self.capacity)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+    def balance(self) -> float:
+        return self._balance
+
+
+# Retry budgets keyed by ``(tenant_id, connector_id)``
+retry_budgets = LRUCache(maxsize=RETRY_BUDGET_CACHE_SIZE)
+
+
+def retry_budget(tenant_id: str, connector_id: str) -> RetryBudget:
+    return retry_budgets.get_or_set((tenant_id, connector_id), RetryBudget)
@@ -204,6 +204,10 @@ class CoreV1IteratorParams(BaseModel):
     # This must be a JMESPath expression that returns the array to iterate over
     array_path: str
     iterator_input: Optional[dict] = None
+    # The number of items that are run at the same time
+    max_concurrency: conint(gt=0, lt=51) = 1
+    # Arrays larger than the chunk size are split and sent to the run queue in chunks
+    fan_out_chunk_size: Optional[conint(gt=0, lt=1001)] = None
     # Iterators cannot be nested in and Iterator.
     actions: conlist(
         Union[
@@ -273,6 +277,16 @@ class CoreV1BranchParams(BaseModel):
     model_config = ConfigDict(extra="forbid")
 
     branches: conlist(CoreV1BranchItem, min_length=1, max_length=100)
+    # Run only the first branch whose condition is met. Otherwise every branch whose condition
+    # is met runs at the same time.
+    exclusive: bool = True
+
+    @field_validator("branches")
+    def validate_branches_order_values(cls, v):
+        assert len(order_ids := [i.order for i in v]) == len(
+            set(order_ids)
+        ), "Branch order values must be unique"
+        return v
 
 
 class CoreV1Branch(BaseModel):
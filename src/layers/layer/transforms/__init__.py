@@ -1,14 +1,14 @@
-import copy
+from abc import ABC, abstractmethod
+import json
 import re
 import string
-from typing import Union
+from typing import Optional, Union
 
 
-import jmespath
 from jmespath.exceptions import JMESPathError
 
-from .core import flexli_options
-
+from caching import LRUCache
+from .core import CompiledExpression, compile_expression, flexli_options
 
 key_path_splitter = re.compile(r"""((?:[^\."']|"[^"]*"|'[^']*')+)""")
 
@@ -19,6 +19,9 @@ class TransformError(Exception):
 
 # Copied from pydantic.v1.utils - function is deprecated in v2
 def deep_update(mapping: dict, *updating_mappings: dict) -> dict:
+    """Returns a new dictionary with the updates merged in. Only the dictionaries along the updated
+    key paths are copied; every other value is shared with ``mapping`` (copy-on-write).
+    """
     updated_mapping = mapping.copy()
     for updating_mapping in updating_mappings:
         for k, v in updating_mapping.items():
@@ -72,7 +75,7 @@ def return_value(value, source: dict):
         if isinstance(value, str) and value.startswith("::"):
             search_value = value[2:]
             return (
-                jmespath.search(search_value, source, options=flexli_options)
+                compile_expression(search_value).search(source)
                 if len(search_value) > 0
                 else source
             )
@@ -192,6 +195,16 @@ def find_and_format_strings(
                 )
 
 
+def format_fields(value: str) -> tuple[str, ...]:
+    """Returns the names of the format fields in a string. Strings that cannot be parsed as a
+    format string return an empty tuple.
+    """
+    try:
+        return tuple(t[1] for t in string.Formatter().parse(value) if t[1] is not None)
+    except ValueError:
+        return ()
+
+
 def find_value(path: list[str], source: dict):
     """Given a key path list, return the value of the innermost key."""
     if len(path) == 1:
@@ -211,6 +224,258 @@ def find_values_dict(values_dict: dict[str, str], source: dict) -> dict:
     return new_dict
 
 
+class _PlanNode(ABC):
+    """Base class for the compiled positions of a ``TransformPlan``. Values that are not a
+    ``_PlanNode`` are constants and are returned as-is when the plan is applied.
+    """
+
+    __slots__ = ()
+
+    @abstractmethod
+    def resolve(self, source, format_vars: Optional[dict]):
+        """Return the value of the position for the source."""
+
+
+class _ExpressionNode(_PlanNode):
+    """A JMESPath expression (the ``::`` prefix removed) that is parsed once."""
+
+    __slots__ = ("compiled",)
+
+    def __init__(self, expression: str):
+        try:
+            self.compiled: Optional[CompiledExpression] = (
+                compile_expression(expression) if expression else None
+            )
+        except JMESPathError as err:
+            raise TransformError(str(err))
+
+    def resolve(self, source, format_vars: Optional[dict]):
+        if self.compiled is None:
+            return source
+        try:
+            return self.compiled.search(source)
+        except JMESPathError as err:
+            raise TransformError(str(err))
+
+
+class _FormatStringNode(_PlanNode):
+    """A string with format fields. If the formatted string is an expression it is evaluated
+    unless the position is on an ignored path.
+    """
+
+    __slots__ = ("value", "fields", "evaluate")
+
+    def __init__(self, value: str, fields: tuple[str, ...], evaluate: bool):
+        self.value = value
+        self.fields = fields
+        self.evaluate = evaluate
+
+    def resolve(self, source, format_vars: Optional[dict]):
+        value = self.value
+        if format_vars and all(f in format_vars for f in self.fields):
+            value = value.format(**format_vars)
+        if self.evaluate:
+            return return_value(value, source)
+        return value
+
+
+class _DictNode(_PlanNode):
+    __slots__ = ("items",)
+
+    def __init__(self, items: tuple):
+        self.items = items
+
+    def resolve(self, source, format_vars: Optional[dict]):
+        return {
+            k: v.resolve(source, format_vars) if isinstance(v, _PlanNode) else v
+            for k, v in self.items
+        }
+
+
+class _ListNode(_PlanNode):
+    __slots__ = ("items",)
+
+    def __init__(self, items: tuple):
+        self.items = items
+
+    def resolve(self, source, format_vars: Optional[dict]):
+        return [
+            i.resolve(source, format_vars) if isinstance(i, _PlanNode) else i
+            for i in self.items
+        ]
+
+
+def _compile_node(value, ignored_paths: Optional[list[list]], evaluate: bool = True):
+    """Compile a template value into a ``_PlanNode``. Values without any expressions or format
+    fields are returned unchanged.
+    """
+    if isinstance(value, str):
+        if fields := format_fields(value):
+            return _FormatStringNode(value, fields, evaluate)
+        elif evaluate and value.startswith("::"):
+            return _ExpressionNode(value[2:])
+        return value
+
+    if isinstance(value, dict):
+        enumerate_items = tuple(value.items())
+        node_type = _DictNode
+    elif isinstance(value, list):
+        enumerate_items = tuple(enumerate(value))
+        node_type = _ListNode
+    else:
+        return value
+
+    compiled = []
+    for k, v in enumerate_items:
+        if not evaluate or key_path_is_ignored(current=k, ignored_paths=ignored_paths):
+            compiled.append((k, _compile_node(v, None, evaluate=False)))
+        else:
+            compiled.append(
+                (k, _compile_node(v, check_next_ignored_paths(k, ignored_paths)))
+            )
+
+    if not any(isinstance(v, _PlanNode) for _, v in compiled):
+        return value
+
+    if node_type is _DictNode:
+        return _DictNode(tuple(compiled))
+    return _ListNode(tuple(v for _, v in compiled))
+
+
+class TransformPlan:
+    """A compiled form of the ``updates``, ``variables`` and ``ignored_paths`` passed to
+    ``transform()``.
+
+    Key paths are split, JMESPath expressions are parsed, and the positions holding expressions
+    or format fields are recorded once. Applying the plan only visits those positions; values
+    already in the ``target`` are treated as data and are never scanned.
+
+    Results are copy-on-write: only the dictionaries along updated key paths are new objects.
+    Untouched values are shared with the ``target`` and values read from the ``source`` are not
+    copied, so neither the inputs nor the result may be mutated in place.
+
+    :param updates: A dictionary of key-path locations and values/JMESPath expressions.
+
+    :param variables: A dictionary of names and values/JMESPath expressions used to format
+        strings in the ``updates`` (and ``template``).
+
+    :param ignored_paths: A list of key-paths that will be ignored when processing JMESPath
+        expressions.
+
+    :param template: A static dictionary the ``updates`` are applied to. The template is
+        compiled with the plan (expressions and format fields in it are processed).
+    """
+
+    __slots__ = ("wildcard", "updates", "variables", "template")
+
+    def __init__(
+        self,
+        updates: dict = None,
+        variables: dict[str, str] = None,
+        ignored_paths: list[str] = None,
+        template: dict = None,
+    ):
+        # The `source` will be returned if the update wildcard is detected
+        self.wildcard = bool(updates) and ("::", "::") in updates.items()
+
+        if ignored_paths:
+            ignored_paths = [key_path_from_string(i) for i in ignored_paths]
+
+        self.template = _compile_node(template, ignored_paths) if template else None
+
+        self.updates = []
+        for k, v in (updates or {}).items() if not self.wildcard else ():
+            key_path = tuple(key_path_from_string(k))
+
+            # Values set directly by an expression are always evaluated
+            if isinstance(v, str) and v.startswith("::"):
+                self.updates.append((key_path, _ExpressionNode(v[2:])))
+                continue
+
+            # Ignored paths are followed along the key path of the update
+            next_ignored_paths, evaluate = ignored_paths, True
+            for key in key_path:
+                if key_path_is_ignored(current=key, ignored_paths=next_ignored_paths):
+                    next_ignored_paths, evaluate = None, False
+                    break
+                next_ignored_paths = check_next_ignored_paths(key, next_ignored_paths)
+
+            self.updates.append(
+                (key_path, _compile_node(v, next_ignored_paths, evaluate=evaluate))
+            )
+
+        self.variables = None
+        if variables:
+            self.variables = {
+                k: _ExpressionNode(v[2:]) if isinstance(v, str) and v[:2] == "::" else v
+                for k, v in variables.items()
+            }
+
+    def apply(self, source, target: dict = None, format_vars: dict = None) -> dict:
+        """Apply the plan to a ``source`` and return a new object.
+
+        :param source: The data referenced by the JMESPath expressions in the plan.
+
+        :param target: A dictionary the updates are applied to. The target is not modified.
+            If not provided the plan's ``template`` (or an empty dictionary) is used.
+
+        :param format_vars: A dictionary of variable names and values used to format strings.
+            These are merged over any resolved ``variables`` of the plan.
+        """
+        if self.wildcard:
+            return source
+
+        if self.variables:
+            resolved_vars = {
+                k: v.resolve(source, None) if isinstance(v, _PlanNode) else v
+                for k, v in self.variables.items()
+            }
+            if format_vars:
+                resolved_vars.update(format_vars)
+        else:
+            resolved_vars = format_vars
+
+        if target is None:
+            if isinstance(self.template, _PlanNode):
+                target = self.template.resolve(source, resolved_vars)
+            else:
+                target = self.template or {}
+
+        return deep_update(
+            target,
+            *(
+                dict_from_key_path(
+                    key_path,
+                    v.resolve(source, resolved_vars) if isinstance(v, _PlanNode) else v,
+                )
+                for key_path, v in self.updates
+            ),
+        )
+
+
+TRANSFORM_PLAN_CACHE_SIZE = 1024
+
+transform_plan_cache = LRUCache(maxsize=TRANSFORM_PLAN_CACHE_SIZE)
+
+
+def compile_transform(
+    updates: dict = None,
+    variables: dict[str, str] = None,
+    ignored_paths: list[str] = None,
+) -> TransformPlan:
+    """Return a ``TransformPlan`` for an action or source definition. Plans are cached by the
+    content of the definition so a workflow's plans are only compiled once per process.
+    """
+    # Keys are not sorted: updates are applied in order and overlapping key-paths depend on it
+    key = json.dumps([updates, variables, ignored_paths], default=repr)
+    return transform_plan_cache.get_or_set(
+        key,
+        lambda: TransformPlan(
+            updates=updates, variables=variables, ignored_paths=ignored_paths
+        ),
+    )
+
+
 def transform(
     source: dict,
     target: dict = None,
@@ -223,7 +488,8 @@ def transform(
     :param source: A dictionary that contains data that will be referenced by JMESPath expressions
         in the ``updates`` and ``variables`` dictionaries.
 
-    :param target: A dictionary that will be modified and returned.
+    :param target: A dictionary the ``updates`` are applied to. The target is not modified; the
+        returned object shares every unchanged value with it.
 
     :param updates: A dictionary of key-path locations and JMESPath expressions that will reference
         the ``source`` dictionary to apply to the ``target`` dictionary.
@@ -234,40 +500,11 @@ def transform(
     :param ignored_paths: A list of key-paths that will be ignored when processing JMESPath
         expressions and string formatting.
 
+    Use ``compile_transform()`` for definitions that are applied repeatedly.
     """
-    # A copy of the `source` will be returned if the update wildcard is detected
-    if updates and ("::", "::") in updates.items():
-        return copy.deepcopy(source)
-
-    # The `ignored_paths` are converted to key-path lists
-    if ignored_paths:
-        ignored_paths = [key_path_from_string(i) for i in ignored_paths]
-
-    # If a target was provided a copy is made
-    target_copy = copy.deepcopy(target) if target else {}
-
-    # The `target_copy` has any `updates` applied from the `source`
-    if updates:
-        target_updates = [
-            dict_from_key_path(
-                key_path_from_string(k),
-                return_value(value=v, source=source),
-            )
-            for k, v in updates.items()
-        ]
-
-        target_copy = deep_update(target_copy, *target_updates)
-
-    # Formattable strings are found and processed
-    if variables:
-        find_and_format_strings(
-            target=target_copy,
-            format_vars=find_values_dict(values_dict=variables, source=source),
-        )
-
-    # JMESPath expressions are found and processed (this is always done)
-    find_and_evaluate_expressions(
-        target=target_copy, source=source, ignored_paths=ignored_paths
-    )
-
-    return target_copy
+    return TransformPlan(
+        updates=updates,
+        variables=variables,
+        ignored_paths=ignored_paths,
+        template=target,
+    ).apply(source=source)
@@ -1,13 +1,20 @@
 import json
 from datetime import datetime, timedelta
+import os
 import random
 import string
+from typing import Any, Optional
 
 import dateutil.parser
+import jmespath
 import jmespath.functions
+from jmespath.parser import ParsedResult
 
+from caching import LRUCache
 import flexli_globals
 
+EXPRESSION_CACHE_SIZE = int(os.getenv("EXPRESSION_CACHE_SIZE", 2048))
+
 
 class CustomFunctionException(Exception):
     pass
@@ -16,12 +23,10 @@ class CustomFunctionException(Exception):
 class FlexliCustomFunctions(jmespath.functions.Functions):
     @jmespath.functions.signature()
     def _func_flexli_iterator_value(self):
-        # TODO: Returns iterator value for a running workflow
-        # But how?
-        if flexli_globals.ITERATOR_VALUE is None:
+        if (iterator_value := flexli_globals.ITERATOR_VALUE.get()) is None:
             raise CustomFunctionException("No iterator value present")
         else:
-            return flexli_globals.ITERATOR_VALUE
+            return iterator_value
 
     @jmespath.functions.signature()
     def _func_flexli_datetime_now(self) -> str:
@@ -87,3 +92,38 @@ class FlexliCustomFunctions(jmespath.functions.Functions):
 
 
 flexli_options = jmespath.Options(custom_functions=FlexliCustomFunctions())
+
+
+class CompiledExpression:
+    """A parsed JMESPath expression bound to the options (custom functions) it is searched with."""
+
+    __slots__ = ("expression", "parsed", "options")
+
+    def __init__(self, expression: str, options: Optional[jmespath.Options] = None):
+        self.expression = expression
+        self.parsed: ParsedResult = jmespath.compile(expression)
+        self.options = options
+
+    def __repr__(self) -> str:
+        return f"<CompiledExpression: '{self.expression}'>"
+
+    def search(self, data: Any) -> Any:
+        return self.parsed.search(data, options=self.options)
+
+
+expression_cache = LRUCache(maxsize=EXPRESSION_CACHE_SIZE)
+
+
+def compile_expression(
+    expression: str, options: Optional[jmespath.Options] = flexli_options
+) -> CompiledExpression:
+    """Return a ``CompiledExpression`` for a JMESPath expression (without the ``::`` prefix).
+
+    Parsed expressions are kept in a process-wide LRU cache keyed by the expression text and the
+    options. Use ``expression_cache.stats()`` to inspect the hit/miss/eviction counters.
+
+    Raises ``jmespath.exceptions.JMESPathError`` if the expression cannot be parsed.
+    """
+    return expression_cache.get_or_set(
+        (expression, options), lambda: CompiledExpression(expression, options)
+    )
@@ -1,8 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
-from functools import lru_cache
+from dataclasses import dataclass
 import json
 import os
-from typing import Iterator
+from typing import Iterator, Optional
 
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.utilities.data_classes import event_source
@@ -11,15 +12,20 @@ from aws_lambda_powertools.utilities.typing import LambdaContext
 from boto3.dynamodb.conditions import Key
 from ulid import ULID
 
-from apis.models import DecimalEncoder
-from aws_utils import get_boto3_client, get_boto3_resource
-from conditions import ConditionEvaluator
-from transforms import transform
+from aws_utils import get_boto3_client, get_boto3_resource, send_message_batches
+from caching import TTLCache
+from conditions import ConditionEvaluator, compile_condition, evaluate_batch
+from payload_store import run_message_body
+from transforms import TransformPlan, compile_transform
 
 from local import Event, EventToSend
 
 MAIN_TABLE_NAME = os.environ["MAIN_TABLE_NAME"]
 RUN_QUEUE_URL = os.environ["RUN_QUEUE_URL"]
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 4))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 1024))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", 60))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 8))
 
 logger = Logger()
 tracer = Tracer()
@@ -28,14 +34,92 @@ main_table = get_boto3_resource("dynamodb").Table(MAIN_TABLE_NAME)
 sqs_client = get_boto3_client("sqs")
 
 
+@dataclass(frozen=True)
+class WorkflowSubscription:
+    """A workflow subscribed to an event type with its source condition and transform
+    compiled.
+    """
+
+    workflow: dict
+    condition: Optional[ConditionEvaluator]
+    transform: Optional[TransformPlan]
+
+
+# Maps ``T#<tenant_id>#C#<connector_id>/E#<event_type>`` to the subscribed workflows. The index
+# lives for the life of the execution environment. Entries expire after SUBSCRIPTION_CACHE_TTL
+# seconds so enabled, disabled, and updated workflows are picked up within that window.
+subscription_index = TTLCache(
+    maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL
+)
+
+
+def subscription_key(tenant_id: str, connector_id: str, event_type: str) -> str:
+    return f"T#{tenant_id}#C#{connector_id}/E#{event_type}"
+
+
+def query_subscriptions(
+    tenant_id: str, connector_id: str, event_type: str
+) -> tuple[WorkflowSubscription, ...]:
+    query_kwargs = {
+        "IndexName": "GSI1",
+        "KeyConditionExpression": Key("gsi1pk").eq(f"T#{tenant_id}#C#{connector_id}")
+        & Key("gsi1sk").eq(f"E#{event_type}"),
+    }
+
+    workflows = []
+    while True:
+        response = main_table.query(**query_kwargs)
+        workflows.extend(response["Items"])
+        if not (last_key := response.get("LastEvaluatedKey")):
+            break
+        query_kwargs["ExclusiveStartKey"] = last_key
+
+    return tuple(
+        WorkflowSubscription(
+            workflow=workflow,
+            condition=(
+                compile_condition(condition)
+                if (condition := workflow["source"].get("condition"))
+                else None
+            ),
+            transform=(
+                compile_transform(updates=transform)
+                if (transform := workflow["source"].get("transform"))
+                else None
+            ),
+        )
+        for workflow in workflows
+    )
+
+
+def prefetch_subscriptions(keys: set[tuple[str, str, str]]) -> None:
+    """Query the subscriptions for every ``(tenant_id, connector_id, event_type)`` not already in
+    the index concurrently and add them to the index. Keys with no subscriptions are also cached.
+    """
+    missing = [i for i in keys if subscription_key(*i) not in subscription_index]
+    if not missing:
+        return
+
+    def fetch(key: tuple[str, str, str]):
+        subscription_index.set(subscription_key(*key), query_subscriptions(*key))
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(PREFETCH_CONCURRENCY, len(missing)))
+    ) as executor:
+        # Consume the results to raise any query errors
+        list(executor.map(fetch, missing))
+
+
 class EventProcessor:
     def __init__(self, records: Iterator[SQSRecord]):
         """
         For each event:
         - Get type, query all workflows with sources matched to the type
-            -> Cache workflows to prevent repeat, duplicate reads
+            -> Workflows are cached in the process-level subscription index
+            -> Missing index entries for the batch are prefetched concurrently
             -> Discard event if there are no workflows that source it
         - Evaluate workflow's source condition if present
+            -> Conditions for all events of the same type are evaluated as a batch
             -> Discard if condition is present and fails
             -> A condition failure is not a SQS item failure
         - Apply transform if present
@@ -49,30 +133,20 @@ class EventProcessor:
 
         self.failed_item_ids: list[str] = []
 
-    @lru_cache
-    def _query_workflows_for_tenant(
-        self, tenant_id: str, connector_id: str, event_type: str
-    ) -> list[dict]:
-        response = main_table.query(
-            IndexName="GSI1",
-            KeyConditionExpression=Key("gsi1pk").eq(f"T#{tenant_id}#C#{connector_id}")
-            & Key("gsi1sk").eq(f"E#{event_type}"),
-        )
-
-        return response["Items"]
-
-    def get_workflows_for_event_type(
-        self, tenant_id: str, connector_id: str, event_type: str
-    ) -> list[dict]:
-        return self._query_workflows_for_tenant(
-            tenant_id=tenant_id, connector_id=connector_id, event_type=event_type
+    @staticmethod
+    def get_subscriptions_for_event_type(
+        tenant_id: str, connector_id: str, event_type: str
+    ) -> tuple[WorkflowSubscription, ...]:
+        return subscription_index.get_or_set(
+            subscription_key(tenant_id, connector_id, event_type),
+            lambda: query_subscriptions(tenant_id, connector_id, event_type),
         )
 
     def evaluate_events(self):
+        events = []
         for record in self.records:
             logger.debug(record)
             try:
-                logger.debug(dir(record))
                 event = Event(**record.json_body)
             except:
                 logger.exception(f"Failed to parse event: %s", record.raw_event)
@@ -80,55 +154,90 @@ class EventProcessor:
                 continue
 
             logger.debug(event)
+            events.append((record, event))
 
-            for workflow in self.get_workflows_for_event_type(
-                tenant_id=event.tenant_id,
-                connector_id=event.connector_id,
-                event_type=event.event_type,
-            ):
-                # Workflows returned in this query are guaranteed to have `source` objects.
-                # if workflow_source := workflow.get("source"):
-                if source_condition := workflow["source"].get("condition"):
-                    if not ConditionEvaluator(source_condition).evaluate(event.data):
-                        logger.info(
-                            "Workflow %s source condition failed for event %s",
-                            workflow["id"],
-                            event.id,
-                        )
-                        continue
+        # Events are grouped by event type and each group's source conditions are evaluated
+        # together, extracting each attribute once per event
+        event_types: dict[tuple[str, str, str], list[int]] = {}
+        for idx, (_, event) in enumerate(events):
+            event_types.setdefault(
+                (event.tenant_id, event.connector_id, event.event_type), []
+            ).append(idx)
+
+        prefetch_subscriptions(set(event_types))
+
+        results: dict[int, tuple[tuple[WorkflowSubscription, ...], list[bool]]] = {}
+        for event_type, indices in event_types.items():
+            subscriptions = self.get_subscriptions_for_event_type(*event_type)
+            matrix = evaluate_batch(
+                [i.condition for i in subscriptions],
+                [events[idx][1].data for idx in indices],
+            )
+            for idx, row in zip(indices, matrix):
+                results[idx] = (subscriptions, row)
+
+        for idx, (record, event) in enumerate(events):
+            subscriptions, row = results[idx]
+            for subscription, passed in zip(subscriptions, row):
+                workflow = subscription.workflow
+                if not passed:
+                    logger.info(
+                        "Workflow %s source condition failed for event %s",
+                        workflow["id"],
+                        event.id,
+                    )
+                    continue
 
                 # TODO: Optimize for memory use (only store unique workflows once)
-                self.events_to_send.append(EventToSend(workflow=workflow, event=event))
+                self.events_to_send.append(
+                    EventToSend(
+                        workflow=workflow,
+                        transform=subscription.transform,
+                        event=event,
+                        message_id=record.message_id,
+                    )
+                )
 
     def send_events_to_run_queue(self):
-        # TODO: Optimize for SQS batching
+        """Send the runs to the run queue with ``SendMessageBatch``. A failed message marks the
+        originating SQS record as an item failure. Other runs from the same record that were sent
+        are not recalled.
+        """
+        messages = []
         for event in self.events_to_send:
-            if event.workflow["source"].get("transform"):
+            if event.transform:
                 logger.debug("***** RUNNING SOURCE TRANSFORM *****")
-                source_input = transform(
-                    source=event.event.data,
-                    updates=event.workflow["source"]["transform"],
-                )
+                source_input = event.transform.apply(source=event.event.data)
             else:
                 source_input = event.event.data
 
             logger.debug(source_input)
             new_run_id = str(ULID())  # TODO: Should this be upstream?
-            sqs_client.send_message(
-                QueueUrl=RUN_QUEUE_URL,
-                MessageBody=json.dumps(
-                    {
-                        "tenant_id": event.event.tenant_id,
-                        "workflow_id": event.workflow["id"],
-                        "workflow_version": event.workflow["version"],
-                        "run_id": new_run_id,
-                        "source_input": source_input,
-                        "actions": event.workflow["actions"],
-                    },
-                    cls=DecimalEncoder,
-                ),
+            messages.append(
+                (
+                    event.message_id,
+                    run_message_body(
+                        {
+                            "tenant_id": event.event.tenant_id,
+                            "workflow_id": event.workflow["id"],
+                            "workflow_version": event.workflow["version"],
+                            "run_id": new_run_id,
+                            "source_input": source_input,
+                        }
+                    ),
+                )
             )
 
+        for message_id in send_message_batches(
+            queue_url=RUN_QUEUE_URL,
+            messages=messages,
+            sqs_client=sqs_client,
+            max_workers=SEND_CONCURRENCY,
+        ):
+            if message_id not in self.failed_item_ids:
+                logger.error("Failed to send run for event record %s", message_id)
+                self.failed_item_ids.append(message_id)
+
     def sqs_batch_failures(self) -> dict:
         return {
             "batchItemFailures": [{"itemIdentifier": i} for i in self.failed_item_ids]
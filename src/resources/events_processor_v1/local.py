@@ -1,9 +1,12 @@
 import copy
 from datetime import datetime
 import json
+from typing import Optional
 
 from pydantic import BaseModel, ConfigDict, model_validator
 
+from transforms import TransformPlan
+
 
 class Event(BaseModel):
     type: str
@@ -34,4 +37,8 @@ class Event(BaseModel):
 
 class EventToSend(BaseModel):
     workflow: dict
+    transform: Optional[TransformPlan] = None
     event: Event
+    message_id: str
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
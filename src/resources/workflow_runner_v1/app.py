@@ -1,19 +1,28 @@
 from __future__ import annotations
 
-import copy
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from dataclasses import asdict
 from datetime import datetime, timedelta
+from functools import cached_property
+import inspect
 
 import json
+import math
 import os
 import posixpath
+from threading import Lock
 import time
-from typing import Optional, Union
-from urllib.parse import urlunparse
+from typing import Callable, Iterator, Optional, Union
 
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.utilities.batch import (
+    AsyncBatchProcessor,
     BatchProcessor,
     EventType,
+    async_process_partial_response,
     process_partial_response,
 )
 from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
@@ -23,32 +32,86 @@ from ulid import ULID
 
 import flexli_globals
 from aws_utils import get_boto3_client, get_boto3_resource
-from conditions import ConditionEvaluator
-from database.connectors import read_connector_cached
-from database.workflows import read_workflow_version
-from transforms import TransformError, transform
+from caching import LRUCache
+from conditions import ConditionEvaluator, compile_condition
+from connector_auth import auth_headers, refresh_auth_headers
+from database.connectors import ConnectorIndex, read_connector_index
+from database.run_history import HistoryWriteError, HistoryWriter, diff_state
+from database.workflows import read_workflow_definition, read_workflow_definitions
+from http_pool import HttpPoolManager
+from payload_store import load_run_message, run_message_body
+from retries import (
+    RETRY_MAX_DELAY,
+    RetryBudget,
+    RetryPolicy,
+    error_type,
+    retry_after,
+    retry_budget,
+)
+from transforms import TransformError, TransformPlan, compile_transform
 
 MAIN_TABLE_NAME = os.environ["MAIN_TABLE_NAME"]
 WORKFLOW_HISTORY_V1_TABLE_NAME = os.environ["WORKFLOW_HISTORY_V1_TABLE_NAME"]
 DATA_V1_TABLE_NAME = os.environ["DATA_V1_TABLE_NAME"]
 EVENTS_QUEUE_URL = os.environ["EVENTS_QUEUE_URL"]
 RUN_QUEUE_URL = os.environ["RUN_QUEUE_URL"]
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 1))
+INVOCATION_MAX_THREADS = int(os.getenv("INVOCATION_MAX_THREADS", 50))
+BRANCH_MAX_CONCURRENCY = int(os.getenv("BRANCH_MAX_CONCURRENCY", 10))
+RUNNER_MODE = os.getenv("RUNNER_MODE", "sync")
+ASYNC_RUN_CONCURRENCY = int(os.getenv("ASYNC_RUN_CONCURRENCY", 50))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 10))
+HTTP_HOST_CONCURRENCY = int(os.getenv("HTTP_HOST_CONCURRENCY", 10))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 1))
+HISTORY_STATE_MODE = os.getenv("HISTORY_STATE_MODE", "diff")
+HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("HISTORY_SNAPSHOT_INTERVAL", 10))
+WORKFLOW_PLAN_CACHE_SIZE = int(os.getenv("WORKFLOW_PLAN_CACHE_SIZE", 256))
+WAIT_IN_PLACE_MAX = int(os.getenv("WAIT_IN_PLACE_MAX", 30))
+CHECKPOINT_MARGIN = int(os.getenv("CHECKPOINT_MARGIN", 60))
+ACTION_TIMEOUT = int(os.getenv("ACTION_TIMEOUT", 3))
+ACTION_CONNECT_TIMEOUT = float(os.getenv("ACTION_CONNECT_TIMEOUT", 3.05))
+ACTION_DEADLINE_RESERVE = int(os.getenv("ACTION_DEADLINE_RESERVE", 5))
+
+# The longest delay of an SQS message. Runs suspended for longer are continued more than once.
+MAX_CONTINUATION_DELAY = 900
 
 logger = Logger()
 tracer = Tracer()
 
-processor = BatchProcessor(event_type=EventType.SQS)
-
+# Runs are processed on several threads and boto3 resources are not thread-safe. The tables
+# are only used for their names and their clients (``table.meta.client``), which are
+# thread-safe and serialize Python types like the resources do.
 main_table = get_boto3_resource("dynamodb").Table(MAIN_TABLE_NAME)
 workflow_history_v1_table = get_boto3_resource("dynamodb").Table(
     WORKFLOW_HISTORY_V1_TABLE_NAME
 )
 data_table = get_boto3_resource("dynamodb").Table(DATA_V1_TABLE_NAME)
 
-kms_client = get_boto3_client("kms")
+# Run history updates are buffered and written in batches. Runs flush the buffer when they end.
+history_writer = HistoryWriter(
+    workflow_history_v1_table, flush_interval=HISTORY_FLUSH_INTERVAL
+)
+
 sqs_client = get_boto3_client("sqs")
 
 
+def flush_history() -> None:
+    """Write the buffered run history. A write error is logged and not raised: it must not
+    replace the result of the run or fail the batch. Unwritten items stay buffered and are
+    written by the next flush (see ``HistoryWriter``).
+    """
+    try:
+        history_writer.flush()
+    except HistoryWriteError:
+        logger.exception("Failed to write run history")
+
+
+# Connector HTTP connections are pooled by host and shared by every runner in the process
+http_pool = HttpPoolManager(
+    pool_maxsize=HTTP_POOL_MAXSIZE, max_concurrency=HTTP_HOST_CONCURRENCY
+)
+
+
 class WorkflowError(Exception):
     def __init__(self, failed_action: dict, exception: Exception = None):
         self.failed_action = failed_action
@@ -71,6 +134,164 @@ class ConditionFailedStop(WorkflowError):
     pass
 
 
+class ActionFailedStop(WorkflowError):
+    pass
+
+
+class RunSuspended(Exception):
+    """Raised by an action to suspend the run before the action completes. The action is run
+    again when the run resumes (see ``WorkflowRunnerV1.suspend()``).
+    """
+
+
+class ThreadBudget:
+    """The number of worker threads the pools of an invocation may start. Records of a batch,
+    iterator items and branches run on pools that share the budget, so nested pools can't
+    multiply the threads of the invocation.
+
+    Taking threads never blocks: a pool gets the threads that are left and, with fewer than
+    two, runs its work in the calling thread. A nested pool never waits for an outer one.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._available = size
+        self._lock = Lock()
+
+    @property
+    def available(self) -> int:
+        return self._available
+
+    @contextmanager
+    def threads(self, count: int) -> Iterator[int]:
+        """Take up to ``count`` threads for a pool and give them back when it exits. Yields the
+        number of threads taken, either 0 or at least 2.
+        """
+        with self._lock:
+            taken = min(count, self._available)
+            if taken < 2:
+                taken = 0
+            self._available -= taken
+        try:
+            yield taken
+        finally:
+            with self._lock:
+                self._available += taken
+
+
+thread_budget = ThreadBudget(INVOCATION_MAX_THREADS)
+
+
+class ConcurrentBatchProcessor(BatchProcessor):
+    """Processes the records of a batch on a bounded thread pool.
+
+    Each record is handled in a copy of the submitting context so context variables (such as
+    ``flexli_globals.ITERATOR_VALUE``) are isolated per run. Failures are collected by the base
+    processor and reported with ``process_partial_response``. A ``max_workers`` of 1 processes
+    the batch sequentially. The pool's threads are taken from ``thread_budget``.
+    """
+
+    def __init__(self, event_type: EventType, max_workers: int = 1):
+        super().__init__(event_type=event_type)
+        self.max_workers = max_workers
+
+    def process(self) -> list[tuple]:
+        if self.max_workers < 2 or len(self.records) < 2:
+            return super().process()
+
+        with thread_budget.threads(min(self.max_workers, len(self.records))) as workers:
+            if not workers:
+                return super().process()
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(copy_context().run, self._process_record, record)
+                    for record in self.records
+                ]
+                return [f.result() for f in futures]
+
+
+processor = ConcurrentBatchProcessor(
+    event_type=EventType.SQS, max_workers=BATCH_CONCURRENCY
+)
+async_processor = AsyncBatchProcessor(event_type=EventType.SQS)
+# The blocking calls of async runs share this pool. The event loop's default pool is sized
+# by the CPU count, which is a handful of threads in Lambda.
+async_executor = ThreadPoolExecutor(max_workers=ASYNC_RUN_CONCURRENCY)
+
+
+def async_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop async batches run on in Lambda, with ``async_executor`` as its
+    default executor. ``async_process_partial_response`` runs the batch on the current event
+    loop, or on a new one when there is none.
+    """
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    loop.set_default_executor(async_executor)
+    return loop
+
+
+# The value of a key removed from the state, in ``state_changes()``
+REMOVED = object()
+
+
+def state_changes(old, new, path: tuple = ()) -> list[tuple[tuple, object]]:
+    """Return the ``(path, value)`` of every value in the ``new`` state that is changed from the
+    ``old`` state. Dicts are compared key by key; other values, lists included, are replaced
+    whole. The value of a removed key is ``REMOVED``.
+
+    The state is copy-on-write so a value that is the same object in both states is unchanged.
+    """
+    if old is new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = [(path + (key,), REMOVED) for key in old if key not in new]
+        for key, value in new.items():
+            if key in old:
+                changes.extend(state_changes(old[key], value, path + (key,)))
+            else:
+                changes.append((path + (key,), value))
+        return changes
+
+    if type(old) is type(new) and old == new:
+        return []
+    return [(path, new)]
+
+
+def apply_state_change(state, path: tuple, value, changed_state):
+    """Return a new state with the value at the ``path`` replaced (or removed). The ``state`` is
+    not modified: only the dicts on the path are copied.
+
+    ``changed_state`` is the state the change was taken from. Where the path no longer leads
+    through dicts of the ``state`` (another change replaced or removed a value on it), the
+    value of ``changed_state`` at that point of the path replaces it.
+    """
+    if not path:
+        return value
+    if not isinstance(state, dict):
+        return changed_state
+
+    state = dict(state)
+    key = path[0]
+    if len(path) == 1:
+        if value is REMOVED:
+            state.pop(key, None)
+        else:
+            state[key] = value
+    elif key in state:
+        state[key] = apply_state_change(state[key], path[1:], value, changed_state[key])
+    else:
+        state[key] = changed_state[key]
+    return state
+
+
 class FlexliCoreV1:
     def __init__(self, runner: WorkflowRunnerV1):
         self._runner = runner
@@ -106,7 +327,7 @@ class FlexliCoreV1:
         self, workflow_id: str, workflow_version: int, workflow_input: dict, **kwargs
     ):
         # TODO: This code is shared ith the Run API and needs to be in a module
-        workflow_data = read_workflow_version(
+        workflow_data = read_workflow_definition(
             tenant_id=self._runner.tenant_id,
             workflow_id=workflow_id,
             workflow_version=workflow_version,
@@ -115,14 +336,14 @@ class FlexliCoreV1:
         # Source-less workflows are allowed through the Run API
         if workflow_source := workflow_data.get("source"):
             if source_condition := workflow_source.get("condition"):
-                if not ConditionEvaluator(source_condition).evaluate(workflow_input):
+                if not compile_condition(source_condition).evaluate(workflow_input):
                     raise CoreActionFailure("Nested workflow condition failed.")
 
         new_run_id = str(ULID())
 
         sqs_client.send_message(
             QueueUrl=RUN_QUEUE_URL,
-            MessageBody=json.dumps(
+            MessageBody=run_message_body(
                 {
                     "tenant_id": self._runner.tenant_id,
                     "workflow_id": workflow_id,
@@ -130,13 +351,12 @@ class FlexliCoreV1:
                     "parent_run_id": self._runner.run_id,
                     "run_id": new_run_id,
                     "source_input": workflow_input,
-                    "actions": workflow_data["actions"],
-                },
-                # cls=DecimalEncoder,
+                }
             ),
         )
 
-        main_table.put_item(
+        main_table.meta.client.put_item(
+            TableName=main_table.name,
             Item={
                 "pk": f"T#{self._runner.tenant_id}#WH#{self._runner.workflow_id}",
                 "sk": f"RH#{new_run_id}",
@@ -150,35 +370,317 @@ class FlexliCoreV1:
                 "workflow_name": workflow_data["name"],
                 "status": "queued",
                 "start_time": datetime.utcnow().isoformat(),
-            }
+            },
+        )
+
+    def _run_iterator_item(self, item, workflow: CompiledWorkflow):
+        logger.debug({"message": "***** ITERATOR ITEM *****", "item": item})
+
+        iterator_runner = WorkflowRunnerV1(
+            tenant_id=self._runner.tenant_id,
+            workflow_id=self._runner.workflow_id,
+            workflow_version=self._runner.workflow_version,
+            run_id=str(ULID()),
+            source_input=item,
+            actions=workflow,
+            # History for every item is written to the root run
+            parent_run_id=self._runner.parent_run_id or self._runner.run_id,
+            # Item requests time out before the invocation does
+            deadline=self._runner.deadline,
         )
 
+        # The item is available to flexli_iterator_value() for the nested run only
+        token = flexli_globals.ITERATOR_VALUE.set(item)
+        try:
+            iterator_runner.run()
+        finally:
+            flexli_globals.ITERATOR_VALUE.reset(token)
+
+    def _fan_out_iterator(
+        self,
+        array: list,
+        actions: list[dict],
+        max_concurrency: int,
+        chunk_size: int,
+    ):
+        """Send the array to the run queue in chunks. Each chunk is run as a nested iterator."""
+        for start in range(0, len(array), chunk_size):
+            sqs_client.send_message(
+                QueueUrl=RUN_QUEUE_URL,
+                MessageBody=run_message_body(
+                    {
+                        "tenant_id": self._runner.tenant_id,
+                        "workflow_id": self._runner.workflow_id,
+                        "workflow_version": self._runner.workflow_version,
+                        "parent_run_id": self._runner.parent_run_id
+                        or self._runner.run_id,
+                        "run_id": str(ULID()),
+                        "source_input": {"items": array[start : start + chunk_size]},
+                        # Items are retried with the workflow's options, as they are in place
+                        "on_error": self._runner.workflow.retry_policy.to_on_error(),
+                        # The chunk runs a generated iterator, not the workflow version
+                        "actions": [
+                            {
+                                "type": "Flexli:CoreV1:Iterator",
+                                "order": 1,
+                                "parameters": {
+                                    "array_path": "::items",
+                                    "actions": actions,
+                                    "max_concurrency": max_concurrency,
+                                },
+                            }
+                        ],
+                    }
+                ),
+            )
+
     def iterator(
         self,
         array_path: list,
         actions: list[dict],
         iterator_input: Optional[dict] = None,
+        max_concurrency: int = 1,
+        fan_out_chunk_size: Optional[int] = None,
+        **kwargs,
     ):
         if not isinstance(array_path, list):
             raise CoreActionFailure("The value for 'array_path' is not an array.")
 
         logger.debug({"message": "***** ITERATOR ARRAY *****", "item": array_path})
 
-        for i in array_path:
-            # TODO: Store iterator value in secure location for retrival by flexli_iterator_value()
-            # TODO: Use `iterator_input` with an applied transform is provided
-            logger.debug({"message": "***** ITERATOR ITEM *****", "item": i})
-
-            iterator_runner = WorkflowRunnerV1(
-                tenant_id=self._runner.tenant_id,
-                workflow_id=self._runner.workflow_id,
-                workflow_version=self._runner.workflow_version,
-                run_id=str(ULID()),
-                source_input=i,
-                actions=copy.deepcopy(actions),
-                parent_run_id=self._runner.run_id,
+        # TODO: Use `iterator_input` with an applied transform is provided
+        max_concurrency = min(int(max_concurrency), len(array_path))
+
+        if fan_out_chunk_size and len(array_path) > int(fan_out_chunk_size):
+            self._fan_out_iterator(
+                array=array_path,
+                actions=actions,
+                max_concurrency=max(max_concurrency, 1),
+                chunk_size=int(fan_out_chunk_size),
             )
-            iterator_runner.run()
+            return
+
+        # The items' actions are compiled once and shared by every item's run
+        workflow = CompiledWorkflow(
+            actions,
+            core_actions_class=type(self),
+            retry_policy=self._runner.workflow.retry_policy,
+        )
+        indexes = self._remaining_items(array_path)
+        skipped = []
+
+        def run_item(index: int):
+            if self._runner.resumable and self._runner.deadline_reached():
+                skipped.append(index)
+            else:
+                self._run_iterator_item(array_path[index], workflow)
+
+        # Items run in the calling thread when the invocation has no threads left
+        with thread_budget.threads(max_concurrency) as workers:
+            if not workers:
+                for i in indexes:
+                    run_item(i)
+            else:
+                # Each item runs in its own context; an unhandled error cancels the pending
+                # items
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(copy_context().run, run_item, i)
+                        for i in indexes
+                    ]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except Exception:
+                        for future in futures:
+                            future.cancel()
+                        raise
+
+        self._suspend_iterator(skipped)
+
+    def _remaining_items(self, array: list) -> list[int]:
+        """Return the indexes of the items to run. An iterator resumed after the run was
+        suspended runs the items that were not run before.
+        """
+        if progress := self._runner.action_progress:
+            return [int(i) for i in progress["remaining_items"]]
+        return list(range(len(array)))
+
+    def _suspend_iterator(self, skipped: list[int]) -> None:
+        """Suspend the run if items were skipped at the run's deadline. The skipped items are
+        run when the run resumes.
+        """
+        if skipped:
+            self._runner.suspend(
+                resume_at=time.time(),
+                reason="deadline",
+                progress={"remaining_items": sorted(skipped)},
+            )
+            raise RunSuspended()
+
+    def _select_branches(self, branches: list[dict], exclusive: bool) -> list[dict]:
+        """Return the branches whose condition is met by the current state, by ``order``. Only
+        the first is returned for an exclusive branch action.
+        """
+        selected = []
+        for branch in sorted(branches, key=lambda i: i["order"]):
+            if (condition := branch.get("condition")) and not compile_condition(
+                condition
+            ).evaluate(self._runner.state):
+                continue
+            selected.append(branch)
+            if exclusive:
+                break
+
+        logger.debug(
+            {
+                "message": "***** BRANCHES *****",
+                "orders": [i["order"] for i in selected],
+            }
+        )
+        return selected
+
+    def _branch_runner(
+        self,
+        branch: dict,
+        run_id: Optional[str] = None,
+        checkpoint: Optional[dict] = None,
+    ) -> WorkflowRunnerV1:
+        """Return a nested run of the branch's actions. The branch starts from the current
+        state; the state is copy-on-write so branches never see each other's changes. A branch
+        suspended with the run resumes from its ``checkpoint``.
+        """
+        branch_runner = type(self._runner)(
+            tenant_id=self._runner.tenant_id,
+            workflow_id=self._runner.workflow_id,
+            workflow_version=self._runner.workflow_version,
+            run_id=run_id or str(ULID()),
+            source_input={},
+            actions=CompiledWorkflow(
+                branch["actions"],
+                core_actions_class=type(self),
+                retry_policy=self._runner.workflow.retry_policy,
+            ),
+            # History for every branch is written to the root run
+            parent_run_id=self._runner.parent_run_id or self._runner.run_id,
+            checkpoint=checkpoint,
+            # Branches of a resumable run are suspended with it
+            resumable=self._runner.resumable,
+            nested=True,
+            deadline=self._runner.deadline,
+        )
+        if checkpoint is None:
+            # The state is not a source input: a ``transform`` key in it is not applied again
+            branch_runner.state = self._runner.state
+        return branch_runner
+
+    def _branch_runners(
+        self, branches: list[dict], exclusive: bool
+    ) -> list[tuple[int, Union[WorkflowRunnerV1, dict]]]:
+        """Return the ``order`` and nested run of the selected branches. A branch action
+        resumed after the run was suspended runs the branches that were suspended; the
+        branches that had completed are returned with their progress instead of a run.
+        """
+        if progress := self._runner.action_progress:
+            branches_by_order = {int(i["order"]): i for i in branches}
+            return [
+                (
+                    int(i["order"]),
+                    (
+                        self._branch_runner(
+                            branches_by_order[int(i["order"])],
+                            run_id=i["run_id"],
+                            checkpoint=i["checkpoint"],
+                        )
+                        if "checkpoint" in i
+                        else i
+                    ),
+                )
+                for i in progress["branches"]
+            ]
+
+        return [
+            (i["order"], self._branch_runner(i))
+            for i in self._select_branches(branches, exclusive)
+        ]
+
+    @staticmethod
+    def _branch_progress(
+        order: int, branch_runner: Union[WorkflowRunnerV1, dict]
+    ) -> dict:
+        """Return the progress of a branch: its checkpoint if it was suspended, or its status
+        and state if it completed.
+        """
+        if isinstance(branch_runner, dict):
+            return branch_runner
+
+        progress = {"order": order, "run_id": branch_runner.run_id}
+        if branch_runner.suspended:
+            progress["checkpoint"] = branch_runner.continuation_checkpoint()
+        else:
+            progress.update(status=branch_runner.status, state=branch_runner.state)
+        return progress
+
+    def _end_branches(
+        self, branch_runners: list[tuple[int, Union[WorkflowRunnerV1, dict]]]
+    ) -> dict:
+        """Merge the branches, or suspend the run when a branch was suspended. The run resumes
+        when the first suspended branch does and runs the branch action again with the
+        suspended branches; a branch resumed early is suspended again.
+        """
+        progress = [self._branch_progress(*i) for i in branch_runners]
+        if resume_at := [
+            float(i["checkpoint"]["resume_at"]) for i in progress if "checkpoint" in i
+        ]:
+            self._runner.suspend(
+                resume_at=min(resume_at),
+                reason="branch",
+                progress={"branches": progress},
+            )
+            raise RunSuspended()
+
+        return self._merge_branches(progress)
+
+    def _merge_branches(self, branches: list[dict]) -> dict:
+        """Apply the changes the completed branches made to the state, in branch order. Changed
+        values are replaced whole (see ``state_changes()``), so when branches changed the same
+        value, or a value and a value in it, the change of the last branch is kept. The changes
+        of a failed or stopped branch are discarded.
+        """
+        base = state = self._runner.state
+        for branch in branches:
+            if branch["status"] == "successful":
+                for path, value in state_changes(base, branch["state"]):
+                    state = apply_state_change(state, path, value, branch["state"])
+
+        self._runner.state = state
+        return state
+
+    def branch(self, branches: list[dict], exclusive: bool = True, **kwargs):
+        """Run the selected branches as nested runs, concurrently for a non-exclusive branch
+        action, on at most ``BRANCH_MAX_CONCURRENCY`` threads from ``thread_budget``.
+
+        Branches of a resumable run are suspended with it: a long wait or backoff in a branch
+        suspends the branch, and the run is suspended with every branch's progress when the
+        other branches complete. Branches of a run that is not resumable, such as an iterator
+        item, wait in place.
+        """
+        branch_runners = self._branch_runners(branches, exclusive)
+        runs = [i.run for _, i in branch_runners if isinstance(i, WorkflowRunnerV1)]
+
+        with thread_budget.threads(min(len(runs), BRANCH_MAX_CONCURRENCY)) as workers:
+            if not workers:
+                for run in runs:
+                    run()
+            else:
+                # Each branch runs in its own context
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(copy_context().run, i) for i in runs]
+                    for future in futures:
+                        future.result()
+
+        # The merged state is the response, for the action's transform
+        return self._end_branches(branch_runners)
 
     def data(self, operation: str, scope: str, key: str, value, **kwargs):
         """Action data:
@@ -200,14 +702,173 @@ class FlexliCoreV1:
         """
         return {}
 
-    @staticmethod
-    def wait(seconds: Union[int, str], **kwargs):
-        # TODO: Conditional based on the amount of time. < X use `sleep`, > X perform a callback
-        time.sleep(int(seconds))
+    def wait(self, seconds: Union[int, str], **kwargs):
+        # Long waits suspend the run instead of holding the invocation (see
+        # ``WorkflowRunnerV1.suspend()``)
+        seconds = int(seconds)
+        if seconds <= WAIT_IN_PLACE_MAX or not self._runner.suspend(
+            resume_at=time.time() + seconds, reason="wait"
+        ):
+            time.sleep(seconds)
         return {}
 
 
+# The parameters of core actions that hold nested actions. They are processed by the nested
+# runs, not from the state.
+NESTED_ACTIONS_PATHS = {
+    "Flexli:CoreV1:Iterator": ["actions"],
+    "Flexli:CoreV1:Branch": ["branches"],
+}
+
+
+class CompiledAction:
+    """An action of a ``CompiledWorkflow``. The core action method is resolved when the action
+    is compiled. The condition and the parameters and transform plans are compiled on first use
+    (a definition error fails the run at the action) and are then shared by every run.
+    """
+
+    def __init__(
+        self,
+        action: dict,
+        core_actions_class: type,
+        workflow_retry_policy: RetryPolicy = RetryPolicy(),
+    ):
+        self.action = action
+        self.type: str = action["type"]
+        self.connector_id: Optional[str] = action.get("connector_id")
+        # The connector version the action was validated against when the workflow was created
+        self.connector_version: Optional[int] = (
+            int(action["connector_version"])
+            if action.get("connector_version")
+            else None
+        )
+
+        self.core_action_name: Optional[str] = None
+        self._core_action = None
+        if self.type.startswith("Flexli:CoreV1:"):
+            self.core_action_name = self.type.split(":")[-1].lower()
+            # The descriptor: static methods and methods are both bound with ``__get__()``
+            self._core_action = inspect.getattr_static(
+                core_actions_class, self.core_action_name, None
+            )
+
+        self._workflow_retry_policy = workflow_retry_policy
+
+        # The connector index this action's template was last matched for, and the template's
+        # plan
+        self._connector_template: Optional[tuple[ConnectorIndex, TransformPlan]] = None
+
+    @cached_property
+    def condition(self) -> Optional[ConditionEvaluator]:
+        if condition := self.action.get("condition"):
+            return compile_condition(condition)
+        return None
+
+    @property
+    def on_fail(self) -> Optional[str]:
+        return (self.action.get("condition") or {}).get("on_fail")
+
+    @cached_property
+    def parameters(self) -> TransformPlan:
+        # Prevent expression and string formatting on certain key-paths for core actions
+        return compile_transform(
+            updates=self.action.get("parameters"),
+            variables=self.action.get("variables"),
+            ignored_paths=NESTED_ACTIONS_PATHS.get(self.type),
+        )
+
+    @property
+    def timeout(self) -> float:
+        return float(self.action.get("timeout") or ACTION_TIMEOUT)
+
+    @cached_property
+    def retry_policy(self) -> RetryPolicy:
+        # Actions without ``on_error`` options use the workflow's
+        if on_error := self.action.get("on_error"):
+            return RetryPolicy.from_on_error(on_error)
+        return self._workflow_retry_policy
+
+    @cached_property
+    def transform(self) -> Optional[TransformPlan]:
+        if transform := self.action.get("transform"):
+            return compile_transform(updates=transform)
+        return None
+
+    def core_action(self, core_actions: FlexliCoreV1) -> Callable:
+        if self._core_action is None:
+            return getattr(core_actions, self.core_action_name)
+        return self._core_action.__get__(core_actions)
+
+    def connector_template(self, connector: ConnectorIndex) -> TransformPlan:
+        """Return the plan of the connector action matching this action's type. The match is
+        kept until a different (refreshed) connector is passed.
+        """
+        if (matched := self._connector_template) and matched[0] is connector:
+            return matched[1]
+
+        if (connector_action := connector.actions.get(self.type)) is None:
+            raise Exception("How did we not find a matching action??")
+        plan = compile_transform(updates=connector_action)
+
+        self._connector_template = (connector, plan)
+        return plan
+
+
+class CompiledWorkflow:
+    """A workflow's actions compiled once and shared by every run. Actions are ordered by
+    ``order``; runs step through them with their own cursor and never modify them.
+    """
+
+    def __init__(
+        self,
+        actions: list[dict],
+        core_actions_class: type = FlexliCoreV1,
+        retry_policy: RetryPolicy = RetryPolicy(),
+    ):
+        self.core_actions_class = core_actions_class
+        self.retry_policy = retry_policy
+        self.actions: tuple[CompiledAction, ...] = tuple(
+            CompiledAction(i, core_actions_class, workflow_retry_policy=retry_policy)
+            for i in sorted(actions, key=lambda i: i["order"])
+        )
+
+
+# Compiled workflows keyed by ``(tenant_id, workflow_id, version, core_actions_class)``. Versions
+# are never modified so entries do not expire.
+workflow_plan_cache = LRUCache(maxsize=WORKFLOW_PLAN_CACHE_SIZE)
+
+
+def workflow_retry_policy(on_error: Optional[dict]) -> RetryPolicy:
+    """Return the retry policy of a workflow's ``on_error`` options, which have longer backoff
+    defaults than an action's.
+    """
+    return RetryPolicy.from_on_error(on_error, wait=30, rate=2.5)
+
+
+def compile_workflow(
+    tenant_id: str,
+    workflow_id: str,
+    workflow_version: int,
+    actions: list[dict],
+    core_actions_class: type = FlexliCoreV1,
+    on_error: Optional[dict] = None,
+) -> CompiledWorkflow:
+    """Return the cached ``CompiledWorkflow`` of a workflow version's actions. The workflow's
+    ``on_error`` options are the retry policy of actions without their own.
+    """
+    return workflow_plan_cache.get_or_set(
+        (tenant_id, workflow_id, int(workflow_version), core_actions_class),
+        lambda: CompiledWorkflow(
+            actions,
+            core_actions_class=core_actions_class,
+            retry_policy=workflow_retry_policy(on_error),
+        ),
+    )
+
+
 class WorkflowRunnerV1:
+    core_actions_class = FlexliCoreV1
+
     def __init__(
         self,
         tenant_id: str,
@@ -215,8 +876,13 @@ class WorkflowRunnerV1:
         workflow_version: int,
         run_id: str,
         source_input: dict,
-        actions: list[dict],
+        actions: Union[list[dict], CompiledWorkflow],
         parent_run_id: Optional[str] = None,
+        checkpoint: Optional[dict] = None,
+        resumable: bool = False,
+        deadline: Optional[float] = None,
+        on_error: Optional[dict] = None,
+        nested: bool = False,
     ):
         self.tenant_id = tenant_id
         self.workflow_id = workflow_id
@@ -229,27 +895,175 @@ class WorkflowRunnerV1:
         # self.run_name = f"{tenant_id}-{workflow_id}:{workflow_version}-{run_id}"
 
         self.run_history_ttl = int((datetime.utcnow() + timedelta(days=7)).timestamp())
+        # The status of the run's last history update
+        self.status: Optional[str] = None
+        self._history_seq = 0
+        # The ``seq`` and state of the last history update that included the state
+        self._history_state: Optional[tuple[int, dict]] = None
+        self._history_diffs = 0
+
+        self.core_actions = self.core_actions_class(runner=self)
+
+        # The state is copy-on-write: transforms return a new state that shares every unchanged
+        # value with the previous one. Nothing may modify the state (or values in it) in place.
+        if checkpoint:
+            self.state = checkpoint["state"]
+        else:
+            try:
+                updates: dict = source_input["transform"]
+            except KeyError:
+                self.state = source_input
+            else:
+                self.state = compile_transform(updates=updates).apply(
+                    source=source_input
+                )
 
-        self.core_actions = FlexliCoreV1(runner=self)
-
-        try:
-            updates: dict = source_input["transform"]
-        except KeyError:
-            self.state = source_input
+        # Actions and the workflow's ``on_error`` options sent with the run message are sent
+        # again with its continuations
+        self._message_on_error = on_error
+        if isinstance(actions, CompiledWorkflow):
+            self.workflow = actions
+            self._message_actions = None
         else:
-            self.state = transform(source=source_input, updates=updates)
+            self.workflow = CompiledWorkflow(
+                actions,
+                core_actions_class=self.core_actions_class,
+                retry_policy=workflow_retry_policy(on_error),
+            )
+            self._message_actions = actions
+        self._cursor = 0
+
+        # Runs started from a run message can be suspended and resumed by a continuation
+        # message. Nested runs of an iterator are run in place by their parent.
+        self.resumable = resumable
+        # Nested runs of a branch are suspended with their parent run: the parent checkpoints
+        # them and sends the continuation message (see ``FlexliCoreV1.branch()``)
+        self.nested = nested
+        # ``(resume_at, reason, progress)`` of a requested suspension
+        self._suspension: Optional[tuple[float, str, Optional[dict]]] = None
+        # The ``time.monotonic()`` time the invocation times out (see ``run_deadline()``).
+        # Resumable runs are suspended ``CHECKPOINT_MARGIN`` seconds before, and requests are
+        # timed out before it.
+        self.deadline = deadline
+        # The progress of the current action saved when the run was suspended during the action
+        self.action_progress: Optional[dict] = None
+        self._checkpoint_progress: Optional[dict] = None
+
+        if checkpoint:
+            # A continuation resumes the run with the action it was suspended at
+            self._cursor = int(checkpoint["cursor"])
+            self._history_seq = int(checkpoint["history_seq"])
+            self._checkpoint_progress = checkpoint.get("progress")
+            resume_at = float(checkpoint.get("resume_at") or 0)
+            if resume_at - time.time() >= 1:
+                # Suspended for longer than one message can be delayed
+                self._suspension = (
+                    resume_at,
+                    checkpoint.get("reason"),
+                    self._checkpoint_progress,
+                )
 
-        self.actions = sorted(actions, key=lambda i: i["order"])
+        # All workflow objects share the process-wide connection pools
+        self._session = http_pool
 
-        # Each workflow object gets its own session
-        self._session = requests.Session()
+    def get_next_action(self) -> CompiledAction:
+        """Return the next action and advance the run's cursor. Catch "IndexError" to signal
+        the actions have been depleted.
+        """
+        action = self.workflow.actions[self._cursor]
+        self._cursor += 1
+        # Only the action the run was suspended at is resumed with its progress
+        self.action_progress, self._checkpoint_progress = (
+            self._checkpoint_progress,
+            None,
+        )
+        return action
+
+    def deadline_reached(self, after: float = 0) -> bool:
+        """Return whether the run must be checkpointed now, or ``after`` seconds from now."""
+        return (
+            self.deadline is not None
+            and time.monotonic() + after >= self.deadline - CHECKPOINT_MARGIN
+        )
+
+    def suspend(
+        self, resume_at: float, reason: str, progress: Optional[dict] = None
+    ) -> bool:
+        """Suspend the run when the current action completes. The run is checkpointed and a
+        continuation message delayed until ``resume_at`` (a UNIX timestamp) resumes it with the
+        next action. Returns ``False`` if the run is not resumable.
+
+        An action can also suspend the run before it completes by passing its ``progress`` and
+        raising ``RunSuspended``. The action is run again when the run resumes and reads its
+        progress from ``action_progress``.
+        """
+        if not self.resumable:
+            return False
+        self._suspension = (resume_at, reason, progress)
+        if progress is not None:
+            # The action is run again
+            self._cursor -= 1
+        return True
+
+    @property
+    def suspended(self) -> bool:
+        return self._suspension is not None
+
+    def continuation_checkpoint(self) -> dict:
+        """Return the checkpoint a suspended run is resumed from."""
+        resume_at, reason, _ = self._suspension
+        return dict(self.checkpoint(), resume_at=resume_at, reason=reason)
+
+    def checkpoint(self) -> dict:
+        checkpoint = {
+            "cursor": self._cursor,
+            "state": self.state,
+            "history_seq": self._history_seq,
+        }
+        if self._suspension and (progress := self._suspension[2]) is not None:
+            checkpoint["progress"] = progress
+        return checkpoint
 
-    def get_next_action(self) -> dict:
-        """Extract the next action from the internal actions list. This mutates the list.
-        Catch "IndexError" to signal the actions have been depleted.
+    def _suspend_run(self) -> None:
+        """Write the history update of a suspended run and send its continuation message. A
+        nested run is continued by its parent.
         """
-        # TODO: Stop mutating the actions. Track the current `order` in class, get next, return action ref.
-        return self.actions.pop(0)
+        resume_at, reason, _ = self._suspension
+        self.log_workflow_history_update(
+            status="waiting",
+            reason={
+                "message": "The run is suspended",
+                "reason": reason,
+                "resume_at": datetime.utcfromtimestamp(resume_at).isoformat(
+                    timespec="seconds"
+                )
+                + "Z",
+            },
+            include_state=False,
+        )
+        if self.nested:
+            return
+
+        message = {
+            "tenant_id": self.tenant_id,
+            "workflow_id": self.workflow_id,
+            "workflow_version": self.workflow_version,
+            "run_id": self.run_id,
+            "parent_run_id": self.parent_run_id,
+            "checkpoint": self.continuation_checkpoint(),
+        }
+        if self._message_actions is not None:
+            message["actions"] = self._message_actions
+            if self._message_on_error is not None:
+                message["on_error"] = self._message_on_error
+
+        sqs_client.send_message(
+            QueueUrl=RUN_QUEUE_URL,
+            MessageBody=run_message_body(message),
+            DelaySeconds=min(
+                max(math.ceil(resume_at - time.time()), 0), MAX_CONTINUATION_DELAY
+            ),
+        )
 
     def log_workflow_history_update(
         self,
@@ -259,11 +1073,15 @@ class WorkflowRunnerV1:
         include_state: bool = True,
     ):
         timestamp = datetime.utcnow().isoformat(timespec="milliseconds")
+        self._history_seq += 1
+        self.status = status
 
         item = {
             "pk": f"T#{self.tenant_id}#RH#{self.parent_run_id if self.parent_run_id else self.run_id}",
-            "sk": f"TS#{timestamp}",
+            # Updates from the run and its nested runs must not replace each other
+            "sk": f"TS#{timestamp}#{self.run_id}#{self._history_seq:05}",
             "_item_type": "WorkflowRunHistoryUpdate",
+            "seq": self._history_seq,
             "status": status,
             "reason": reason,
             "time": timestamp + "Z",
@@ -281,72 +1099,57 @@ class WorkflowRunnerV1:
             }
 
         if include_state:
-            item["state"] = self.state
+            self._add_history_state(item)
 
-        workflow_history_v1_table.put_item(Item=item)
+        history_writer.put(item)
 
-    @staticmethod
-    def _action_auth_headers(credentials: dict) -> dict:
-        # TODO: Should be a function that returns a type
-        decrypted_credentials = kms_client.decrypt(
-            CiphertextBlob=credentials["CiphertextBlob"].value,
-            KeyId=credentials["KeyId"],
-        )
-
-        connector_credentials = json.loads(decrypted_credentials["Plaintext"])
+    def _add_history_state(self, item: dict) -> None:
+        """Add the state to a history update. In ``diff`` mode only the changes since the
+        previous update with the state are added, with a full snapshot at the first update and
+        every ``HISTORY_SNAPSHOT_INTERVAL`` updates. See ``rebuild_history_states()``.
 
-        match connector_credentials["type"]:
-            case "ApiKey":
-                auth_header = {
-                    connector_credentials["api_key_header"]: connector_credentials[
-                        "api_key"
-                    ]
-                }
-            case "BearerToken":
-                auth_header = {
-                    "Authorization": f"Bearer {connector_credentials['bearer_token']}"
-                }
-            case "OAuth2Client":
-                # TODO: Not implemented
-                # Cached request to obtain token and return
-                auth_header = {"Authorization": "Bearer Token"}
-            case _:
-                raise Exception("Unsupported Auth Type")
+        The state is replaced, never modified, so buffered items can reference it.
+        """
+        if (
+            HISTORY_STATE_MODE == "diff"
+            and self._history_state
+            and self._history_diffs < HISTORY_SNAPSHOT_INTERVAL - 1
+        ):
+            base_seq, base_state = self._history_state
+            item["state_base"] = base_seq
+            item["state_diff"] = diff_state(base_state, self.state)
+            self._history_diffs += 1
+        else:
+            item["state"] = self.state
+            self._history_diffs = 0
 
-        return auth_header
+        self._history_state = (item["seq"], self.state)
 
-    def _run_action(self, action: dict, connector: dict) -> dict:
+    def _run_action(
+        self,
+        action: dict,
+        connector: ConnectorIndex,
+        timeout: Optional[tuple[float, float]] = None,
+        max_time: Optional[float] = None,
+    ) -> dict:
         request_args = {
             "method": action["method"],
-            "url": posixpath.join(
-                urlunparse(
-                    (
-                        "https",
-                        connector["config"]["host"],
-                        connector["config"].get("base_path"),
-                        None,
-                        None,
-                        None,
-                    )
-                ),
-                action["path"].strip("/"),
-            ),
+            "url": posixpath.join(connector.base_url, action["path"].strip("/")),
             "params": action.get("query"),
-            "headers": {},
+            "headers": dict(connector.default_headers),
+            "timeout": timeout,
+            # Waiting for a free connection to the host counts against the time left
+            "max_time": max_time,
         }
 
         # Headers setup
-        if (default_headers := connector["config"].get("default_headers")) is not None:
-            request_args["headers"].update(default_headers)
-
         if (action_headers := action.get("headers")) is not None:
             request_args["headers"].update(action_headers)
 
         # Apply auth headers if credentials
-        if action_credentials := connector.get("credentials"):
-            request_args["headers"].update(
-                self._action_auth_headers(action_credentials)
-            )
+        if action_credentials := connector.credentials:
+            action_auth_headers = auth_headers(action_credentials)
+            request_args["headers"].update(action_auth_headers)
 
         # Handle body content based on MIME type (needs a lot of work)
         if (body := action.get("body")) is not None:
@@ -361,6 +1164,15 @@ class WorkflowRunnerV1:
 
         response = self._session.request(**request_args)
 
+        # A rejected OAuth2 token is refreshed and the request retried once
+        if response.status_code == 401 and action_credentials:
+            if refreshed_headers := refresh_auth_headers(
+                action_credentials, stale_headers=action_auth_headers
+            ):
+                logger.info("Retrying action with refreshed auth headers")
+                request_args["headers"].update(refreshed_headers)
+                response = self._session.request(**request_args)
+
         logger.debug(
             {
                 "status_code": response.status_code,
@@ -377,8 +1189,217 @@ class WorkflowRunnerV1:
         except requests.exceptions.JSONDecodeError:
             return {}
 
+    def _run_connector_action(
+        self,
+        action: CompiledAction,
+        action_connector: ConnectorIndex,
+        prepared_action: dict,
+    ) -> Optional[dict]:
+        """Run a connector action and retry failed requests with the action's ``on_error``
+        options. Returns ``None`` if the action failed and is skipped.
+        """
+        budget = retry_budget(self.tenant_id, action_connector.id)
+        attempt = self._first_retry_attempt(budget)
+        while True:
+            try:
+                return self._run_action(
+                    action=prepared_action,
+                    connector=action_connector,
+                    timeout=self._request_timeout(action),
+                    max_time=self._request_time_left(),
+                )
+            except Exception as error:
+                if (delay := self._retry_delay(action, error, attempt, budget)) is None:
+                    return self._action_failed(action, error)
+
+            attempt += 1
+            if self._suspend_retry(delay, attempt):
+                raise RunSuspended()
+            time.sleep(delay)
+
+    def _request_timeout(self, action: CompiledAction) -> tuple[float, float]:
+        """Return the connect and read timeouts of a connector action's request. The action's
+        ``timeout`` is shortened so the request ends ``ACTION_DEADLINE_RESERVE`` seconds before
+        the invocation times out.
+        """
+        timeout = action.timeout
+        if (remaining := self._request_time_left()) is not None:
+            timeout = min(timeout, remaining)
+        return min(ACTION_CONNECT_TIMEOUT, timeout), timeout
+
+    def _request_time_left(self) -> Optional[float]:
+        """Return the seconds until a request must end, ``ACTION_DEADLINE_RESERVE`` seconds
+        before the invocation times out, or ``None`` if the run has no deadline.
+        """
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - ACTION_DEADLINE_RESERVE - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout(
+                "The invocation timed out before the request could be sent"
+            )
+        return remaining
+
+    def _first_retry_attempt(self, budget: RetryBudget) -> int:
+        # An action resumed after the run was suspended during a backoff continues its retries
+        if progress := self.action_progress:
+            return int(progress.get("retry_attempt", 0))
+        budget.deposit()
+        return 0
+
+    def _retry_delay(
+        self,
+        action: CompiledAction,
+        error: Exception,
+        attempt: int,
+        budget: RetryBudget,
+    ) -> Optional[float]:
+        """Return the seconds to wait before the next attempt of a failed connector action, or
+        ``None`` if the action is not retried. A ``Retry-After`` delay is waited at least.
+        """
+        policy = action.retry_policy
+        if not policy.retries(error, attempt):
+            return None
+
+        delay = policy.backoff(attempt)
+        if (server_delay := retry_after(error)) is not None:
+            if server_delay > RETRY_MAX_DELAY:
+                return None
+            delay = max(delay, server_delay)
+
+        # Runs that can't be suspended (iterator items and branches) never wait past the
+        # deadline: the action fails, or is skipped
+        if not self.resumable and self.deadline_reached(after=delay):
+            return None
+
+        # Retries beyond the connector's budget fail the action
+        if not budget.withdraw():
+            logger.warning(
+                {
+                    "message": "The connector's retry budget is exhausted",
+                    "connector_id": action.connector_id,
+                }
+            )
+            return None
+
+        self.log_workflow_history_update(
+            action=action.action,
+            reason={
+                "message": "Retrying the action",
+                "attempt": attempt + 1,
+                "delay_ms": int(delay * 1000),
+                "error": str(error),
+                "error_type": error_type(error),
+            },
+            include_state=False,
+        )
+        return delay
+
+    def _suspend_retry(self, delay: float, attempt: int) -> bool:
+        """Suspend the run for a backoff longer than a wait in place, or one that would end
+        after the run's deadline. The action is retried when the run resumes.
+        """
+        if delay <= WAIT_IN_PLACE_MAX and not self.deadline_reached(after=delay):
+            return False
+        return self.suspend(
+            resume_at=time.time() + delay,
+            reason="retry",
+            progress={"retry_attempt": attempt},
+        )
+
+    def _action_failed(self, action: CompiledAction, error: Exception) -> None:
+        """Handle a connector action that failed with the ``on_fail`` option of its
+        ``on_error`` options.
+        """
+        if (on_fail := action.retry_policy.on_fail) == "skip":
+            logger.warning(error, exc_info=error)
+            self.log_workflow_history_update(
+                action=action.action,
+                reason={
+                    "message": "The action failed and was skipped",
+                    "error": str(error),
+                    "error_type": error_type(error),
+                },
+                include_state=False,
+            )
+            return None
+        elif on_fail == "stop":
+            raise ActionFailedStop(failed_action=action.action, exception=error)
+        raise WorkflowFailed(failed_action=action.action, exception=error)
+
+    def _prepare_action(self, action: CompiledAction) -> Optional[dict]:
+        """Evaluate the action's condition and return its parameters processed from the state.
+        Returns ``None`` if the action is skipped.
+        """
+        if action.condition is not None:
+            if not action.condition.evaluate(self.state):
+                if (on_fail := action.on_fail) == "fail":
+                    raise ConditionFailedFail(
+                        failed_action=action.action, exception=None
+                    )
+                elif on_fail == "stop":
+                    raise ConditionFailedStop(
+                        failed_action=action.action, exception=None
+                    )
+                elif on_fail == "skip":
+                    # Skip the remainder of this action and proceed to the next
+                    return None
+
+        # Parameters are processed from the workflow state
+        prepared_action_params = action.parameters.apply(source=self.state)
+        logger.debug(
+            {"object": "prepared_action_params", "contents": prepared_action_params}
+        )
+        return prepared_action_params
+
+    @staticmethod
+    def _prepare_connector_action(
+        action: CompiledAction,
+        action_connector: ConnectorIndex,
+        prepared_action_params: dict,
+    ) -> dict:
+        logger.debug(
+            {
+                "object": "action_connector",
+                "id": action_connector.id,
+                "version": action_connector.version,
+            }
+        )
+
+        # The prepared action is processed from the prepared param
+        # (also used for variable subs)
+        prepared_action = action.connector_template(action_connector).apply(
+            source=prepared_action_params,
+            format_vars=prepared_action_params,
+        )
+        logger.debug({"object": "prepared_action", "contents": prepared_action})
+        return prepared_action
+
+    def _apply_action_response(
+        self, action: CompiledAction, action_response: dict
+    ) -> None:
+        if action.transform is not None:
+            self.state = action.transform.apply(
+                source=action_response,
+                target=self.state,
+            )
+
+    def _check_deadline(self) -> None:
+        """Suspend the run before the next action if the run's deadline has been reached."""
+        if (
+            self._suspension is None
+            and self._cursor < len(self.workflow.actions)
+            and self.deadline_reached()
+        ):
+            self.suspend(resume_at=time.time(), reason="deadline")
+
     def _run(self):
         while True:
+            # A suspended run is continued by another invocation
+            self._check_deadline()
+            if self._suspension is not None:
+                break
+
             try:
                 action = self.get_next_action()
             except IndexError:
@@ -386,91 +1407,45 @@ class WorkflowRunnerV1:
                 break
 
             # Log start of action - do I want to log the end of the action?
-            self.log_workflow_history_update(action=action)
-            logger.debug(action)
-
-            if action_condition := action.get("condition"):
-                if not ConditionEvaluator(action_condition).evaluate(self.state):
-                    if (on_fail := action_condition.get("on_fail")) == "fail":
-                        raise ConditionFailedFail(failed_action=action, exception=None)
-                    elif on_fail == "stop":
-                        raise ConditionFailedStop(failed_action=action, exception=None)
-                    elif on_fail == "skip":
-                        # Skip the remainder of this action and proceed to the next
-                        continue
-
-            # Prevent expression and string formatting on certain key-paths for core actions
-            if action["type"] == "Flexli:CoreV1:Iterator":
-                ignored_paths = ["actions"]
-            else:
-                ignored_paths = None
-
-            # Parameters are processed from the workflow state
-            prepared_action_params = transform(
-                source=self.state,
-                updates=action.get("parameters"),
-                variables=action.get("variables"),
-                ignored_paths=ignored_paths,
-            )
-            logger.debug(
-                {"object": "prepared_action_params", "contents": prepared_action_params}
-            )
+            self.log_workflow_history_update(action=action.action)
+            logger.debug(action.action)
+
+            if (prepared_action_params := self._prepare_action(action)) is None:
+                continue
 
-            if action["type"].startswith("Flexli:CoreV1:"):
-                logger.debug({"action_type": action["type"]})
-                core_v1_action = action["type"].split(":")[-1].lower()
-                action_response = getattr(self.core_actions, core_v1_action)(
+            if action.core_action_name:
+                logger.debug({"action_type": action.type})
+                action_response = action.core_action(self.core_actions)(
                     **prepared_action_params
                 )
 
             else:
-                action_connector = copy.deepcopy(
-                    read_connector_cached(
-                        tenant_id=self.tenant_id,
-                        connector_id=action["connector_id"],
-                    )
+                # The cached connector is shared and must not be modified
+                action_connector = read_connector_index(
+                    tenant_id=self.tenant_id,
+                    connector_id=action.connector_id,
+                    # A cached connector older than the workflow's is read again
+                    min_version=action.connector_version,
                 )
-
-                # Find matching action
-                for i in action_connector["actions"]:
-                    if i["type"] == action["type"]:
-                        connector_action = i
-                        break
-                else:
-                    raise Exception("How did we not find a matching action??")
-
-                logger.debug("***** ACTION CONNECTOR FROM LRU_CACHE CALL *****")
-                logger.debug({k: str(v) for k, v in action_connector.items()})
-
-                # The prepared action is processed from the prepared param
-                # (also used for variable subs)
-                prepared_action = transform(
-                    source=prepared_action_params,
-                    updates=connector_action,
-                    variables=prepared_action_params,
+                prepared_action = self._prepare_connector_action(
+                    action, action_connector, prepared_action_params
                 )
-                logger.debug({"object": "prepared_action", "contents": prepared_action})
 
-                try:
-                    action_response = self._run_action(
-                        action=prepared_action,
-                        connector=action_connector,
+                if (
+                    action_response := self._run_connector_action(
+                        action, action_connector, prepared_action
                     )
-                except Exception as error:
-                    raise WorkflowFailed(failed_action=action, exception=error)
-
-            if action.get("transform"):
-                self.state = transform(
-                    source=action_response,
-                    target=self.state,
-                    updates=action["transform"],
-                )
+                ) is None:
+                    continue
 
-    def run(self):
-        try:
-            self._run()
-        except TransformError as error:
-            logger.exception(error)
+            self._apply_action_response(action, action_response)
+
+    def _finish_run(self, error: Optional[Exception] = None) -> None:
+        """Write the final history update for the run. ``error`` is the exception that ended
+        the run, if any.
+        """
+        if isinstance(error, TransformError):
+            logger.error(error, exc_info=error)
             self.log_workflow_history_update(
                 status="failed",
                 reason={
@@ -478,32 +1453,37 @@ class WorkflowRunnerV1:
                     "error": str(error),
                 },
             )
-        except ConditionFailedFail as error:
-            logger.exception(error.exception)
+        elif isinstance(error, ConditionFailedFail):
+            logger.error(error.exception, exc_info=error)
             self.log_workflow_history_update(
                 status="failed", reason="Action condition failed", include_state=False
             )
-        except ConditionFailedStop as error:
-            logger.exception(error.exception)
+        elif isinstance(error, ConditionFailedStop):
+            logger.error(error.exception, exc_info=error)
             self.log_workflow_history_update(
                 status="stopped", reason="Action condition failed", include_state=False
             )
-        except WorkflowFailed as error:
-            logger.exception(error.exception)
+        elif isinstance(error, (WorkflowFailed, ActionFailedStop)):
+            logger.error(error.exception, exc_info=error)
             self.log_workflow_history_update(
-                status="failed",
+                status="failed" if isinstance(error, WorkflowFailed) else "stopped",
                 action=error.failed_action,
                 reason={
                     "message": f"The workflow encountered an error.",
                     "error": str(error.exception),
-                    "response": error.exception.response.text,
+                    "error_type": error_type(error.exception),
+                    # Requests that failed without a response (timeouts) have no text
+                    "response": getattr(
+                        getattr(error.exception, "response", None), "text", None
+                    ),
                 },
                 include_state=False,
             )
         else:
             self.log_workflow_history_update(status="successful", include_state=False)
             # TODO: This needs to be an async process that also handles stopped/failed
-            main_table.update_item(
+            main_table.meta.client.update_item(
+                TableName=main_table.name,
                 Key={
                     "pk": f"T#{self.tenant_id}#WH#{self.workflow_id}",
                     "sk": f"RH#{self.run_id}",
@@ -516,13 +1496,268 @@ class WorkflowRunnerV1:
                 },
             )
 
+    def run(self):
+        try:
+            self._run()
+        except (TransformError, WorkflowError) as error:
+            self._finish_run(error)
+        except RunSuspended:
+            self._suspend_run()
+        else:
+            if self._suspension is not None:
+                self._suspend_run()
+            else:
+                self._finish_run()
+        finally:
+            flush_history()
+
 
-@tracer.capture_method
-def run_workflow_handler(record: SQSRecord):
-    # This is incompatible with multi-threading
-    flexli_globals.reset()
+class AsyncFlexliCoreV1(FlexliCoreV1):
+    """Core actions for ``AsyncWorkflowRunnerV1``. Blocking AWS calls run in worker threads,
+    waits use ``asyncio.sleep``, and iterator items run as tasks on the event loop.
+    """
+
+    async def customevent(self, **kwargs):
+        return await asyncio.to_thread(super().customevent, **kwargs)
+
+    async def runworkflow(self, **kwargs):
+        return await asyncio.to_thread(super().runworkflow, **kwargs)
+
+    async def _run_iterator_item(self, item, workflow: CompiledWorkflow):
+        logger.debug({"message": "***** ITERATOR ITEM *****", "item": item})
 
-    item: dict = json.loads(record.body)
+        iterator_runner = AsyncWorkflowRunnerV1(
+            tenant_id=self._runner.tenant_id,
+            workflow_id=self._runner.workflow_id,
+            workflow_version=self._runner.workflow_version,
+            run_id=str(ULID()),
+            source_input=item,
+            actions=workflow,
+            # History for every item is written to the root run
+            parent_run_id=self._runner.parent_run_id or self._runner.run_id,
+            # Item requests time out before the invocation does
+            deadline=self._runner.deadline,
+        )
+
+        # Each task has its own copy of the context
+        flexli_globals.ITERATOR_VALUE.set(item)
+        await iterator_runner.run()
+
+    async def iterator(
+        self,
+        array_path: list,
+        actions: list[dict],
+        iterator_input: Optional[dict] = None,
+        max_concurrency: int = 1,
+        fan_out_chunk_size: Optional[int] = None,
+        **kwargs,
+    ):
+        if not isinstance(array_path, list):
+            raise CoreActionFailure("The value for 'array_path' is not an array.")
+
+        logger.debug({"message": "***** ITERATOR ARRAY *****", "item": array_path})
+
+        max_concurrency = min(int(max_concurrency), len(array_path))
+
+        if fan_out_chunk_size and len(array_path) > int(fan_out_chunk_size):
+            await asyncio.to_thread(
+                self._fan_out_iterator,
+                array=array_path,
+                actions=actions,
+                max_concurrency=max(max_concurrency, 1),
+                chunk_size=int(fan_out_chunk_size),
+            )
+            return
+
+        workflow = CompiledWorkflow(
+            actions,
+            core_actions_class=type(self),
+            retry_policy=self._runner.workflow.retry_policy,
+        )
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        skipped = []
+
+        async def run_item(index: int):
+            async with semaphore:
+                if self._runner.resumable and self._runner.deadline_reached():
+                    skipped.append(index)
+                else:
+                    await self._run_iterator_item(array_path[index], workflow)
+
+        # An unhandled error cancels the pending items
+        tasks = [
+            asyncio.create_task(run_item(i)) for i in self._remaining_items(array_path)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        self._suspend_iterator(skipped)
+
+    async def branch(self, branches: list[dict], exclusive: bool = True, **kwargs):
+        branch_runners = self._branch_runners(branches, exclusive)
+        semaphore = asyncio.Semaphore(BRANCH_MAX_CONCURRENCY)
+
+        async def run_branch(branch_runner: AsyncWorkflowRunnerV1):
+            async with semaphore:
+                await branch_runner.run()
+
+        tasks = [
+            asyncio.create_task(run_branch(i))
+            for _, i in branch_runners
+            if isinstance(i, WorkflowRunnerV1)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        return self._end_branches(branch_runners)
+
+    async def data(self, **kwargs):
+        return super().data(**kwargs)
+
+    async def wait(self, seconds: Union[int, str], **kwargs):
+        seconds = int(seconds)
+        if seconds <= WAIT_IN_PLACE_MAX or not self._runner.suspend(
+            resume_at=time.time() + seconds, reason="wait"
+        ):
+            await asyncio.sleep(seconds)
+        return {}
+
+
+class AsyncWorkflowRunnerV1(WorkflowRunnerV1):
+    """Runs a workflow as a coroutine with the same action semantics as ``WorkflowRunnerV1``.
+
+    Requests, DynamoDB, KMS, and SQS calls are blocking and run in the event loop's default
+    thread pool (``async_executor`` in ``lambda_handler``), so many runs and iterator items can
+    be interleaved on one event loop.
+    """
+
+    core_actions_class = AsyncFlexliCoreV1
+
+    async def _run_connector_action(
+        self,
+        action: CompiledAction,
+        action_connector: ConnectorIndex,
+        prepared_action: dict,
+    ) -> Optional[dict]:
+        budget = retry_budget(self.tenant_id, action_connector.id)
+        attempt = self._first_retry_attempt(budget)
+        while True:
+            try:
+                return await asyncio.to_thread(
+                    self._run_action,
+                    action=prepared_action,
+                    connector=action_connector,
+                    timeout=self._request_timeout(action),
+                    max_time=self._request_time_left(),
+                )
+            except Exception as error:
+                if (delay := self._retry_delay(action, error, attempt, budget)) is None:
+                    return self._action_failed(action, error)
+
+            attempt += 1
+            if self._suspend_retry(delay, attempt):
+                raise RunSuspended()
+            await asyncio.sleep(delay)
+
+    async def _run(self):
+        while True:
+            self._check_deadline()
+            if self._suspension is not None:
+                break
+
+            try:
+                action = self.get_next_action()
+            except IndexError:
+                logger.debug("***** Workflow Run %s Complete *****", self.run_id)
+                break
+
+            await asyncio.to_thread(
+                self.log_workflow_history_update, action=action.action
+            )
+            logger.debug(action.action)
+
+            if (prepared_action_params := self._prepare_action(action)) is None:
+                continue
+
+            if action.core_action_name:
+                logger.debug({"action_type": action.type})
+                action_response = await action.core_action(self.core_actions)(
+                    **prepared_action_params
+                )
+
+            else:
+                action_connector = await asyncio.to_thread(
+                    read_connector_index,
+                    tenant_id=self.tenant_id,
+                    connector_id=action.connector_id,
+                    # A cached connector older than the workflow's is read again
+                    min_version=action.connector_version,
+                )
+                prepared_action = self._prepare_connector_action(
+                    action, action_connector, prepared_action_params
+                )
+
+                if (
+                    action_response := await self._run_connector_action(
+                        action, action_connector, prepared_action
+                    )
+                ) is None:
+                    continue
+
+            self._apply_action_response(action, action_response)
+
+    async def run(self):
+        try:
+            await self._run()
+        except (TransformError, WorkflowError) as error:
+            await asyncio.to_thread(self._finish_run, error)
+        except RunSuspended:
+            await asyncio.to_thread(self._suspend_run)
+        else:
+            if self._suspension is not None:
+                await asyncio.to_thread(self._suspend_run)
+            else:
+                await asyncio.to_thread(self._finish_run)
+        finally:
+            await asyncio.to_thread(flush_history)
+
+
+def create_runner(
+    record: SQSRecord, runner_class: type = None, deadline: Optional[float] = None
+) -> WorkflowRunnerV1:
+    # Offloaded payloads are read when the run starts
+    item: dict = load_run_message(record.body)
+
+    runner_class = runner_class or WorkflowRunnerV1
+
+    # Run messages reference the workflow version. Messages sent before versions were
+    # referenced, and iterator chunks, include the actions.
+    if "actions" in item:
+        actions = item["actions"]
+    else:
+        workflow_data = read_workflow_definition(
+            tenant_id=item["tenant_id"],
+            workflow_id=item["workflow_id"],
+            workflow_version=item["workflow_version"],
+        )
+        actions = compile_workflow(
+            tenant_id=item["tenant_id"],
+            workflow_id=item["workflow_id"],
+            workflow_version=item["workflow_version"],
+            actions=workflow_data["actions"],
+            core_actions_class=runner_class.core_actions_class,
+            on_error=workflow_data.get("on_error"),
+        )
 
     logger.info(
         {
@@ -537,7 +1772,8 @@ def run_workflow_handler(record: SQSRecord):
         item["run_id"] = str(ULID())
 
         # TODO: Move to database module
-        main_table.put_item(
+        main_table.meta.client.put_item(
+            TableName=main_table.name,
             Item={
                 "pk": f"T#{item['tenant_id']}#WH#{item['workflow_id']}",
                 "sk": f"RH#{item['run_id']}",
@@ -550,20 +1786,75 @@ def run_workflow_handler(record: SQSRecord):
                 "workflow_name": item["workflow_name"],
                 "status": "running",
                 "start_time": datetime.utcnow().isoformat(),
-            }
+            },
         )
 
-    runner = WorkflowRunnerV1(
+    return runner_class(
         tenant_id=item["tenant_id"],
         workflow_id=item["workflow_id"],
         workflow_version=item["workflow_version"],
         run_id=item["run_id"],
         source_input=item.get("source_input", {}),
-        actions=item["actions"],
+        actions=actions,
         parent_run_id=item.get("parent_run_id"),
+        checkpoint=item.get("checkpoint"),
+        resumable=True,
+        deadline=deadline,
+        on_error=item.get("on_error"),
     )
 
-    runner.run()
+
+def run_deadline(lambda_context: Optional[LambdaContext]) -> Optional[float]:
+    """Return the ``time.monotonic()`` time the invocation times out. Runs are checkpointed
+    and continued by another invocation ``CHECKPOINT_MARGIN`` seconds before.
+    """
+    try:
+        remaining = lambda_context.get_remaining_time_in_millis() / 1000
+    except AttributeError:
+        return None
+    return time.monotonic() + remaining
+
+
+@tracer.capture_method
+def run_workflow_handler(record: SQSRecord, lambda_context: LambdaContext = None):
+    # Records are processed in their own context (see `ConcurrentBatchProcessor`)
+    flexli_globals.reset()
+
+    create_runner(record, deadline=run_deadline(lambda_context)).run()
+
+
+async def async_run_workflow_handler(
+    record: SQSRecord, lambda_context: LambdaContext = None
+):
+    # Each record is processed in its own task (and context)
+    flexli_globals.reset()
+
+    runner = await asyncio.to_thread(
+        create_runner, record, AsyncWorkflowRunnerV1, run_deadline(lambda_context)
+    )
+    await runner.run()
+
+
+def prefetch_workflow_definitions(event: dict) -> None:
+    """Read the workflow versions referenced by the batch's run messages into the definition
+    cache with ``BatchGetItem``. Runs read any version that failed to prefetch themselves.
+    """
+    keys = set()
+    for record in event.get("Records", []):
+        try:
+            item = json.loads(record["body"])
+            if "actions" not in item and "actions" not in item.get("payloads", {}):
+                keys.add(
+                    (item["tenant_id"], item["workflow_id"], item["workflow_version"])
+                )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+
+    if keys:
+        try:
+            read_workflow_definitions(keys)
+        except Exception:
+            logger.exception("Failed to prefetch workflow versions")
 
 
 def lambda_handler(event, context: LambdaContext):
@@ -578,9 +1869,17 @@ def lambda_handler(event, context: LambdaContext):
             "version": 1,
             "schema_version": 1,
             "source_input": {} | null,
-            "actions": [<Action1>. <Action2>],
+            "payloads": {"source_input": "<Payload key>"} | null,
+            "checkpoint": {"cursor": 1, "state": {}, ...} | null,
         }
 
+    The actions are read from the workflow version. Older messages include the ``actions``.
+    Large fields are offloaded to the payload store (see ``payload_store``).
+
+    Continuation messages of suspended runs include the run's ``checkpoint`` and resume the run
+    where it was suspended (see ``WorkflowRunnerV1.suspend()``). Runs are also suspended when
+    the invocation is about to time out (see ``run_deadline()``).
+
     Translate to:
 
         {
@@ -593,11 +1892,33 @@ def lambda_handler(event, context: LambdaContext):
 
     Initial `state` is optionally provided in the event/run request.
     If a source is present the `transform` will be applied to the run input.
+
+    Records in the batch are run concurrently when ``BATCH_CONCURRENCY`` is greater than 1. The
+    threads of the batch and of the runs' iterators are bounded by ``INVOCATION_MAX_THREADS``.
+    When ``RUNNER_MODE`` is ``async`` all records in the batch are run concurrently on an event
+    loop with ``AsyncWorkflowRunnerV1``, and their blocking calls on ``ASYNC_RUN_CONCURRENCY``
+    threads.
     """
-    # TODO: Future enhancement: multithread the batch.
-    return process_partial_response(
-        event=event,
-        record_handler=run_workflow_handler,
-        processor=processor,
-        context=context,
-    )
+    prefetch_workflow_definitions(event)
+
+    try:
+        if RUNNER_MODE == "async":
+            async_event_loop()
+            response = async_process_partial_response(
+                event=event,
+                record_handler=async_run_workflow_handler,
+                processor=async_processor,
+                context=context,
+            )
+        else:
+            response = process_partial_response(
+                event=event,
+                record_handler=run_workflow_handler,
+                processor=processor,
+                context=context,
+            )
+    finally:
+        # Nothing may be left in the buffer when the execution environment is frozen
+        flush_history()
+    logger.debug({"http_pool_stats": [asdict(i) for i in http_pool.stats()]})
+    return response
@@ -10,7 +10,7 @@ from aws_lambda_powertools.utilities.data_classes.dynamo_db_stream_event import
 import boto3
 from botocore.exceptions import ClientError
 
-from apis.models import DecimalEncoder
+from payload_store import SCHEDULES_PREFIX, get_payload_store, run_message_body
 
 RUN_QUEUE_ARN = os.environ["RUN_QUEUE_ARN"]
 SCHEDULER_ROLE_ARN = os.environ["SCHEDULER_ROLE_ARN"]
@@ -111,7 +111,7 @@ def create_schedule(image: dict[str, Any]):
             Target={
                 "Arn": RUN_QUEUE_ARN,
                 "RoleArn": SCHEDULER_ROLE_ARN,
-                "Input": json.dumps(
+                "Input": run_message_body(
                     {
                         "tenant_id": tenant_id,
                         "workflow_id": image["id"],
@@ -120,9 +120,8 @@ def create_schedule(image: dict[str, Any]):
                         "workflow_name": image["name"],
                         "run_id": None,
                         "source_input": {},
-                        "actions": image["actions"],
                     },
-                    cls=DecimalEncoder,
+                    store=get_payload_store(SCHEDULES_PREFIX),
                 ),
                 # "DeadLetterConfig": {"Arn": "string"},
                 # "RetryPolicy": {
@@ -162,7 +161,7 @@ def update_schedule(image: dict[str, Any]):
             Target={
                 "Arn": RUN_QUEUE_ARN,
                 "RoleArn": SCHEDULER_ROLE_ARN,
-                "Input": json.dumps(
+                "Input": run_message_body(
                     {
                         "tenant_id": tenant_id,
                         "workflow_id": image["id"],
@@ -171,9 +170,8 @@ def update_schedule(image: dict[str, Any]):
                         "workflow_name": image["name"],
                         "run_id": None,
                         "source_input": {},
-                        "actions": image["actions"],
                     },
-                    cls=DecimalEncoder,
+                    store=get_payload_store(SCHEDULES_PREFIX),
                 ),
             },
         )
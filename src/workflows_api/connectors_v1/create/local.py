@@ -19,6 +19,7 @@ class OAuth2ClientCredentials(BaseModel):
     client_secret: str
     token_url: str
     basic_auth: bool
+    scope: Optional[str] = None
 
 
 class BearerTokenCredentials(BaseModel):
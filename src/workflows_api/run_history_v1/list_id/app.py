@@ -7,7 +7,7 @@ from pydantic import ValidationError, parse_obj_as
 from apis.middleware import api_middleware_v1
 from apis.models import ApiMiddlewareEvent, ApiResponse, BadRequest
 from aws_utils import get_boto3_resource
-from database.run_history import list_run_history_by_id
+from database.run_history import list_run_history_by_id, rebuild_history_states
 
 from local import QueryStringParams, RunHistoryV1List, RunHistoryV1ListItem
 
@@ -46,6 +46,9 @@ def lambda_handler(event: ApiMiddlewareEvent, context: LambdaContext) -> ApiResp
     )
     logger.debug(response)
 
+    # States are rebuilt for history updates that were written as a diff of the state
+    response = rebuild_history_states(response)
+
     return ApiResponse(
         200,
         {
@@ -12,11 +12,11 @@ from apis.models import (
     ApiResponse,
     BadRequest,
     CreatedResponse,
-    DecimalEncoder,
 )
 from aws_utils import get_boto3_client, get_boto3_resource
-from conditions import ConditionEvaluator
-from database.workflows import read_workflow_version
+from conditions import compile_condition
+from database.workflows import read_workflow_definition
+from payload_store import run_message_body
 
 logger = Logger()
 
@@ -46,7 +46,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context: LambdaContext) -> ApiResp
 
     # TODO: This code is shared ith the Backend Runner and needs to be in a module
 
-    workflow_data = read_workflow_version(
+    workflow_data = read_workflow_definition(
         tenant_id=event.tenant_id,
         workflow_id=workflow_id,
         workflow_version=workflow_version,
@@ -55,7 +55,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context: LambdaContext) -> ApiResp
     # Source-less workflows are allowed through the Run API
     if workflow_source := workflow_data.get("source"):
         if source_condition := workflow_source.get("condition"):
-            if not ConditionEvaluator(source_condition).evaluate(source_input):
+            if not compile_condition(source_condition).evaluate(source_input):
                 raise BadRequest(
                     error_code="ConditionFailed",
                     description="The source condition failed.",
@@ -66,7 +66,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context: LambdaContext) -> ApiResp
 
     sqs_client.send_message(
         QueueUrl=RUN_QUEUE_URL,
-        MessageBody=json.dumps(
+        MessageBody=run_message_body(
             {
                 "tenant_id": event.tenant_id,
                 "workflow_id": workflow_id,
@@ -74,9 +74,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context: LambdaContext) -> ApiResp
                 # "workflow_schema_version": workflow_data["schema_version"],
                 "run_id": new_run_id,
                 "source_input": source_input,
-                "actions": workflow_data["actions"],
-            },
-            cls=DecimalEncoder,
+            }
         ),
     )
 
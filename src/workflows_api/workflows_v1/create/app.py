@@ -9,22 +9,15 @@ from apis.models import (
     BadRequest,
     json_schema_validation,
 )
-from database.connectors import find_connector_by_id, list_connectors
+from database.connectors import list_connectors, read_connector_index
 from database.workflows import create_workflow
 
 from local import WorkflowsV1Create
 
-
 logger = Logger()
 tracer = Tracer()
 
 
-def find_item_by_key(items: list[dict], key: str, value: str) -> dict:
-    for i in items:
-        if i.get(key) == value:
-            return i
-
-
 @api_middleware_v1(input_validator=WorkflowsV1Create, output_validator=CreatedResponse)
 def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
     logger.append_keys(tenant_id=event.tenant_id)
@@ -34,7 +27,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
 
     # Get the list of all current connectors
     # The 'type' is included in this return.
-    current_tenant_connectors = list_connectors(tenant_id)
+    current_tenant_connectors = {i["id"]: i for i in list_connectors(tenant_id)}
     logger.debug(current_tenant_connectors or "No connectors found for this tenant")
 
     """List response items:
@@ -84,9 +77,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
             connector_id = workflow_source["connector_id"]
 
             if not (
-                matched_source_connector := find_item_by_key(
-                    items=current_tenant_connectors, key="id", value=connector_id
-                )
+                matched_source_connector := current_tenant_connectors.get(connector_id)
             ):
                 raise BadRequest(
                     error_code="InvalidConnectorId",
@@ -94,11 +85,14 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
                     details={"id": connector_id},
                 )
 
-            # if workflow_source["type"] not in matched_source_connector["context"]["events"]:
-            if (
-                workflow_source["type"]
-                not in matched_source_connector["context"]["events"]
-            ):
+            # The cached connector is shared and must not be modified
+            source_connector = read_connector_index(
+                tenant_id=tenant_id,
+                connector_id=connector_id,
+                min_version=matched_source_connector["version"],
+            )
+
+            if workflow_source["type"] not in source_connector.events:
                 raise BadRequest(
                     error_code="UnsupportedEventType",
                     description="The source event type is not supported by this connector",
@@ -111,12 +105,6 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
                     },
                 )
 
-            # matched_source_connector_data = find_connector_by_id(
-            #     tenant_id=tenant_id,
-            #     connector_id=connector_id,
-            #     connectors_list=current_tenant_connectors,
-            # )
-
             # TODO: Update middleware to handle JSON schema validation errors.
             workflow_source["connector_type"] = matched_source_connector["type"]
 
@@ -135,9 +123,7 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
         connector_id = workflow_action["connector_id"]
 
         if not (
-            matched_action_connector := find_item_by_key(
-                items=current_tenant_connectors, key="id", value=connector_id
-            )
+            matched_action_connector := current_tenant_connectors.get(connector_id)
         ):
             raise BadRequest(
                 error_code="InvalidConnectorId",
@@ -145,9 +131,17 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
                 details={"id": connector_id},
             )
 
-        if (
-            workflow_action["type"]
-            not in matched_action_connector["context"]["actions"]
+        # The cached connector is shared and must not be modified
+        action_connector = read_connector_index(
+            tenant_id=tenant_id,
+            connector_id=connector_id,
+            min_version=matched_action_connector["version"],
+        )
+
+        if not (
+            matched_action_connector_data := action_connector.actions.get(
+                workflow_action["type"]
+            )
         ):
             raise BadRequest(
                 error_code="UnsupportedActionType",
@@ -161,16 +155,6 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
                 },
             )
 
-        matched_action_connector_data = find_item_by_key(
-            items=find_connector_by_id(
-                tenant_id=tenant_id,
-                connector_id=connector_id,
-                connectors_list=current_tenant_connectors,
-            )["actions"],
-            key="type",
-            value=workflow_action["type"],
-        )
-
         if actions_validation_errors := json_schema_validation(
             data=workflow_action.get("parameters"),
             validator=Draft202012Validator(
@@ -192,6 +176,8 @@ def lambda_handler(event: ApiMiddlewareEvent, context) -> ApiResponse:
             )
 
         workflow_action["connector_type"] = matched_action_connector["type"]
+        # Runs read the connector at least at the version the action was validated against
+        workflow_action["connector_version"] = action_connector.version
 
     new_workflow_id = create_workflow(tenant_id=tenant_id, data=workflow_data)
 
@@ -12,6 +12,9 @@ os.environ["AWS_REGION"] = "us-east-2"
 os.environ["RUN_QUEUE_URL"] = "RunQueueUrl"
 os.environ["TABLE_NAME"] = "WorkflowsTable"
 os.environ["MAIN_TABLE_NAME"] = "WorkflowsTable"
+os.environ["WORKFLOW_HISTORY_V1_TABLE_NAME"] = "WorkflowHistoryTable"
+os.environ["DATA_V1_TABLE_NAME"] = "DataTable"
+os.environ["EVENTS_QUEUE_URL"] = "EventsQueueUrl"
 
 sys.path.append(".")
 sys.path.append("src/layers/layer")
@@ -0,0 +1,102 @@
+from botocore.exceptions import ClientError, EndpointConnectionError
+import pytest
+
+from aws_utils import pack_message_batches, send_message_batches
+
+
+class FakeSqsClient:
+    """Records ``send_message_batch`` calls and fails any entry with a body in ``fail_bodies``."""
+
+    def __init__(
+        self,
+        fail_bodies: tuple = (),
+        raise_error: bool = False,
+        connection_error_bodies: tuple = (),
+    ):
+        self.fail_bodies = fail_bodies
+        self.raise_error = raise_error
+        self.connection_error_bodies = connection_error_bodies
+        self.calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append(Entries)
+        if any(i["MessageBody"] in self.connection_error_bodies for i in Entries):
+            raise EndpointConnectionError(endpoint_url="https://sqs.example.com")
+        if self.raise_error:
+            raise ClientError(
+                {"Error": {"Code": "AWS.SimpleQueueService.NonExistentQueue"}},
+                "SendMessageBatch",
+            )
+
+        failed = [
+            {"Id": i["Id"], "SenderFault": True, "Code": "Failed"}
+            for i in Entries
+            if i["MessageBody"] in self.fail_bodies
+        ]
+        return {
+            "Successful": [
+                {"Id": i["Id"]}
+                for i in Entries
+                if i["MessageBody"] not in self.fail_bodies
+            ],
+            "Failed": failed,
+        }
+
+
+def test_pack_message_batches_entries():
+    batches, oversized = pack_message_batches(
+        [(i, str(i)) for i in range(25)], max_entries=10
+    )
+
+    assert [len(i) for i in batches] == [10, 10, 5]
+    assert oversized == []
+
+
+def test_pack_message_batches_bytes():
+    batches, oversized = pack_message_batches(
+        [("a", "x" * 60), ("b", "x" * 60), ("c", "x" * 101), ("d", "x" * 10)],
+        max_bytes=100,
+    )
+
+    assert batches == [[("a", "x" * 60)], [("b", "x" * 60), ("d", "x" * 10)]]
+    assert oversized == ["c"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_send_message_batches(max_workers):
+    client = FakeSqsClient(fail_bodies=("fail-1", "fail-2"))
+    messages = [(f"record-{i % 3}", str(i)) for i in range(20)]
+    messages += [("record-3", "fail-1"), ("record-3", "fail-2"), ("record-4", "ok")]
+
+    failed = send_message_batches(
+        queue_url="RunQueueUrl",
+        messages=messages,
+        sqs_client=client,
+        max_workers=max_workers,
+    )
+
+    assert failed == ["record-3", "record-3"]
+    assert len(client.calls) == 3
+    assert sum(len(i) for i in client.calls) == 23
+
+
+def test_send_message_batches_client_error():
+    failed = send_message_batches(
+        queue_url="RunQueueUrl",
+        messages=[("a", "1"), ("b", "2")],
+        sqs_client=FakeSqsClient(raise_error=True),
+    )
+
+    assert failed == ["a", "b"]
+
+
+def test_send_message_batches_connection_error():
+    failed = send_message_batches(
+        queue_url="RunQueueUrl",
+        messages=[(f"record-{i // 10}", str(i)) for i in range(30)],
+        sqs_client=FakeSqsClient(connection_error_bodies=("15",)),
+        max_workers=3,
+    )
+
+    # Only the messages of the batch that failed to send are failed
+    assert failed == ["record-1"] * 10
@@ -0,0 +1,94 @@
+import pytest
+
+from caching import LRUCache, TTLCache
+
+
+def test_lru_cache_get_set():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("b", "default") == "default"
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.size) == (1, 2, 1)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats().evictions == 1
+
+
+def test_lru_cache_get_or_set():
+    cache = LRUCache(maxsize=2)
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return "value"
+
+    assert cache.get_or_set("a", factory) == "value"
+    assert cache.get_or_set("a", factory) == "value"
+    assert len(calls) == 1
+
+
+def test_lru_cache_pop_and_clear():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.pop("a") == 1
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache_invalid_maxsize():
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=0)
+
+
+def test_ttl_cache_expires():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set("a", 1)
+
+    now[0] = 9.9
+    assert "a" in cache
+    assert cache.get("a") == 1
+
+    now[0] = 10
+    assert "a" not in cache
+    assert cache.get("a", "expired") == "expired"
+    assert len(cache) == 0
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses) == (1, 1)
+
+
+def test_ttl_cache_get_or_set_and_pop():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+
+    assert cache.get_or_set("a", lambda: 1) == 1
+    assert cache.get_or_set("a", lambda: 2) == 1
+    now[0] = 20
+    assert cache.get_or_set("a", lambda: 3) == 3
+
+    assert cache.pop("a") == 3
+    assert cache.pop("a", "missing") == "missing"
+
+
+def test_ttl_cache_invalid_ttl():
+    with pytest.raises(ValueError):
+        TTLCache(ttl=0)
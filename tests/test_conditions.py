@@ -1,4 +1,15 @@
-from src.layers.layer.conditions import ConditionEvaluator
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import ValidationError
+import pytest
+
+from src.layers.layer.conditions import (
+    ConditionEvaluator,
+    compile_condition,
+    condition_cache,
+    evaluate_batch,
+    value_coercer,
+)
 
 
 def test_single_number_criteria():
@@ -103,6 +114,181 @@ def test_value_expression():
     assert cond.evaluate(source) is True
 
 
+def single_attribute(type_: str, attribute: str, operator: str, value) -> dict:
+    return {
+        "criteria": [
+            {
+                "attributes": [
+                    {
+                        "type": type_,
+                        "attribute": attribute,
+                        "operator": operator,
+                        "value": value,
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def test_value_expression_resolved_per_resource():
+    cond = ConditionEvaluator(single_attribute("Number", "::foo", "eq", "::bar"))
+
+    assert cond.evaluate({"foo": 1, "bar": 1}) is True
+    assert cond.evaluate({"foo": 1, "bar": 2}) is False
+    assert cond.evaluate({"foo": 2, "bar": 2}) is True
+    assert cond.criteria[0].attributes[0].model.value == "::bar"
+
+
+@pytest.mark.parametrize(
+    "operator,value,expected",
+    [
+        ("eq", "10.15.7", True),
+        ("gt", "10.9", True),
+        ("lt", "10.15.10", True),
+        ("gte", "11", False),
+        ("ne", "10.15.7", False),
+    ],
+)
+def test_version_criteria(operator, value, expected):
+    cond = ConditionEvaluator(single_attribute("Version", "::os", operator, value))
+    assert cond.evaluate({"os": "10.15.7"}) is expected
+
+
+@pytest.mark.parametrize(
+    "operator,resource,expected",
+    [
+        ("gt", {"foo": "5"}, False),
+        ("gt", {"foo": ["a", 5]}, True),
+        ("eq", {"foo": True}, False),
+        ("ne", {"foo": "1"}, True),
+        ("ne", {"foo": [1, "a"]}, False),
+        ("eq", {"foo": []}, False),
+    ],
+)
+def test_type_mismatch_criteria(operator, resource, expected):
+    cond = ConditionEvaluator(single_attribute("Number", "::foo", operator, 1))
+    assert cond.evaluate(resource) is expected
+
+
+def test_date_criteria_epoch_and_invalid_values():
+    cond = ConditionEvaluator(
+        single_attribute("Date", "::time", "after", "2020-01-01T00:00:00Z")
+    )
+
+    assert cond.evaluate({"time": 1700000000}) is True
+    assert cond.evaluate({"time": 1700000000000}) is True
+    assert cond.evaluate({"time": "not a date"}) is False
+    assert cond.evaluate({}) is False
+
+
+def test_criteria_short_circuit():
+    data = {
+        "operator": "or",
+        "criteria": [
+            {
+                "attributes": [
+                    {
+                        "type": "Number",
+                        "attribute": "::foo",
+                        "operator": "eq",
+                        "value": 1,
+                    }
+                ]
+            },
+            {
+                "attributes": [
+                    {
+                        "type": "String",
+                        "attribute": "::bar",
+                        "operator": "starts_with",
+                        "value": "::prefix",
+                    }
+                ]
+            },
+        ],
+    }
+    cond = ConditionEvaluator(data)
+
+    assert cond.evaluate({"foo": 1}) is True
+    assert cond.evaluate({"foo": 2, "bar": "abc", "prefix": "ab"}) is True
+    assert cond.evaluate({"foo": 2, "bar": "abc", "prefix": "b"}) is False
+
+
+def test_compile_condition_cached():
+    condition_cache.clear()
+    data = single_attribute("Number", "::foo", "eq", 1)
+
+    cond = compile_condition(data)
+
+    assert compile_condition(dict(data)) is cond
+    assert compile_condition(single_attribute("Number", "::foo", "eq", 2)) is not cond
+    assert cond.evaluate({"foo": 1}) is True
+    assert condition_cache.stats().hits == 1
+
+
+@pytest.mark.parametrize(
+    "type_,operator,resource,expected",
+    [
+        ("Number", "eq", {"foo": 1, "other": "1"}, False),
+        ("Number", "eq", {"foo": 1.5, "other": 1.5}, True),
+        ("Boolean", "eq", {"foo": True, "other": "true"}, False),
+        ("Date", "before", {"foo": "2020-01-01", "other": "2020-01-02"}, True),
+        ("Date", "before", {"foo": "2020-01-01", "other": "never"}, False),
+        ("String", "eq", {"foo": "a", "other": None}, False),
+    ],
+)
+def test_value_expression_coerced(type_, operator, resource, expected):
+    cond = ConditionEvaluator(single_attribute(type_, "::foo", operator, "::other"))
+    assert cond.evaluate(resource) is expected
+
+
+def test_value_coercer_shared():
+    assert value_coercer("Number") is value_coercer("Number")
+    assert value_coercer("Date") is not value_coercer("Number")
+
+
+def test_condition_model_frozen():
+    cond = ConditionEvaluator(single_attribute("Number", "::foo", "eq", "::bar"))
+
+    with pytest.raises(ValidationError):
+        cond.criteria[0].attributes[0].model.value = 1
+
+
+def test_condition_shared_across_threads():
+    cond = compile_condition(single_attribute("Number", "::foo", "eq", "::bar"))
+    resources = [{"foo": i, "bar": i if i % 3 else -1} for i in range(1000)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(cond.evaluate, resources))
+
+    assert results == [bool(i % 3) for i in range(1000)]
+
+
+def test_evaluate_batch():
+    foo_eq_1 = compile_condition(single_attribute("Number", "::foo", "eq", 1))
+    foo_gt_bar = compile_condition(single_attribute("Number", "::foo", "gt", "::bar"))
+    resources = [{"foo": 1, "bar": 0}, {"foo": 2, "bar": 3}, {}]
+    conditions = [foo_eq_1, None, foo_gt_bar, foo_eq_1]
+
+    matrix = evaluate_batch(conditions, resources)
+
+    assert matrix == [
+        [True, True, True, True],
+        [False, True, False, False],
+        [False, True, False, False],
+    ]
+    assert matrix == [
+        [c.evaluate(r) if c else True for c in conditions] for r in resources
+    ]
+    assert [e.expression for e in foo_gt_bar.expressions] == ["foo", "bar"]
+
+
+def test_evaluate_batch_empty():
+    assert evaluate_batch([], [{}, {}]) == [[], []]
+    assert evaluate_batch([None], []) == []
+
+
 JAMF_COMPUTER_EXAMPLE = {
     "general": {
         "id": 1,
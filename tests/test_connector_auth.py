@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+from boto3.dynamodb.types import Binary
+import pytest
+
+import connector_auth
+from connector_auth import (
+    OAuth2TokenCache,
+    OAuth2TokenError,
+    auth_headers,
+    credentials_cache_key,
+    refresh_auth_headers,
+)
+
+
+class FakeKmsClient:
+    """Decrypts by reading the ciphertext as the JSON plaintext."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def decrypt(self, CiphertextBlob, KeyId):
+        self.calls += 1
+        return {"KeyId": KeyId, "Plaintext": CiphertextBlob}
+
+
+class FakeTokenResponse:
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise connector_auth.requests.HTTPError(f"{self.status_code} Error")
+
+    def json(self):
+        return self.body
+
+
+class FakeTokenSession:
+    """Issues numbered tokens. Each request waits for ``delay`` seconds."""
+
+    def __init__(self, expires_in: int = 3600, delay: float = 0, status_code=200):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.status_code = status_code
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def post(self, url, data, auth, headers, timeout):
+        time.sleep(self.delay)
+        with self._lock:
+            self.requests.append({"url": url, "data": data, "auth": auth})
+            count = len(self.requests)
+        return FakeTokenResponse(
+            self.status_code,
+            {
+                "access_token": f"token-{count}",
+                "token_type": "bearer",
+                "expires_in": self.expires_in,
+            },
+        )
+
+
+@pytest.fixture
+def kms_client(monkeypatch):
+    client = FakeKmsClient()
+    monkeypatch.setattr(connector_auth, "kms_client", client)
+    connector_auth.clear_auth_header_cache()
+    connector_auth.oauth2_token_cache.clear()
+    yield client
+    connector_auth.clear_auth_header_cache()
+    connector_auth.oauth2_token_cache.clear()
+
+
+@pytest.fixture
+def token_session(monkeypatch):
+    session = FakeTokenSession()
+    monkeypatch.setattr(connector_auth, "token_session", session)
+    return session
+
+
+OAUTH2_CREDENTIALS = {
+    "type": "OAuth2Client",
+    "client_id": "client",
+    "client_secret": "secret",
+    "token_url": "https://auth.example.com/token",
+    "basic_auth": True,
+    "scope": "read",
+}
+
+
+def encrypted(credentials: dict, key_id: str = "key") -> dict:
+    return {
+        "CiphertextBlob": Binary(json.dumps(credentials).encode()),
+        "KeyId": key_id,
+    }
+
+
+def test_auth_headers_cached(kms_client):
+    credentials = encrypted({"type": "BearerToken", "bearer_token": "abc"})
+
+    headers = auth_headers(credentials)
+
+    assert headers == {"Authorization": "Bearer abc"}
+    assert auth_headers(credentials) is headers
+    assert kms_client.calls == 1
+    with pytest.raises(TypeError):
+        headers["Authorization"] = "modified"
+
+
+def test_auth_headers_api_key(kms_client):
+    credentials = encrypted(
+        {"type": "ApiKey", "api_key": "abc", "api_key_header": "X-Api-Key"}
+    )
+    assert auth_headers(credentials) == {"X-Api-Key": "abc"}
+
+
+def test_auth_headers_unsupported(kms_client):
+    with pytest.raises(Exception, match="Unsupported Auth Type"):
+        auth_headers(encrypted({"type": "Unknown"}))
+
+    assert len(connector_auth.auth_header_cache) == 0
+
+
+def test_credentials_cache_key():
+    credentials = encrypted({"type": "BearerToken", "bearer_token": "abc"})
+    raw = dict(credentials, CiphertextBlob=credentials["CiphertextBlob"].value)
+
+    assert credentials_cache_key(credentials) == credentials_cache_key(raw)
+    assert credentials_cache_key(credentials) != credentials_cache_key(
+        encrypted({"type": "BearerToken", "bearer_token": "abc"}, key_id="other")
+    )
+    assert "abc" not in credentials_cache_key(credentials)
+
+
+def test_oauth2_auth_headers(kms_client, token_session):
+    credentials = encrypted(OAUTH2_CREDENTIALS)
+
+    assert auth_headers(credentials) == {"Authorization": "Bearer token-1"}
+    assert auth_headers(credentials) == {"Authorization": "Bearer token-1"}
+    assert kms_client.calls == 1
+    assert token_session.requests == [
+        {
+            "url": "https://auth.example.com/token",
+            "data": {"grant_type": "client_credentials", "scope": "read"},
+            "auth": ("client", "secret"),
+        }
+    ]
+
+
+def test_oauth2_form_credentials(kms_client, token_session):
+    auth_headers(encrypted(dict(OAUTH2_CREDENTIALS, basic_auth=False, scope=None)))
+
+    assert token_session.requests[0]["auth"] is None
+    assert token_session.requests[0]["data"] == {
+        "grant_type": "client_credentials",
+        "client_id": "client",
+        "client_secret": "secret",
+    }
+
+
+def test_oauth2_single_flight(kms_client, token_session):
+    token_session.delay = 0.05
+    credentials = encrypted(OAUTH2_CREDENTIALS)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: auth_headers(credentials), range(8)))
+
+    assert len(token_session.requests) == 1
+    assert all(i == {"Authorization": "Bearer token-1"} for i in results)
+
+
+def test_oauth2_refresh_on_rejected_token(kms_client, token_session):
+    credentials = encrypted(OAUTH2_CREDENTIALS)
+    stale = auth_headers(credentials)
+
+    assert refresh_auth_headers(credentials, stale_headers=stale) == {
+        "Authorization": "Bearer token-2"
+    }
+    # A second caller with the same stale token uses the refreshed token
+    assert refresh_auth_headers(credentials, stale_headers=stale) == {
+        "Authorization": "Bearer token-2"
+    }
+    assert len(token_session.requests) == 2
+
+
+def test_refresh_auth_headers_static_credentials(kms_client):
+    credentials = encrypted({"type": "BearerToken", "bearer_token": "abc"})
+    assert refresh_auth_headers(credentials, auth_headers(credentials)) is None
+
+
+def test_oauth2_proactive_refresh(token_session):
+    token_session.expires_in = 30
+    cache = OAuth2TokenCache(refresh_margin=60)
+
+    first = cache.get_token(("key", None), OAUTH2_CREDENTIALS)
+    # The token is inside the refresh margin and is still returned while refreshing
+    assert cache.get_token(("key", None), OAUTH2_CREDENTIALS) is first
+
+    for _ in range(100):
+        if cache.get_token(("key", None), OAUTH2_CREDENTIALS) is not first:
+            break
+        time.sleep(0.01)
+
+    assert cache.get_token(("key", None), OAUTH2_CREDENTIALS).access_token != "token-1"
+
+
+def test_oauth2_token_error(token_session):
+    token_session.status_code = 401
+
+    with pytest.raises(OAuth2TokenError) as error:
+        OAuth2TokenCache().get_token(("key", None), OAUTH2_CREDENTIALS)
+
+    assert "secret" not in str(error.value)
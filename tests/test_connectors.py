@@ -0,0 +1,148 @@
+from dataclasses import FrozenInstanceError
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+import pytest
+
+from apis.models import NotFound
+import database.connectors as connectors
+from database.connectors import (
+    ConnectorIndex,
+    delete_connector,
+    read_connector_cached,
+    read_connector_index,
+)
+
+
+class FakeConnectorsTable:
+    name = "connectors"
+
+    def __init__(self):
+        self.items = {}
+        self.reads = 0
+        self.meta = SimpleNamespace(client=self)
+
+    def get_item(self, Key, **kwargs):
+        self.reads += 1
+        if item := self.items.get(Key["pk"]):
+            return {"Item": item}
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        if self.items.pop(Key["pk"], None) is None:
+            raise ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "DeleteItem"
+            )
+
+    def put(self, connector_id: str, version: int):
+        self.items[f"T#tenant#C#{connector_id}"] = {
+            "id": connector_id,
+            "version": version,
+        }
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeConnectorsTable()
+    monkeypatch.setattr(connectors, "dynamodb_table", table)
+    connectors.connector_cache.clear()
+    yield table
+    connectors.connector_cache.clear()
+
+
+def test_read_connector_cached(table):
+    table.put("connector", 1)
+
+    connector = read_connector_cached(tenant_id="tenant", connector_id="connector")
+
+    assert read_connector_cached(tenant_id="tenant", connector_id="connector") is (
+        connector
+    )
+    assert table.reads == 1
+
+
+def test_read_connector_cached_expires(table, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(connectors.connector_cache, "timer", lambda: now[0])
+    table.put("connector", 1)
+
+    read_connector_cached(tenant_id="tenant", connector_id="connector")
+    table.put("connector", 2)
+    now[0] = connectors.CONNECTOR_CACHE_TTL
+
+    connector = read_connector_cached(tenant_id="tenant", connector_id="connector")
+    assert connector["version"] == 2
+    assert table.reads == 2
+
+
+def test_read_connector_cached_min_version(table):
+    table.put("connector", 1)
+    read_connector_cached(tenant_id="tenant", connector_id="connector")
+    table.put("connector", 2)
+
+    assert (
+        read_connector_cached(tenant_id="tenant", connector_id="connector")["version"]
+        == 1
+    )
+    assert (
+        read_connector_cached(
+            tenant_id="tenant", connector_id="connector", min_version=2
+        )["version"]
+        == 2
+    )
+    assert table.reads == 2
+
+
+def test_delete_connector_invalidates_cache(table):
+    table.put("connector", 1)
+    read_connector_cached(tenant_id="tenant", connector_id="connector")
+
+    delete_connector(tenant_id="tenant", connector_id="connector")
+
+    with pytest.raises(NotFound):
+        read_connector_cached(tenant_id="tenant", connector_id="connector")
+    with pytest.raises(NotFound):
+        delete_connector(tenant_id="tenant", connector_id="connector")
+
+
+def test_read_connector_index(table):
+    table.put("connector", 1)
+
+    index = read_connector_index(tenant_id="tenant", connector_id="connector")
+
+    assert read_connector_index(tenant_id="tenant", connector_id="connector") is index
+    assert read_connector_cached(tenant_id="tenant", connector_id="connector") is (
+        index.connector
+    )
+    assert index.version == 1
+    assert table.reads == 1
+
+
+def test_connector_index():
+    index = ConnectorIndex.from_connector(
+        {
+            "id": "connector",
+            "version": 1,
+            "config": {
+                "host": "api.example.com",
+                "base_path": "/v1",
+                "default_headers": {"Accept": "application/json"},
+            },
+            "events": [{"type": "DeviceCreated"}],
+            "actions": [{"type": f"Action{i}", "path": f"/{i}"} for i in range(500)],
+        }
+    )
+
+    assert index.actions["Action499"]["path"] == "/499"
+    assert "Missing" not in index.actions
+    assert "DeviceCreated" in index.events
+    assert index.base_url == "https://api.example.com/v1"
+    assert index.default_headers == {"Accept": "application/json"}
+
+    # The index is shared by every run and can't be modified
+    with pytest.raises(TypeError):
+        index.actions["Action0"] = {}
+    with pytest.raises(FrozenInstanceError):
+        index.base_url = "https://example.com"
+
+    assert ConnectorIndex.from_connector({"id": "c", "version": 1}).base_url is None
@@ -1,5 +1,18 @@
+import json
+import sys
+
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+import pytest
+
+import src.resources.events_processor_v1.local as events_processor_local
 from src.resources.events_processor_v1.local import Event
 
+# The app imports its sibling module as ``local`` the same as when packaged for Lambda
+sys.modules.setdefault("local", events_processor_local)
+
+import src.resources.events_processor_v1.app as events_processor_app
+from test_aws_utils import FakeSqsClient
+
 
 def test_event_model_connector():
     event_data = {
@@ -39,3 +52,147 @@ def test_event_model_core():
     assert event_model.data == {}
     assert event_model.connector_type == "Flexli:CoreV1"
     assert event_model.event_type == "MyCustomEvent"
+
+
+def event_record(message_id: str, event_type: str, data: dict) -> SQSRecord:
+    return SQSRecord(
+        {
+            "messageId": message_id,
+            "body": json.dumps(
+                {
+                    "specversion": "1.0",
+                    "type": f"MyConnector:{event_type}",
+                    "source": "flexli.events-api",
+                    "id": f"event-{message_id}",
+                    "tenantid": "tenant",
+                    "connectorid": "connector",
+                    "time": "2023-11-11T05:20:05.251Z",
+                    "datacontenttype": "application/json",
+                    "data": json.dumps(data),
+                }
+            ),
+        }
+    )
+
+
+class FakeMainTable:
+    """Returns ``workflows`` for an event type from GSI1 queries one item per page."""
+
+    def __init__(self, workflows: dict):
+        self.workflows = workflows
+        self.queries = []
+
+    def query(self, **kwargs):
+        self.queries.append(kwargs)
+        values = kwargs["KeyConditionExpression"].get_expression()["values"]
+        event_type = values[1].get_expression()["values"][1].removeprefix("E#")
+        items = self.workflows.get(event_type, [])
+
+        page = kwargs.get("ExclusiveStartKey", 0)
+        response = {"Items": items[page : page + 1]}
+        if page + 1 < len(items):
+            response["LastEvaluatedKey"] = page + 1
+        return response
+
+
+@pytest.fixture
+def main_table(monkeypatch):
+    events_processor_app.subscription_index.clear()
+    table = FakeMainTable({})
+    monkeypatch.setattr(events_processor_app, "main_table", table)
+    yield table
+    events_processor_app.subscription_index.clear()
+
+
+def test_subscription_index_prefetch(main_table):
+    main_table.workflows = {
+        "TypeA": [{"id": "workflow-1", "source": {}}],
+        "TypeB": [
+            {"id": "workflow-2", "source": {"transform": {"value": "::value"}}},
+            {
+                "id": "workflow-3",
+                "source": {
+                    "condition": {
+                        "criteria": [
+                            {
+                                "attributes": [
+                                    {
+                                        "type": "Number",
+                                        "attribute": "::value",
+                                        "operator": "eq",
+                                        "value": 2,
+                                    }
+                                ]
+                            }
+                        ]
+                    }
+                },
+            },
+        ],
+    }
+    records = [
+        event_record("1", "TypeA", {}),
+        event_record("2", "TypeA", {}),
+        event_record("3", "TypeB", {"value": 1}),
+        event_record("4", "TypeC", {}),
+    ]
+
+    processor = events_processor_app.EventProcessor(records=records)
+    processor.evaluate_events()
+
+    # TypeA and TypeC are queried once each, TypeB has two pages
+    assert len(main_table.queries) == 4
+    # workflow-3's source condition fails for the TypeB event
+    assert [i.workflow["id"] for i in processor.events_to_send] == [
+        "workflow-1",
+        "workflow-1",
+        "workflow-2",
+    ]
+    assert processor.events_to_send[2].transform.apply({"value": 1}) == {"value": 1}
+    assert "T#tenant#C#connector/E#TypeC" in events_processor_app.subscription_index
+
+    # A warm index makes no further reads
+    events_processor_app.EventProcessor(records=records).evaluate_events()
+    assert len(main_table.queries) == 4
+
+
+def test_send_events_to_run_queue(monkeypatch, main_table):
+    workflows = [
+        {
+            "id": f"workflow-{i}",
+            "version": 1,
+            "source": {"transform": {"value": "::value"}} if i == 0 else {},
+            "actions": [],
+        }
+        for i in range(3)
+    ]
+    client = FakeSqsClient(fail_bodies=())
+    monkeypatch.setattr(events_processor_app, "sqs_client", client)
+    main_table.workflows = {"MyEventType": workflows}
+
+    processor = events_processor_app.EventProcessor(
+        records=[event_record(str(i), "MyEventType", {"value": i}) for i in range(5)]
+        + [SQSRecord({"messageId": "bad", "body": "{}"})]
+    )
+    processor.evaluate_events()
+
+    # Fail every run for the event from record "2"
+    original = client.send_message_batch
+
+    def send_message_batch(QueueUrl, Entries):
+        client.fail_bodies = tuple(
+            i["MessageBody"]
+            for i in Entries
+            if json.loads(i["MessageBody"])["source_input"] == {"value": 2}
+        )
+        return original(QueueUrl=QueueUrl, Entries=Entries)
+
+    monkeypatch.setattr(client, "send_message_batch", send_message_batch)
+    processor.send_events_to_run_queue()
+
+    assert len(client.calls) == 2
+    assert sum(len(i) for i in client.calls) == 15
+    assert json.loads(client.calls[0][0]["MessageBody"])["source_input"] == {"value": 0}
+    assert processor.sqs_batch_failures() == {
+        "batchItemFailures": [{"itemIdentifier": "bad"}, {"itemIdentifier": "2"}]
+    }
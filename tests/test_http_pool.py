@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+
+from http_pool import HttpPoolManager, PoolTimeout, shorten_timeout
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.cookies.append(self.headers.get("Cookie"))
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "session=tenant-a")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.lock = threading.Lock()
+    server.active = server.max_active = 0
+    server.delay = 0
+    server.cookies = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def test_connections_reused(server):
+    pools = HttpPoolManager()
+
+    for _ in range(5):
+        assert pools.request("get", url(server)).status_code == 200
+
+    (stats,) = pools.stats()
+    assert stats.host == f"127.0.0.1:{server.server_address[1]}"
+    assert (stats.requests, stats.errors, stats.active) == (5, 0, 0)
+    assert stats.connections_opened == 1
+    assert stats.connections_idle == 1
+    pools.close()
+
+
+def test_host_concurrency_capped(server):
+    server.delay = 0.05
+    pools = HttpPoolManager(pool_maxsize=2, max_concurrency=2)
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(
+            executor.map(lambda _: pools.request("get", url(server)), range(6))
+        )
+
+    assert all(i.status_code == 200 for i in responses)
+    assert server.max_active == 2
+    assert pools.stats()[0].connections_opened == 2
+    pools.close()
+
+
+def test_host_slot_wait_times_out(server):
+    server.delay = 0.5
+    pools = HttpPoolManager(max_concurrency=1)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow = executor.submit(pools.request, "get", url(server))
+        while not pools.stats() or not pools.stats()[0].active:
+            time.sleep(0.01)
+
+        with pytest.raises(PoolTimeout):
+            pools.request("get", url(server), max_time=0.1)
+        assert slow.result().status_code == 200
+
+    # The slot is free again
+    assert pools.request("get", url(server), max_time=5).status_code == 200
+    (stats,) = pools.stats()
+    assert (stats.requests, stats.errors, stats.active, stats.waiting) == (2, 1, 0, 0)
+    pools.close()
+
+
+def test_shorten_timeout():
+    assert shorten_timeout(None, 2) == 2
+    assert shorten_timeout(5, 2) == 2
+    assert shorten_timeout((3.05, 1), 2) == (2, 1)
+    assert shorten_timeout((None, 30), 2) == (2, 2)
+
+
+def test_cookies_not_shared(server):
+    pools = HttpPoolManager()
+
+    pools.request("get", url(server))
+    pools.request("get", url(server))
+
+    assert server.cookies == [None, None]
+    pools.close()
+
+
+def test_request_errors_counted():
+    pools = HttpPoolManager()
+
+    with pytest.raises(Exception):
+        pools.request("get", "http://127.0.0.1:1/", timeout=1)
+
+    assert pools.stats()[0].errors == 1
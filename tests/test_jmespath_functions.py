@@ -1,6 +1,9 @@
 import jmespath
+from jmespath.exceptions import JMESPathError
+import pytest
 
 from transforms import flexli_options
+from transforms.core import compile_expression, expression_cache
 
 
 """
@@ -22,3 +25,23 @@ jmespath.search("flexli_time_delta(flexli_datetime(`%Y-%m-%dT%H:%M:%SZ`), `%Y-%m
 
 def test_datetime_isoformat():
     pass
+
+
+def test_compile_expression_is_cached():
+    stats = expression_cache.stats()
+
+    compiled = compile_expression("foo.bar")
+
+    assert compile_expression("foo.bar") is compiled
+    assert compile_expression("foo.bar", options=None) is not compiled
+    assert compiled.search({"foo": {"bar": 1}}) == 1
+    assert expression_cache.stats().hits == stats.hits + 1
+
+
+def test_compiled_expression_uses_options():
+    assert compile_expression("flexli_to_json_string(@)").search({"a": 1}) == '{"a": 1}'
+
+
+def test_compile_expression_invalid():
+    with pytest.raises(JMESPathError):
+        compile_expression("foo[")
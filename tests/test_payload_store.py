@@ -0,0 +1,116 @@
+from decimal import Decimal
+import gzip
+import io
+import json
+
+from botocore.exceptions import ClientError
+import pytest
+
+from payload_store import (
+    LocalPayloadStore,
+    PayloadNotFound,
+    PayloadStore,
+    S3PayloadStore,
+    load_run_message,
+    run_message_body,
+)
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.puts += 1
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        try:
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+        except KeyError:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
+
+MESSAGE = {
+    "tenant_id": "tenant",
+    "workflow_id": "workflow",
+    "run_id": "run",
+    "source_input": {
+        "devices": [{"id": i, "price": Decimal("1.5")} for i in range(200)]
+    },
+    "actions": [{"type": "Flexli:CoreV1:Wait", "order": 1}],
+}
+
+
+def test_run_message_body_offloads_large_fields(tmp_path):
+    store = LocalPayloadStore(str(tmp_path))
+
+    body = run_message_body(MESSAGE, store=store, threshold=1024)
+    sent = json.loads(body)
+
+    assert "source_input" not in sent
+    assert sent["actions"] == MESSAGE["actions"]
+    key = sent["payloads"]["source_input"]
+    assert key.startswith("runs/sha256/")
+    assert json.loads(gzip.decompress((tmp_path / key).read_bytes()))["devices"][0] == {
+        "id": 0,
+        "price": 1.5,
+    }
+
+    message = load_run_message(body, store=store)
+    assert message == json.loads(json.dumps(MESSAGE, default=float))
+    assert "payloads" not in message
+
+
+def test_run_message_body_without_store_or_under_threshold(tmp_path):
+    assert json.loads(run_message_body(MESSAGE, store=None))["source_input"]
+    store = LocalPayloadStore(str(tmp_path))
+    assert "payloads" not in json.loads(run_message_body(MESSAGE, store=store))
+    assert not list(tmp_path.iterdir())
+
+
+def test_payloads_are_content_addressed():
+    s3_client = FakeS3Client()
+    store = S3PayloadStore("bucket", s3_client=s3_client)
+
+    keys = {
+        json.loads(run_message_body(dict(MESSAGE, run_id=str(i)), store, threshold=10))[
+            "payloads"
+        ]["source_input"]
+        for i in range(5)
+    }
+
+    # Identical payloads are written once
+    assert len(keys) == 1
+    assert s3_client.puts == 2
+
+    # A new store (another Lambda environment) reads the same payload. Every read returns a
+    # new object
+    reader = S3PayloadStore("bucket", s3_client=s3_client)
+    key = keys.pop()
+    first, second = reader.get(key), reader.get(key)
+    assert first == second and first is not second
+    assert first["devices"][-1]["id"] == 199
+
+
+def test_payload_not_found(tmp_path):
+    body = json.dumps({"run_id": "run", "payloads": {"actions": "runs/sha256/x"}})
+
+    with pytest.raises(PayloadNotFound):
+        load_run_message(body, store=LocalPayloadStore(str(tmp_path)))
+    with pytest.raises(PayloadNotFound):
+        load_run_message(body, store=S3PayloadStore("bucket", s3_client=FakeS3Client()))
+    with pytest.raises(PayloadNotFound):
+        load_run_message(body, store=None)
+
+
+def test_payload_store_requires_storage_methods():
+    class WriteOnlyPayloadStore(PayloadStore):
+        def _write(self, key: str, data: bytes) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        PayloadStore()
+    with pytest.raises(TypeError):
+        WriteOnlyPayloadStore()
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import retries
+from retries import RetryBudget, RetryPolicy, error_codes, error_type, retry_after
+
+
+def http_error(status_code: int, headers: dict = None) -> requests.HTTPError:
+    response = SimpleNamespace(status_code=status_code, headers=headers or {})
+    return requests.HTTPError(f"{status_code} Error", response=response)
+
+
+def test_error_codes():
+    assert error_codes(http_error(503)) == ("503", "5XX")
+    assert error_codes(requests.ReadTimeout()) == ("Timeout",)
+    assert error_codes(requests.ConnectTimeout()) == ("Timeout",)
+    assert error_codes(requests.ConnectionError()) == ("ConnectionError",)
+    assert error_codes(ValueError()) == ("ValueError",)
+
+
+def test_error_type():
+    assert error_type(requests.ReadTimeout()) == "timeout"
+    assert error_type(requests.ConnectTimeout()) == "timeout"
+    assert error_type(requests.ConnectionError()) == "connection"
+    assert error_type(http_error(404)) == "http"
+    assert error_type(ValueError()) == "error"
+
+
+def test_retry_after():
+    assert retry_after(http_error(429, {"Retry-After": "5"})) == 5
+    assert retry_after(http_error(503, {"Retry-After": "-1"})) == 0
+
+    date = datetime.now(timezone.utc) + timedelta(seconds=30)
+    delay = retry_after(http_error(503, {"Retry-After": format_datetime(date)}))
+    assert delay == pytest.approx(30, abs=2)
+
+    assert retry_after(http_error(503, {"Retry-After": "soon"})) is None
+    assert retry_after(http_error(503)) is None
+    assert retry_after(requests.ConnectionError()) is None
+
+
+def test_retry_policy():
+    assert RetryPolicy.from_on_error(None).max_retries == 0
+
+    policy = RetryPolicy.from_on_error({"max_retries": 2})
+    assert (policy.wait, policy.rate) == (3, 1.5)
+    # Transient errors are retried by default
+    assert policy.retries(http_error(429), attempt=0)
+    assert policy.retries(requests.ReadTimeout(), attempt=1)
+    assert not policy.retries(http_error(429), attempt=2)
+    assert not policy.retries(http_error(404), attempt=0)
+
+    policy = RetryPolicy.from_on_error(
+        {"max_retries": 1, "retry_on": ["404", "5xx"], "on_fail": "skip"}
+    )
+    assert policy.retries(http_error(404), attempt=0)
+    assert policy.retries(http_error(501), attempt=0)
+    assert not policy.retries(http_error(429), attempt=0)
+    assert policy.on_fail == "skip"
+
+
+def test_retry_policy_to_on_error():
+    for policy in (
+        RetryPolicy(),
+        RetryPolicy(max_retries=2, retry_on=frozenset({"5XX"}), wait=30, rate=2.5),
+        RetryPolicy(max_retries=1, on_fail="skip"),
+    ):
+        assert RetryPolicy.from_on_error(policy.to_on_error()) == policy
+
+
+def test_retry_policy_backoff_full_jitter():
+    policy = RetryPolicy.from_on_error(
+        {"max_retries": 3, "backoff": {"wait": 2, "rate": 2}}
+    )
+
+    for attempt, cap in enumerate((2, 4, 8)):
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        assert all(0 <= d <= cap for d in delays)
+        # Delays are spread over the whole range
+        assert min(delays) < cap / 4 and max(delays) > cap * 3 / 4
+
+
+def test_retry_policy_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(retries, "RETRY_MAX_DELAY", 60)
+    policy = RetryPolicy.from_on_error({"max_retries": 10}, wait=30, rate=2.5)
+
+    delays = [policy.backoff(attempt) for attempt in range(10) for _ in range(50)]
+    assert max(delays) <= 60
+    # The cap is the jitter window of later attempts
+    assert max(delays) > 45
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, capacity=2)
+
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+    for _ in range(10):
+        budget.deposit()
+    assert budget.balance() == 2
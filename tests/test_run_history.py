@@ -0,0 +1,272 @@
+from decimal import Decimal
+import threading
+import time
+
+from botocore.exceptions import ClientError
+import pytest
+
+from database.run_history import (
+    HistoryWriteError,
+    HistoryWriter,
+    apply_state_diff,
+    diff_state,
+    rebuild_history_states,
+)
+
+
+class FakeBatchClient:
+    """Records ``BatchWriteItem`` requests. ``unprocessed`` items are returned as unprocessed
+    the number of times given for their ``sk``.
+    """
+
+    def __init__(self, unprocessed: dict = None, error: Exception = None):
+        self.requests = []
+        self.items = []
+        self.unprocessed = dict(unprocessed or {})
+        self.error = error
+
+    def batch_write_item(self, RequestItems):
+        if self.error:
+            raise self.error
+
+        requests = RequestItems["history"]
+        assert len(requests) <= 25
+        keys = [
+            (i["PutRequest"]["Item"]["pk"], i["PutRequest"]["Item"]["sk"])
+            for i in requests
+        ]
+        assert len(keys) == len(set(keys))
+        self.requests.append(requests)
+
+        unprocessed = []
+        for request in requests:
+            sk = request["PutRequest"]["Item"]["sk"]
+            if self.unprocessed.get(sk):
+                self.unprocessed[sk] -= 1
+                unprocessed.append(request)
+            else:
+                self.items.append(request["PutRequest"]["Item"])
+
+        return {"UnprocessedItems": {"history": unprocessed} if unprocessed else {}}
+
+
+class FakeHistoryTable:
+    name = "history"
+
+    def __init__(self, client: FakeBatchClient):
+        self.meta = type("Meta", (), {"client": client})
+
+
+def history_item(sk: str, status: str = "running") -> dict:
+    return {"pk": "T#tenant#RH#run", "sk": sk, "status": status}
+
+
+def make_writer(client: FakeBatchClient, **kwargs) -> HistoryWriter:
+    kwargs.setdefault("flush_interval", 60)
+    kwargs.setdefault("backoff", 0)
+    return HistoryWriter(FakeHistoryTable(client), **kwargs)
+
+
+def test_history_writer_flush_writes_batches_of_25():
+    client = FakeBatchClient()
+    writer = make_writer(client)
+
+    for i in range(60):
+        writer.put(history_item(f"TS#{i:03}"))
+    writer.flush()
+
+    assert writer.pending() == 0
+    assert [i["sk"] for i in client.items] == [f"TS#{i:03}" for i in range(60)]
+    assert all(len(r) <= 25 for r in client.requests)
+
+
+def test_history_writer_duplicate_keys_are_written_in_order():
+    client = FakeBatchClient()
+    writer = make_writer(client)
+
+    writer.put(history_item("TS#1", status="running"))
+    writer.put(history_item("TS#2"))
+    writer.put(history_item("TS#1", status="successful"))
+    writer.flush()
+
+    # The later item is in a later batch so it replaces the earlier one
+    assert len(client.requests) == 2
+    assert [i["status"] for i in client.items if i["sk"] == "TS#1"] == [
+        "running",
+        "successful",
+    ]
+
+
+def test_history_writer_retries_unprocessed_items():
+    client = FakeBatchClient(unprocessed={"TS#2": 2})
+    writer = make_writer(client)
+
+    for i in range(3):
+        writer.put(history_item(f"TS#{i}"))
+    writer.flush()
+
+    assert len(client.requests) == 3
+    assert sorted(i["sk"] for i in client.items) == ["TS#0", "TS#1", "TS#2"]
+
+
+def test_history_writer_flush_raises_and_keeps_unwritten_items():
+    client = FakeBatchClient(unprocessed={"TS#1": 10})
+    writer = make_writer(client, max_attempts=2, batch_size=1)
+
+    for i in range(3):
+        writer.put(history_item(f"TS#{i}"))
+
+    with pytest.raises(HistoryWriteError) as error:
+        writer.flush()
+
+    # Writing stops at the failed batch so later items are not written ahead of it
+    assert [i["sk"] for i in error.value.items] == ["TS#1", "TS#2"]
+    assert [i["sk"] for i in client.items] == ["TS#0"]
+    assert writer.pending() == 2
+
+    client.unprocessed.clear()
+    writer.flush()
+    assert [i["sk"] for i in client.items] == ["TS#0", "TS#1", "TS#2"]
+
+
+def test_history_writer_flush_raises_on_client_error():
+    client = FakeBatchClient(error=RuntimeError("throttled"))
+    writer = make_writer(client)
+    writer.put(history_item("TS#1"))
+
+    with pytest.raises(HistoryWriteError, match="throttled"):
+        writer.flush()
+    assert writer.pending() == 1
+
+
+def test_history_writer_drops_items_that_keep_failing():
+    client = FakeBatchClient(unprocessed={"TS#1": 100})
+    writer = make_writer(client, max_attempts=1, max_item_failures=2)
+
+    writer.put(history_item("TS#1"))
+    with pytest.raises(HistoryWriteError):
+        writer.flush()
+    writer.put(history_item("TS#2"))
+    with pytest.raises(HistoryWriteError):
+        writer.flush()
+
+    # The item is dropped after its second failed write; the later item is written
+    writer.put(history_item("TS#3"))
+    writer.flush()
+    assert writer.pending() == 0
+    assert [i["sk"] for i in client.items] == ["TS#2", "TS#3"]
+
+
+def test_history_writer_drops_rejected_items():
+    client = FakeBatchClient()
+    batch_write_item = client.batch_write_item
+
+    def reject_large_items(RequestItems):
+        if any(i["PutRequest"]["Item"].get("large") for i in RequestItems["history"]):
+            raise ClientError(
+                {"Error": {"Code": "ValidationException"}}, "BatchWriteItem"
+            )
+        return batch_write_item(RequestItems)
+
+    client.batch_write_item = reject_large_items
+    writer = make_writer(client)
+
+    writer.put(history_item("TS#1"))
+    writer.put(dict(history_item("TS#2"), large=True))
+    writer.put(history_item("TS#3"))
+    writer.flush()
+
+    # Only the rejected item is dropped
+    assert writer.pending() == 0
+    assert [i["sk"] for i in client.items] == ["TS#1", "TS#3"]
+
+
+def test_history_writer_background_flush():
+    client = FakeBatchClient()
+    writer = make_writer(client, flush_interval=0.05)
+
+    writer.put(history_item("TS#1"))
+
+    deadline = time.monotonic() + 5
+    while not client.items and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert [i["sk"] for i in client.items] == ["TS#1"]
+    assert writer.pending() == 0
+
+
+def test_history_writer_concurrent_puts():
+    client = FakeBatchClient()
+    writer = make_writer(client, flush_interval=0.01)
+
+    def put_items(thread: int):
+        for i in range(50):
+            writer.put(history_item(f"TS#{thread}#{i:02}"))
+
+    threads = [threading.Thread(target=put_items, args=(t,)) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.flush()
+
+    assert len(client.items) == 200
+    assert len({i["sk"] for i in client.items}) == 200
+
+
+def test_history_writer_batch_size():
+    with pytest.raises(ValueError):
+        HistoryWriter(FakeHistoryTable(FakeBatchClient()), batch_size=26)
+
+
+def test_diff_state():
+    shared = {"devices": [{"id": i} for i in range(100)]}
+    old = {"inventory": shared, "a": 1, "b": {"c": [1, 2, 3]}, "d": True}
+    new = {"inventory": shared, "a": 2, "b": {"c": [1, 5]}, "e": None, "d": 1}
+
+    ops = diff_state(old, new)
+
+    # The shared subtree is unchanged and is not in the diff
+    assert all(op["path"][0] != "inventory" for op in ops)
+    assert {"op": "replace", "path": ["d"], "value": 1} in ops
+    assert apply_state_diff(old, ops) == new
+    assert old["b"]["c"] == [1, 2, 3]
+    assert diff_state(old, old) == []
+
+
+def test_apply_state_diff_copies_changed_containers_only():
+    old = {"a": {"b": [1, 2]}, "c": {"d": 1}}
+    new = apply_state_diff(
+        old, [{"op": "add", "path": ["a", "b", Decimal(2)], "value": 3}]
+    )
+
+    assert new == {"a": {"b": [1, 2, 3]}, "c": {"d": 1}}
+    assert new["c"] is old["c"]
+    assert old["a"]["b"] == [1, 2]
+
+
+def test_diff_state_root_replace():
+    assert apply_state_diff({"a": 1}, diff_state({"a": 1}, [1, 2])) == [1, 2]
+
+
+def test_rebuild_history_states():
+    states = [{"n": 0}, {"n": 1}, {"n": 1, "m": [1]}]
+    items = [
+        {"seq": 1, "state": states[0]},
+        {"seq": 2, "state_base": 1, "state_diff": diff_state(states[0], states[1])},
+        {"seq": 3},
+        {"nested_run_id": "nested", "seq": 1, "state": {"x": 1}},
+        {"seq": 4, "state_base": 2, "state_diff": diff_state(states[1], states[2])},
+    ]
+
+    rebuilt = rebuild_history_states(items)
+
+    assert [i.get("state") for i in rebuilt] == [
+        states[0],
+        states[1],
+        None,
+        {"x": 1},
+        states[2],
+    ]
+    # A diff without its base state can't be rebuilt
+    assert "state" not in rebuild_history_states(items[1:2])[0]
@@ -630,7 +630,7 @@ data = {
     ],
 }
 
-from transforms import find_values_dict, find_and_format_strings
+from transforms import compile_transform, find_values_dict, find_and_format_strings
 
 
 def test_find_values_dict():
@@ -710,3 +710,21 @@ def test_one():
             },
         ],
     }
+
+
+def test_large_state_update_is_copy_on_write():
+    plan = compile_transform(
+        updates={
+            "counts.applications": "::application_count",
+            "counts.certificates": "::certificate_count",
+        }
+    )
+
+    new_state = plan.apply(
+        source={"application_count": 57, "certificate_count": 4}, target=data
+    )
+
+    assert new_state["counts"] == {"applications": 57, "certificates": 4}
+    assert "counts" not in data
+    assert new_state["installed_apps"] is data["installed_apps"]
+    assert new_state["installed_certs"] is data["installed_certs"]
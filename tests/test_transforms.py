@@ -1,9 +1,12 @@
 import copy
 
 from transforms import (
+    TransformPlan,
     check_next_ignored_paths,
+    compile_transform,
     find_and_evaluate_expressions,
     find_and_format_strings,
+    format_fields,
     key_path_is_ignored,
     transform,
 )
@@ -250,3 +253,96 @@ def test_full_transform_with_ignored_paths():
     assert updated_target["b"] == {"c": "is None", "d": "baz", "e": "foobar"}
     assert updated_target["id"] == "12345"
     assert "f" not in updated_target
+
+
+def test_format_fields():
+    assert format_fields("is {foo} and {bar}") == ("foo", "bar")
+    assert format_fields("no fields") == ()
+    assert format_fields("unmatched {") == ()
+
+
+def test_compile_transform_is_cached():
+    updates = {"id": "::general.id", "b.e": "is {name}"}
+    variables = {"name": "::general.name"}
+
+    plan = compile_transform(updates=updates, variables=variables)
+
+    assert compile_transform(updates=dict(updates), variables=variables) is plan
+    assert compile_transform(updates=updates) is not plan
+
+
+def test_compile_transform_keeps_updates_order():
+    source = {"id": 1}
+
+    first = compile_transform(updates={"a": 2, "a.b": "::id"})
+    second = compile_transform(updates={"a.b": "::id", "a": 2})
+
+    assert first is not second
+    assert first.apply(source) == {"a": {"b": 1}}
+    assert second.apply(source) == {"a": 2}
+
+
+def test_transform_plan_apply():
+    source = {"general": {"id": "12345", "name": "Mac"}}
+    plan = TransformPlan(
+        updates={"id": "::general.id", "b.e": "is {name}", "c": ["::general.name"]},
+        variables={"name": "::general.name"},
+    )
+
+    assert plan.apply(source) == {"id": "12345", "b": {"e": "is Mac"}, "c": ["Mac"]}
+    assert plan.apply({"general": {"id": "1", "name": "PC"}})["b"] == {"e": "is PC"}
+
+
+def test_transform_plan_does_not_scan_target():
+    target = {"a": "::general.id", "b": {"c": "is {name}"}}
+    plan = TransformPlan(updates={"b.d": "::general.name"}, variables={"name": "x"})
+
+    updated_target = plan.apply({"general": {"name": "Mac"}}, target=target)
+
+    assert updated_target == {"a": "::general.id", "b": {"c": "is {name}", "d": "Mac"}}
+    assert target == {"a": "::general.id", "b": {"c": "is {name}"}}
+
+
+def test_transform_plan_format_vars():
+    plan = TransformPlan(updates={"path": "/devices/{id}", "body": {"name": "::name"}})
+
+    prepared = plan.apply(
+        {"id": 1, "name": "Mac"}, format_vars={"id": 1, "name": "Mac"}
+    )
+
+    assert prepared == {"path": "/devices/1", "body": {"name": "Mac"}}
+
+
+def test_transform_plan_ignored_paths():
+    plan = TransformPlan(
+        updates={
+            "array_path": "::items",
+            "actions": [{"parameters": {"id": "::id"}}],
+        },
+        ignored_paths=["actions"],
+    )
+
+    prepared = plan.apply({"items": [1, 2], "id": 3})
+
+    assert prepared == {
+        "array_path": [1, 2],
+        "actions": [{"parameters": {"id": "::id"}}],
+    }
+
+
+def test_transform_plan_is_copy_on_write():
+    state = {"inventory": {"apps": [{"name": "Mail.app"}]}, "device": {"id": 1}}
+    plan = compile_transform(updates={"device.name": "::name"})
+
+    new_state = plan.apply({"name": "Mac"}, target=state)
+
+    assert state == {"inventory": {"apps": [{"name": "Mail.app"}]}, "device": {"id": 1}}
+    assert new_state["device"] == {"id": 1, "name": "Mac"}
+    assert new_state["device"] is not state["device"]
+    assert new_state["inventory"] is state["inventory"]
+
+
+def test_wildcard_transform_shares_source():
+    source = {"c": 3, "p": 0}
+
+    assert compile_transform(updates={"::": "::"}).apply(source) is source
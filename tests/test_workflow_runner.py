@@ -0,0 +1,1955 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from aws_lambda_powertools.utilities.batch import EventType, process_partial_response
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+import pytest
+import requests
+
+from caching import LRUCache
+from database.connectors import ConnectorIndex
+import database.workflows as workflows
+from database.run_history import HistoryWriter, rebuild_history_states
+import flexli_globals
+from http_pool import PoolTimeout
+import payload_store
+import retries
+from payload_store import LocalPayloadStore, run_message_body
+import src.resources.workflow_runner_v1.app as runner_app
+from src.resources.workflow_runner_v1.app import (
+    AsyncWorkflowRunnerV1,
+    CompiledWorkflow,
+    ConcurrentBatchProcessor,
+    WorkflowRunnerV1,
+    compile_workflow,
+)
+
+
+def sqs_record(message_id: str, body: str) -> dict:
+    return {
+        "messageId": message_id,
+        "receiptHandle": "",
+        "body": body,
+        "attributes": {},
+        "messageAttributes": {},
+        "md5OfBody": "",
+        "eventSource": "aws:sqs",
+        "eventSourceARN": "",
+        "awsRegion": "us-east-2",
+    }
+
+
+def test_concurrent_batch_processor():
+    processor = ConcurrentBatchProcessor(event_type=EventType.SQS, max_workers=3)
+    # All three records must be in flight at the same time to pass the barrier
+    barrier = threading.Barrier(3, timeout=5)
+
+    def record_handler(record):
+        flexli_globals.ITERATOR_VALUE.set(record.body)
+        barrier.wait()
+        assert flexli_globals.ITERATOR_VALUE.get() == record.body
+        if record.body == "fail":
+            raise ValueError("Failed record")
+
+    response = process_partial_response(
+        event={
+            "Records": [
+                sqs_record("1", "a"),
+                sqs_record("2", "fail"),
+                sqs_record("3", "c"),
+            ]
+        },
+        record_handler=record_handler,
+        processor=processor,
+    )
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+    assert flexli_globals.ITERATOR_VALUE.get() is None
+
+
+def test_batch_processor_sequential():
+    processor = ConcurrentBatchProcessor(event_type=EventType.SQS, max_workers=1)
+    handled = []
+
+    response = process_partial_response(
+        event={"Records": [sqs_record("1", "a"), sqs_record("2", "b")]},
+        record_handler=lambda record: handled.append(record.body),
+        processor=processor,
+    )
+
+    assert response == {"batchItemFailures": []}
+    assert handled == ["a", "b"]
+
+
+class FakeTable:
+    name = "table"
+
+    def __init__(self):
+        self.items = []
+        self.updates = []
+        self.meta = SimpleNamespace(client=self)
+
+    def put_item(self, Item, **kwargs):
+        self.items.append(Item)
+
+    def batch_write_item(self, RequestItems):
+        self.items.extend(i["PutRequest"]["Item"] for i in RequestItems[self.name])
+        return {"UnprocessedItems": {}}
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class FakeResponse:
+    def __init__(self, status_code: int = 200, body: dict = None, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body if body is not None else {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeSession:
+    """Records requests and returns responses from ``responses`` keyed by URL. A response can
+    be a callable that takes the request arguments.
+    """
+
+    responses: dict = {}
+    requests: list = []
+
+    def request(self, **kwargs):
+        FakeSession.requests.append(copy.deepcopy(kwargs))
+        response = FakeSession.responses.get(kwargs["url"], FakeResponse())
+        return response(kwargs) if callable(response) else response
+
+    def stats(self):
+        return []
+
+
+CONNECTOR = {
+    "id": "connector",
+    "version": 1,
+    "config": {
+        "host": "api.example.com",
+        "base_path": "/v1",
+        "default_headers": {"Content-Type": "application/json"},
+    },
+    "actions": [
+        {
+            "type": "GetDevice",
+            "method": "get",
+            "path": "/devices/{device_id}",
+        },
+        {
+            "type": "RenameDevice",
+            "method": "put",
+            "path": "/devices/{device_id}",
+            "body": {"name": "::name"},
+        },
+    ],
+}
+
+
+@pytest.fixture
+def runner_env(monkeypatch):
+    history_table = FakeTable()
+    main_table = FakeTable()
+    monkeypatch.setattr(runner_app, "workflow_history_v1_table", history_table)
+    monkeypatch.setattr(runner_app, "history_writer", HistoryWriter(history_table))
+    monkeypatch.setattr(runner_app, "main_table", main_table)
+    connector = ConnectorIndex.from_connector(CONNECTOR)
+    monkeypatch.setattr(
+        runner_app,
+        "read_connector_index",
+        lambda tenant_id, connector_id, min_version=None: connector,
+    )
+    monkeypatch.setattr(runner_app, "http_pool", FakeSession())
+    monkeypatch.setattr(retries, "retry_budgets", LRUCache())
+    monkeypatch.setattr(FakeSession, "responses", {})
+    monkeypatch.setattr(FakeSession, "requests", [])
+    return SimpleNamespace(history=history_table, main=main_table)
+
+
+def make_runner(actions: list[dict], source_input: dict = None, **kwargs):
+    return WorkflowRunnerV1(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input=source_input or {},
+        actions=actions,
+        **kwargs,
+    )
+
+
+def test_runner_connector_actions(runner_env):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        body={"id": 1, "name": "Mac"}
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1}, "new_name": "Renamed"},
+        actions=[
+            {
+                "connector_id": "connector",
+                "type": "RenameDevice",
+                "order": 2,
+                "parameters": {"device_id": "::device.id", "name": "::new_name"},
+            },
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+                "transform": {"device.name": "::name"},
+            },
+        ],
+    )
+    runner.run()
+
+    assert [(r["method"], r["url"]) for r in FakeSession.requests] == [
+        ("get", "https://api.example.com/v1/devices/1"),
+        ("put", "https://api.example.com/v1/devices/1"),
+    ]
+    assert FakeSession.requests[1]["json"] == {"name": "Renamed"}
+    assert runner.state["device"] == {"id": 1, "name": "Mac"}
+    assert runner_env.history.items[-1]["status"] == "successful"
+    assert runner_env.main.updates
+
+
+def test_runner_reads_connector_version(runner_env, monkeypatch):
+    reads = []
+    connector = ConnectorIndex.from_connector(CONNECTOR)
+
+    def read_connector_index(tenant_id, connector_id, min_version=None):
+        reads.append(min_version)
+        return connector
+
+    monkeypatch.setattr(runner_app, "read_connector_index", read_connector_index)
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            dict(get_device_action(), connector_version=3),
+            dict(get_device_action(), order=2),
+        ],
+    ).run()
+
+    # A cached connector older than the version the action was created with is read again
+    assert reads == [3, None]
+
+
+def test_runner_history_write_failure(runner_env, monkeypatch):
+    # Every history item of the run "bad" is left unprocessed
+    def batch_write_item(RequestItems):
+        requests = RequestItems["table"]
+        runner_env.history.items.extend(
+            i["PutRequest"]["Item"]
+            for i in requests
+            if "#bad#" not in i["PutRequest"]["Item"]["sk"]
+        )
+        unprocessed = [i for i in requests if "#bad#" in i["PutRequest"]["Item"]["sk"]]
+        return {"UnprocessedItems": {"table": unprocessed} if unprocessed else {}}
+
+    monkeypatch.setattr(runner_env.history, "batch_write_item", batch_write_item)
+    monkeypatch.setattr(
+        runner_app,
+        "history_writer",
+        HistoryWriter(runner_env.history, max_attempts=1, max_item_failures=2),
+    )
+
+    for run_id in ("bad", "good"):
+        # The write error does not replace the run's result
+        WorkflowRunnerV1(
+            tenant_id="tenant",
+            workflow_id="workflow",
+            workflow_version=1,
+            run_id=run_id,
+            source_input={"device": {"id": 1}},
+            actions=[get_device_action()],
+        ).run()
+
+    # The items that keep failing are dropped; later runs' history is written
+    assert runner_app.history_writer.pending() == 0
+    assert {i["sk"].split("#")[-2] for i in runner_env.history.items} == {"good"}
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_action_refreshes_rejected_auth(runner_env, monkeypatch):
+    connector = ConnectorIndex.from_connector(
+        dict(CONNECTOR, credentials={"KeyId": "key", "CiphertextBlob": b""})
+    )
+    monkeypatch.setattr(
+        runner_app,
+        "read_connector_index",
+        lambda tenant_id, connector_id, min_version=None: connector,
+    )
+    monkeypatch.setattr(
+        runner_app, "auth_headers", lambda credentials: {"Authorization": "Bearer old"}
+    )
+    monkeypatch.setattr(
+        runner_app,
+        "refresh_auth_headers",
+        lambda credentials, stale_headers: {"Authorization": "Bearer new"},
+    )
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = lambda request: (
+        FakeResponse(body={"id": 1})
+        if request["headers"]["Authorization"] == "Bearer new"
+        else FakeResponse(status_code=401)
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+            }
+        ],
+    )
+    runner.run()
+
+    assert [r["headers"]["Authorization"] for r in FakeSession.requests] == [
+        "Bearer old",
+        "Bearer new",
+    ]
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_action_failed(runner_env):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        status_code=404
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+            }
+        ],
+    )
+    runner.run()
+
+    assert runner_env.history.items[-1]["status"] == "failed"
+    assert runner_env.history.items[-1]["action"]["type"] == "GetDevice"
+
+
+def responses(*responses: FakeResponse):
+    """Return the responses in order, then the last one for every other request."""
+    pending = list(responses)
+    return lambda request: pending.pop(0) if len(pending) > 1 else pending[0]
+
+
+def get_device_action(**on_error) -> dict:
+    action = {
+        "connector_id": "connector",
+        "type": "GetDevice",
+        "order": 1,
+        "parameters": {"device_id": "::device.id"},
+        "transform": {"device.name": "::name"},
+    }
+    if on_error:
+        action["on_error"] = on_error
+    return action
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(runner_app.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.mark.parametrize("on_fail, status", [(None, "failed"), ("skip", "successful")])
+def test_runner_nested_retry_not_past_deadline(runner_env, sleeps, on_fail, status):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = responses(
+        FakeResponse(status_code=503),
+        FakeResponse(status_code=429, headers={"Retry-After": "600"}),
+        FakeResponse(body={"id": 1, "name": "Mac"}),
+    )
+    item_action = dict(
+        get_device_action(
+            max_retries=3, backoff={"wait": 1, "rate": 1}, on_fail=on_fail
+        ),
+        parameters={"device_id": "::id"},
+        transform={"name": "::name"},
+    )
+    runner = make_runner(
+        source_input={"devices": [{"id": 1}]},
+        actions=[iterator_action(actions=[item_action])],
+        resumable=True,
+        deadline=time.monotonic() + runner_app.CHECKPOINT_MARGIN + 300,
+    )
+    runner.run()
+
+    # Iterator items can't be suspended: a backoff past the deadline fails the action
+    # instead of sleeping
+    assert len(FakeSession.requests) == 2
+    assert len(sleeps) == 1 and sleeps[0] <= 1
+    item_statuses = [
+        i["status"] for i in runner_env.history.items if "nested_run_id" in i
+    ]
+    assert item_statuses[-1] == status
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_action_retries(runner_env, sleeps):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = responses(
+        FakeResponse(status_code=503),
+        FakeResponse(status_code=429, headers={"Retry-After": "7"}),
+        FakeResponse(body={"id": 1, "name": "Mac"}),
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            get_device_action(max_retries=3, backoff={"wait": 2, "rate": 2}),
+            dict(WAIT_WORKFLOW[2], order=2),
+        ],
+    )
+    runner.run()
+
+    assert len(FakeSession.requests) == 4
+    assert runner.state["device"]["name"] == "Mac"
+    assert runner_env.history.items[-1]["status"] == "successful"
+    # Full jitter below the backoff cap; the Retry-After delay is waited at least
+    assert 0 <= sleeps[0] <= 2
+    assert 7 <= sleeps[1] <= 7 + 4
+    assert [
+        i["reason"]["attempt"] for i in runner_env.history.items if i["reason"]
+    ] == [
+        1,
+        2,
+    ]
+
+
+@pytest.mark.parametrize(
+    "on_error, requests_sent",
+    [
+        (None, 1),
+        ({"max_retries": 2}, 1),
+        ({"max_retries": 2, "retry_on": ["404"]}, 3),
+    ],
+)
+def test_runner_action_retry_on(runner_env, sleeps, on_error, requests_sent):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        status_code=404
+    )
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[get_device_action(**(on_error or {}))],
+    ).run()
+
+    assert len(FakeSession.requests) == requests_sent
+    assert runner_env.history.items[-1]["status"] == "failed"
+    assert runner_env.history.items[-1]["reason"]["response"] == "{}"
+
+
+@pytest.mark.parametrize(
+    "on_fail, status", [("skip", "successful"), ("stop", "stopped")]
+)
+def test_runner_action_on_fail(runner_env, sleeps, on_fail, status):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        status_code=500
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            get_device_action(max_retries=1, on_fail=on_fail),
+            dict(WAIT_WORKFLOW[2], order=2, parameters={"device_id": 2}),
+        ],
+    )
+    runner.run()
+
+    assert runner_env.history.items[-1]["status"] == status
+    assert "name" not in runner.state["device"]
+    if on_fail == "skip":
+        assert FakeSession.requests[-1]["method"] == "put"
+    else:
+        assert len(FakeSession.requests) == 2
+
+
+def test_runner_action_retry_budget(runner_env, sleeps):
+    retries.retry_budgets.set(
+        ("tenant", "connector"), retries.RetryBudget(ratio=0, capacity=2)
+    )
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        status_code=503
+    )
+
+    for _ in range(2):
+        make_runner(
+            source_input={"device": {"id": 1}},
+            actions=[get_device_action(max_retries=10)],
+        ).run()
+
+    # The connector's budget allows two retries for both runs
+    assert len(FakeSession.requests) == 4
+    assert len(sleeps) == 2
+
+
+def test_runner_action_connection_error(runner_env, sleeps):
+    def connection_error(request):
+        raise requests.ConnectionError("Connection refused")
+
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = connection_error
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[get_device_action(max_retries=1)],
+    ).run()
+
+    assert len(FakeSession.requests) == 2
+    assert runner_env.history.items[-1]["status"] == "failed"
+    assert runner_env.history.items[-1]["reason"]["response"] is None
+
+
+def test_runner_workflow_on_error(runner_env, sleeps, monkeypatch):
+    monkeypatch.setattr(runner_app, "workflow_plan_cache", LRUCache())
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = responses(
+        FakeResponse(status_code=502), FakeResponse(body={"id": 1, "name": "Mac"})
+    )
+    workflow = compile_workflow(
+        "tenant",
+        "workflow",
+        1,
+        [get_device_action()],
+        on_error={"max_retries": 1},
+    )
+
+    make_runner(source_input={"device": {"id": 1}}, actions=workflow).run()
+
+    # Actions without `on_error` use the workflow's options and backoff defaults
+    assert workflow.actions[0].retry_policy.wait == 30
+    assert len(FakeSession.requests) == 2
+    assert 0 <= sleeps[0] <= 30
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_action_timeout(runner_env):
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            get_device_action(),
+            dict(WAIT_WORKFLOW[2], order=2, timeout=30),
+        ],
+    ).run()
+
+    # Connect and read timeouts
+    assert [r["timeout"] for r in FakeSession.requests] == [(3, 3), (3.05, 30)]
+
+
+def test_runner_action_timeout_shrinks_with_deadline(runner_env):
+    runner = make_runner(
+        source_input={"devices": [{"id": 1}, {"id": 2}]},
+        actions=[
+            dict(
+                iterator_action(),
+                parameters=dict(
+                    iterator_action()["parameters"],
+                    actions=[dict(get_device_action(), timeout=120)],
+                ),
+            )
+        ],
+        deadline=time.monotonic() + runner_app.ACTION_DEADLINE_RESERVE + 10,
+    )
+    runner.run()
+
+    # Iterator items' requests, and their wait for a connection, end before the invocation
+    # does
+    for request in FakeSession.requests:
+        connect_timeout, read_timeout = request["timeout"]
+        assert connect_timeout == 3.05
+        assert 8 < read_timeout <= 10
+        assert 8 < request["max_time"] <= 10
+
+
+@pytest.mark.parametrize(
+    "response, error_type",
+    [
+        (requests.ReadTimeout("Read timed out"), "timeout"),
+        (PoolTimeout("No request slot"), "timeout"),
+        (requests.ConnectionError("Connection refused"), "connection"),
+        (FakeResponse(status_code=500), "http"),
+    ],
+)
+def test_runner_action_error_types(runner_env, sleeps, response, error_type):
+    def send(request):
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = send
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[get_device_action(max_retries=1)],
+    ).run()
+
+    # Timeouts are told apart from error responses in history
+    retry, failed = runner_env.history.items[-2:]
+    assert retry["reason"]["error_type"] == error_type
+    assert failed["status"] == "failed"
+    assert failed["reason"]["error_type"] == error_type
+
+
+def test_runner_action_after_deadline(runner_env):
+    make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[get_device_action()],
+        deadline=time.monotonic() + runner_app.ACTION_DEADLINE_RESERVE - 1,
+    ).run()
+
+    # A request that can't complete before the invocation times out is not sent
+    assert not FakeSession.requests
+    assert runner_env.history.items[-1]["reason"]["error_type"] == "timeout"
+
+
+def test_runner_iterator(runner_env):
+    runner = make_runner(
+        source_input={"devices": [{"id": 1}, {"id": 2}]},
+        actions=[
+            {
+                "type": "Flexli:CoreV1:Iterator",
+                "order": 1,
+                "parameters": {
+                    "array_path": "::devices",
+                    "actions": [
+                        {
+                            "connector_id": "connector",
+                            "type": "RenameDevice",
+                            "order": 1,
+                            "parameters": {
+                                "device_id": "::id",
+                                "name": "::flexli_iterator_value().id",
+                            },
+                        }
+                    ],
+                },
+            }
+        ],
+    )
+    runner.run()
+
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/1",
+        "https://api.example.com/v1/devices/2",
+    ]
+    assert [r["json"] for r in FakeSession.requests] == [{"name": 1}, {"name": 2}]
+    assert flexli_globals.ITERATOR_VALUE.get() is None
+    nested_runs = {
+        i["nested_run_id"] for i in runner_env.history.items if "nested_run_id" in i
+    }
+    assert len(nested_runs) == 2
+
+
+def name_condition(name: str) -> dict:
+    return {
+        "criteria": [
+            {
+                "attributes": [
+                    {
+                        "type": "String",
+                        "attribute": "::device.name",
+                        "operator": "eq",
+                        "value": name,
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def branch_action(*branches: tuple, exclusive: bool = True) -> dict:
+    """A branch action of ``(order, condition, device_id, key)`` branches. Each branch gets
+    the device and sets its name at the key.
+    """
+    return {
+        "type": "Flexli:CoreV1:Branch",
+        "order": 1,
+        "parameters": {
+            "exclusive": exclusive,
+            "branches": [
+                dict(
+                    {
+                        "order": order,
+                        "actions": [
+                            {
+                                "connector_id": "connector",
+                                "type": "GetDevice",
+                                "order": 1,
+                                "parameters": {"device_id": device_id},
+                                "transform": {key: "::name"},
+                            }
+                        ],
+                    },
+                    **({"condition": condition} if condition else {}),
+                )
+                for order, condition, device_id, key in branches
+            ],
+        },
+    }
+
+
+def test_runner_branch_exclusive(runner_env):
+    FakeSession.responses["https://api.example.com/v1/devices/2"] = FakeResponse(
+        body={"name": "Device 2"}
+    )
+    runner = make_runner(
+        source_input={"device": {"id": 1, "name": "Mac"}},
+        actions=[
+            branch_action(
+                (1, name_condition("PC"), 1, "pc"),
+                (2, name_condition("Mac"), 2, "mac"),
+                (3, None, 3, "other"),
+            )
+        ],
+    )
+    runner.run()
+
+    # Only the first branch whose condition is met runs
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/2"
+    ]
+    assert runner.state == {"device": {"id": 1, "name": "Mac"}, "mac": "Device 2"}
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_branch_concurrent(runner_env, monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+    request = FakeSession.request
+
+    def concurrent_request(self, **kwargs):
+        barrier.wait()
+        return request(self, **kwargs)
+
+    monkeypatch.setattr(FakeSession, "request", concurrent_request)
+    FakeSession.responses.update(
+        {
+            f"https://api.example.com/v1/devices/{i}": FakeResponse(
+                body={"name": f"Device {i}"}
+            )
+            for i in range(1, 5)
+        }
+    )
+
+    runner = make_runner(
+        source_input={"device": {"id": 1, "name": "Mac"}},
+        actions=[
+            branch_action(
+                (4, None, 4, "device.name"),
+                (2, name_condition("PC"), 2, "pc"),
+                (1, name_condition("Mac"), 1, "device.name"),
+                (3, None, 3, "other"),
+                exclusive=False,
+            )
+        ],
+    )
+    runner.run()
+
+    # Every branch whose condition is met runs at the same time
+    assert sorted(r["url"] for r in FakeSession.requests) == [
+        "https://api.example.com/v1/devices/1",
+        "https://api.example.com/v1/devices/3",
+        "https://api.example.com/v1/devices/4",
+    ]
+    # Changes are merged in branch order: the last branch's change to a value is kept
+    assert runner.state == {
+        "device": {"id": 1, "name": "Device 4"},
+        "other": "Device 3",
+    }
+    nested_runs = {
+        i["nested_run_id"] for i in runner_env.history.items if "nested_run_id" in i
+    }
+    assert len(nested_runs) == 3
+
+
+@pytest.mark.parametrize("runner_class", [WorkflowRunnerV1, AsyncWorkflowRunnerV1])
+def test_runner_branch_max_concurrency(runner_env, monkeypatch, runner_class):
+    monkeypatch.setattr(runner_app, "BRANCH_MAX_CONCURRENCY", 2)
+    lock = threading.Lock()
+    active = []
+    peak = []
+    request = FakeSession.request
+
+    def concurrent_request(self, **kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.pop()
+        return request(self, **kwargs)
+
+    monkeypatch.setattr(FakeSession, "request", concurrent_request)
+
+    result = runner_class(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input={"device": {"id": 1, "name": "Mac"}},
+        actions=[
+            branch_action(
+                *((i, None, i, f"d{i}") for i in range(1, 6)), exclusive=False
+            )
+        ],
+    ).run()
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+    assert len(FakeSession.requests) == 5
+    assert max(peak) == 2
+
+
+def update_branch(order: int, device_id: int, transform: dict) -> dict:
+    return {
+        "order": order,
+        "actions": [
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": device_id},
+                "transform": transform,
+            }
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "first, second, merged",
+    [
+        # Lists of different lengths
+        ({"x": "::x"}, {"x": "::y"}, {"x": [7, 8], "a": {"b": 1, "c": 1}}),
+        # A value replaced by one branch and a value in it changed by the other
+        ({"a": "::x"}, {"a.b": "::b"}, {"x": [1, 2, 3], "a": {"b": 2, "c": 1}}),
+        ({"a.b": "::b"}, {"a": "::x"}, {"x": [1, 2, 3], "a": [9]}),
+    ],
+)
+def test_runner_branch_merge_conflicts(runner_env, first, second, merged):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        body={"x": [9], "b": 2}
+    )
+    FakeSession.responses["https://api.example.com/v1/devices/2"] = FakeResponse(
+        body={"x": [9], "y": [7, 8], "b": 2}
+    )
+
+    runner = make_runner(
+        source_input={"x": [1, 2, 3], "a": {"b": 1, "c": 1}},
+        actions=[
+            {
+                "type": "Flexli:CoreV1:Branch",
+                "order": 1,
+                "parameters": {
+                    "exclusive": False,
+                    "branches": [
+                        update_branch(1, 1, first),
+                        update_branch(2, 2, second),
+                    ],
+                },
+            }
+        ],
+    )
+    runner.run()
+
+    # The change of the last branch is kept
+    assert runner.state == merged
+    assert runner_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_branch_state_with_transform_key(runner_env):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        body={"name": "Device 1"}
+    )
+    runner = make_runner(
+        actions=[branch_action((1, None, 1, "name"))],
+        checkpoint={
+            "cursor": 0,
+            "history_seq": 0,
+            "state": {"device": {"id": 1}, "transform": {"device": "::name"}},
+        },
+    )
+    runner.run()
+
+    # The state of a branch is not transformed as a source input
+    assert runner.state == {
+        "device": {"id": 1},
+        "transform": {"device": "::name"},
+        "name": "Device 1",
+    }
+
+
+def test_runner_branch_failed(runner_env):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        status_code=404
+    )
+    FakeSession.responses["https://api.example.com/v1/devices/2"] = FakeResponse(
+        body={"name": "Device 2"}
+    )
+
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            branch_action(
+                (1, None, 1, "first"), (2, None, 2, "second"), exclusive=False
+            )
+        ],
+    )
+    runner.run()
+
+    # The changes of a failed branch are discarded
+    assert runner.state == {"device": {"id": 1}, "second": "Device 2"}
+    statuses = [i["status"] for i in runner_env.history.items]
+    assert "failed" in statuses
+    assert statuses[-1] == "successful"
+
+
+class FakeSqsClient:
+    def __init__(self):
+        self.messages = []
+        self.delays = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self.messages.append(json.loads(MessageBody))
+        self.delays.append(DelaySeconds)
+        return {"MessageId": str(len(self.messages))}
+
+
+def iterator_action(**parameters) -> dict:
+    return {
+        "type": "Flexli:CoreV1:Iterator",
+        "order": 1,
+        "parameters": dict(
+            {
+                "array_path": "::devices",
+                "actions": [
+                    {
+                        "connector_id": "connector",
+                        "type": "GetDevice",
+                        "order": 1,
+                        "parameters": {"device_id": "::id"},
+                    }
+                ],
+            },
+            **parameters,
+        ),
+    }
+
+
+def test_runner_iterator_max_concurrency(runner_env, monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+    request = FakeSession.request
+
+    def concurrent_request(self, **kwargs):
+        barrier.wait()
+        return request(self, **kwargs)
+
+    monkeypatch.setattr(FakeSession, "request", concurrent_request)
+
+    runner = make_runner(
+        source_input={"devices": [{"id": 1}, {"id": 2}, {"id": 3}]},
+        actions=[iterator_action(max_concurrency=5)],
+    )
+    runner.run()
+
+    assert sorted(r["url"] for r in FakeSession.requests) == [
+        "https://api.example.com/v1/devices/1",
+        "https://api.example.com/v1/devices/2",
+        "https://api.example.com/v1/devices/3",
+    ]
+    assert runner_env.history.items[-1]["status"] == "successful"
+    assert sum(i["status"] == "successful" for i in runner_env.history.items) == 4
+
+
+def test_lambda_handler_thread_budget(runner_env, monkeypatch):
+    """Iterators of concurrently processed runs share the invocation's threads."""
+    monkeypatch.setattr(runner_app, "thread_budget", runner_app.ThreadBudget(4))
+    monkeypatch.setattr(
+        runner_app,
+        "processor",
+        ConcurrentBatchProcessor(event_type=EventType.SQS, max_workers=3),
+    )
+    lock = threading.Lock()
+    active = []
+    peak = []
+    request = FakeSession.request
+
+    def concurrent_request(self, **kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.pop()
+        return request(self, **kwargs)
+
+    monkeypatch.setattr(FakeSession, "request", concurrent_request)
+    body = {
+        "tenant_id": "tenant",
+        "workflow_id": "workflow",
+        "workflow_version": 1,
+        "source_input": {"devices": [{"id": i} for i in range(4)]},
+        "actions": [iterator_action(max_concurrency=4)],
+    }
+
+    response = runner_app.lambda_handler(
+        {
+            "Records": [
+                sqs_record(str(i), json.dumps(dict(body, run_id=f"run-{i}")))
+                for i in range(3)
+            ]
+        },
+        SimpleNamespace(),
+    )
+
+    assert response == {"batchItemFailures": []}
+    assert len(FakeSession.requests) == 12
+    assert max(peak) <= 4
+    assert runner_app.thread_budget.available == 4
+
+
+def test_thread_budget():
+    budget = runner_app.ThreadBudget(5)
+
+    with budget.threads(3) as outer:
+        # A pool of a single thread is not started
+        with budget.threads(3) as inner, budget.threads(3) as none:
+            assert (outer, inner, none) == (3, 2, 0)
+            assert budget.available == 0
+
+    assert budget.available == 5
+
+
+def test_runner_iterator_fan_out(runner_env, monkeypatch):
+    sqs_client = FakeSqsClient()
+    monkeypatch.setattr(runner_app, "sqs_client", sqs_client)
+
+    runner = make_runner(
+        source_input={"devices": [{"id": i} for i in range(5)]},
+        actions=[iterator_action(max_concurrency=2, fan_out_chunk_size=2)],
+    )
+    runner.run()
+
+    assert not FakeSession.requests
+    assert [m["source_input"]["items"] for m in sqs_client.messages] == [
+        [{"id": 0}, {"id": 1}],
+        [{"id": 2}, {"id": 3}],
+        [{"id": 4}],
+    ]
+    assert all(m["parent_run_id"] == "run" for m in sqs_client.messages)
+
+    # A chunk is run as a nested iterator over its items
+    chunk = sqs_client.messages[0]
+    make_runner(
+        source_input=chunk["source_input"],
+        actions=chunk["actions"],
+        parent_run_id=chunk["parent_run_id"],
+    ).run()
+
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/0",
+        "https://api.example.com/v1/devices/1",
+    ]
+
+
+def test_runner_iterator_fan_out_retries(runner_env, monkeypatch, sleeps):
+    sqs_client = FakeSqsClient()
+    monkeypatch.setattr(runner_app, "sqs_client", sqs_client)
+    FakeSession.responses["https://api.example.com/v1/devices/0"] = responses(
+        FakeResponse(status_code=503), FakeResponse(body={"id": 0})
+    )
+
+    make_runner(
+        source_input={"devices": [{"id": i} for i in range(3)]},
+        actions=CompiledWorkflow(
+            [iterator_action(fan_out_chunk_size=2)],
+            retry_policy=retries.RetryPolicy.from_on_error(
+                {"max_retries": 2, "backoff": {"wait": 1}}, wait=30, rate=2.5
+            ),
+        ),
+    ).run()
+
+    # Chunks are retried with the workflow's on_error options
+    chunk = sqs_client.messages[0]
+    assert chunk["on_error"]["max_retries"] == 2
+    runner = runner_app.create_runner(
+        SQSRecord(sqs_record("1", run_message_body(chunk, store=None)))
+    )
+    assert runner.workflow.retry_policy == retries.RetryPolicy(
+        max_retries=2, wait=1, rate=2.5
+    )
+    runner.run()
+
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/0",
+        "https://api.example.com/v1/devices/0",
+        "https://api.example.com/v1/devices/1",
+    ]
+    assert len(sleeps) == 1
+
+
+def test_runner_condition_on_fail(runner_env):
+    condition = {
+        "criteria": [
+            {
+                "attributes": [
+                    {
+                        "type": "Number",
+                        "attribute": "::device.id",
+                        "operator": "gt",
+                        "value": 1,
+                    }
+                ]
+            }
+        ],
+    }
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=[
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "condition": dict(condition, on_fail="skip"),
+                "parameters": {"device_id": "::device.id"},
+            },
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 2,
+                "condition": dict(condition, on_fail="stop"),
+                "parameters": {"device_id": "::device.id"},
+            },
+        ],
+    )
+    runner.run()
+
+    assert not FakeSession.requests
+    assert runner_env.history.items[-1]["status"] == "stopped"
+
+
+PARITY_WORKFLOWS = {
+    "connector_actions": (
+        {"device": {"id": 1}, "new_name": "Renamed"},
+        [
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+                "transform": {"device.name": "::name"},
+            },
+            {
+                "type": "Flexli:CoreV1:Wait",
+                "order": 2,
+                "parameters": {"seconds": 0},
+            },
+            {
+                "connector_id": "connector",
+                "type": "RenameDevice",
+                "order": 3,
+                "condition": {
+                    "criteria": [
+                        {
+                            "attributes": [
+                                {
+                                    "type": "String",
+                                    "attribute": "::device.name",
+                                    "operator": "eq",
+                                    "value": "Mac",
+                                }
+                            ]
+                        }
+                    ],
+                    "on_fail": "skip",
+                },
+                "parameters": {"device_id": "::device.id", "name": "::new_name"},
+                "transform": {"renamed": "::name"},
+            },
+        ],
+    ),
+    "iterator": (
+        {"devices": [{"id": i} for i in range(1, 6)]},
+        [
+            dict(iterator_action(max_concurrency=3), order=1),
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 2,
+                "parameters": {"device_id": "::devices[-1].id"},
+                "transform": {"last": "::name"},
+            },
+        ],
+    ),
+    "branch": (
+        {"device": {"id": 1, "name": "Mac"}},
+        [
+            branch_action(
+                (1, name_condition("Mac"), 2, "device.name"),
+                (2, name_condition("PC"), 3, "pc"),
+                (3, None, 4, "last"),
+                exclusive=False,
+            ),
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 2,
+                "parameters": {"device_id": "::device.id"},
+                "transform": {"first": "::name"},
+            },
+        ],
+    ),
+    "condition_stop": (
+        {"device": {"id": 1}},
+        [
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "condition": {
+                    "criteria": [
+                        {
+                            "attributes": [
+                                {
+                                    "type": "Number",
+                                    "attribute": "::device.id",
+                                    "operator": "gt",
+                                    "value": 1,
+                                }
+                            ]
+                        }
+                    ],
+                    "on_fail": "stop",
+                },
+                "parameters": {"device_id": "::device.id"},
+            }
+        ],
+    ),
+}
+
+
+@pytest.mark.parametrize("workflow", PARITY_WORKFLOWS)
+def test_async_runner_parity(runner_env, workflow):
+    source_input, actions = PARITY_WORKFLOWS[workflow]
+    FakeSession.responses.update(
+        {
+            f"https://api.example.com/v1/devices/{i}": FakeResponse(
+                body={"id": i, "name": "Mac" if i == 1 else f"Device {i}"}
+            )
+            for i in range(1, 6)
+        }
+    )
+
+    def run(runner_class) -> tuple:
+        FakeSession.requests.clear()
+        runner_env.history.items.clear()
+        runner = runner_class(
+            tenant_id="tenant",
+            workflow_id="workflow",
+            workflow_version=1,
+            run_id="run",
+            source_input=source_input,
+            actions=copy.deepcopy(actions),
+        )
+        result = runner.run()
+        if runner_class is AsyncWorkflowRunnerV1:
+            asyncio.run(result)
+
+        return (
+            runner.state,
+            sorted((r["method"], r["url"]) for r in FakeSession.requests),
+            sorted(i["status"] for i in runner_env.history.items),
+            runner_env.history.items[-1]["status"],
+        )
+
+    assert run(AsyncWorkflowRunnerV1) == run(WorkflowRunnerV1)
+
+
+@pytest.mark.parametrize("workflow", PARITY_WORKFLOWS)
+def test_runner_history_state_diffs(runner_env, monkeypatch, workflow):
+    source_input, actions = PARITY_WORKFLOWS[workflow]
+    FakeSession.responses.update(
+        {
+            f"https://api.example.com/v1/devices/{i}": FakeResponse(
+                body={"id": i, "name": "Mac" if i == 1 else f"Device {i}"}
+            )
+            for i in range(1, 6)
+        }
+    )
+    monkeypatch.setattr(runner_app, "HISTORY_SNAPSHOT_INTERVAL", 2)
+
+    def history_states(mode: str) -> list:
+        monkeypatch.setattr(runner_app, "HISTORY_STATE_MODE", mode)
+        runner_env.history.items.clear()
+        make_runner(source_input=source_input, actions=copy.deepcopy(actions)).run()
+
+        items = runner_env.history.items
+        if mode == "snapshot":
+            assert not any("state_diff" in i for i in items)
+        return sorted(
+            json.dumps(i.get("state"), sort_keys=True)
+            for i in rebuild_history_states(items)
+        )
+
+    assert history_states("diff") == history_states("snapshot")
+
+
+def test_async_runner_interleaves_runs(runner_env):
+    """Every run must be waiting at the same time for the gather to finish."""
+
+    async def run_all():
+        runners = [
+            AsyncWorkflowRunnerV1(
+                tenant_id="tenant",
+                workflow_id="workflow",
+                workflow_version=1,
+                run_id=f"run-{i}",
+                source_input={},
+                actions=[
+                    {
+                        "type": "Flexli:CoreV1:Wait",
+                        "order": 1,
+                        "parameters": {"seconds": 1},
+                    }
+                ],
+            )
+            for i in range(20)
+        ]
+        await asyncio.wait_for(asyncio.gather(*(r.run() for r in runners)), 5)
+
+    started = time.monotonic()
+    asyncio.run(run_all())
+
+    assert time.monotonic() - started < 3
+    assert sum(i["status"] == "successful" for i in runner_env.history.items) == 20
+
+
+def test_lambda_handler_async_mode(runner_env, monkeypatch):
+    monkeypatch.setattr(runner_app, "RUNNER_MODE", "async")
+    body = {
+        "tenant_id": "tenant",
+        "workflow_id": "workflow",
+        "workflow_version": 1,
+        "run_id": "run",
+        "source_input": {"device": {"id": 1}},
+        "actions": [
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+            }
+        ],
+    }
+
+    response = runner_app.lambda_handler(
+        {
+            "Records": [
+                sqs_record("1", json.dumps(body)),
+                sqs_record("2", "not json"),
+            ]
+        },
+        SimpleNamespace(),
+    )
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/1"
+    ]
+
+
+@pytest.fixture
+def lambda_event_loop(monkeypatch):
+    """Batches are run on the current event loop, as they are in Lambda."""
+    monkeypatch.setenv("LAMBDA_TASK_ROOT", "/var/task")
+    yield
+    asyncio.get_event_loop().close()
+    asyncio.set_event_loop(None)
+
+
+def test_lambda_handler_async_concurrency(runner_env, monkeypatch, lambda_event_loop):
+    monkeypatch.setattr(runner_app, "RUNNER_MODE", "async")
+    executor = ThreadPoolExecutor(max_workers=3)
+    monkeypatch.setattr(runner_app, "async_executor", executor)
+    lock = threading.Lock()
+    active = []
+    peak = []
+    request = FakeSession.request
+
+    def concurrent_request(self, **kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+        return request(self, **kwargs)
+
+    monkeypatch.setattr(FakeSession, "request", concurrent_request)
+    body = {
+        "tenant_id": "tenant",
+        "workflow_id": "workflow",
+        "workflow_version": 1,
+        "source_input": {"device": {"id": 1}},
+        "actions": [
+            {
+                "connector_id": "connector",
+                "type": "GetDevice",
+                "order": 1,
+                "parameters": {"device_id": "::device.id"},
+            }
+        ],
+    }
+
+    response = runner_app.lambda_handler(
+        {
+            "Records": [
+                sqs_record(str(i), json.dumps(dict(body, run_id=f"run-{i}")))
+                for i in range(8)
+            ]
+        },
+        SimpleNamespace(),
+    )
+    executor.shutdown()
+
+    # Blocking calls of the runs are bounded by the executor
+    assert response == {"batchItemFailures": []}
+    assert len(FakeSession.requests) == 8
+    assert 1 < max(peak) <= 3
+
+
+def test_lambda_handler_offloaded_payloads(runner_env, monkeypatch, tmp_path):
+    store = LocalPayloadStore(str(tmp_path))
+    monkeypatch.setattr(payload_store, "get_payload_store", lambda prefix=None: store)
+    body = run_message_body(
+        {
+            "tenant_id": "tenant",
+            "workflow_id": "workflow",
+            "workflow_version": 1,
+            "run_id": "run",
+            "source_input": {"device": {"id": 1}},
+            "actions": [
+                {
+                    "connector_id": "connector",
+                    "type": "GetDevice",
+                    "order": 1,
+                    "parameters": {"device_id": "::device.id"},
+                }
+            ],
+        },
+        threshold=0,
+    )
+    assert set(json.loads(body)["payloads"]) == {"source_input", "actions"}
+
+    response = runner_app.lambda_handler(
+        {"Records": [sqs_record("1", body)]}, SimpleNamespace()
+    )
+
+    assert response == {"batchItemFailures": []}
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/1"
+    ]
+
+
+def test_lambda_handler_reads_referenced_workflow_versions(runner_env, monkeypatch):
+    requests = []
+
+    def batch_get_item(RequestItems):
+        keys = RequestItems[workflows.TABLE_NAME]["Keys"]
+        requests.append(keys)
+        return {
+            "Responses": {
+                workflows.TABLE_NAME: [
+                    dict(
+                        key,
+                        actions=[
+                            {
+                                "connector_id": "connector",
+                                "type": "GetDevice",
+                                "order": 1,
+                                "parameters": {"device_id": "::device.id"},
+                            }
+                        ],
+                    )
+                    for key in keys
+                ]
+            }
+        }
+
+    monkeypatch.setattr(
+        workflows,
+        "dynamodb_table",
+        SimpleNamespace(
+            meta=SimpleNamespace(client=SimpleNamespace(batch_get_item=batch_get_item))
+        ),
+    )
+    monkeypatch.setattr(workflows, "workflow_definition_cache", LRUCache())
+    records = [
+        sqs_record(
+            str(i),
+            json.dumps(
+                {
+                    "tenant_id": "tenant",
+                    "workflow_id": "workflow",
+                    "workflow_version": 1,
+                    "run_id": f"run-{i}",
+                    "source_input": {"device": {"id": i}},
+                }
+            ),
+        )
+        for i in (1, 2)
+    ]
+
+    response = runner_app.lambda_handler({"Records": records}, SimpleNamespace())
+
+    assert response == {"batchItemFailures": []}
+    # The batch's versions are read once, with BatchGetItem
+    assert requests == [[{"pk": "T#tenant#W#workflow", "sk": "V#1"}]]
+    assert sorted(r["url"] for r in FakeSession.requests) == [
+        "https://api.example.com/v1/devices/1",
+        "https://api.example.com/v1/devices/2",
+    ]
+
+
+WAIT_WORKFLOW = [
+    {
+        "connector_id": "connector",
+        "type": "GetDevice",
+        "order": 1,
+        "parameters": {"device_id": "::device.id"},
+        "transform": {"device.name": "::name"},
+    },
+    {
+        "type": "Flexli:CoreV1:Wait",
+        "order": 2,
+        "parameters": {"seconds": "::wait"},
+        "transform": {"waited": True},
+    },
+    {
+        "connector_id": "connector",
+        "type": "RenameDevice",
+        "order": 3,
+        "parameters": {"device_id": "::device.id", "name": "::device.name"},
+    },
+]
+
+
+@pytest.fixture
+def suspend_env(runner_env, monkeypatch):
+    """Run messages are sent to a fake queue, and waiting in place fails the test."""
+    runner_env.sqs = FakeSqsClient()
+    monkeypatch.setattr(runner_app, "sqs_client", runner_env.sqs)
+
+    def sleep(seconds):
+        if seconds > runner_app.WAIT_IN_PLACE_MAX:
+            raise AssertionError(f"Waited {seconds} seconds in place")
+
+    monkeypatch.setattr(runner_app.time, "sleep", sleep)
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        body={"id": 1, "name": "Mac"}
+    )
+    return runner_env
+
+
+def resume(message: dict) -> dict:
+    return runner_app.lambda_handler(
+        {"Records": [sqs_record("continuation", json.dumps(message))]},
+        SimpleNamespace(),
+    )
+
+
+def test_runner_wait_suspends_and_resumes(suspend_env, monkeypatch):
+    runner = make_runner(
+        source_input={"device": {"id": 1}, "wait": 600},
+        actions=WAIT_WORKFLOW,
+        resumable=True,
+    )
+    runner.run()
+
+    # The run is suspended after the wait action completes
+    assert len(FakeSession.requests) == 1
+    assert suspend_env.history.items[-1]["status"] == "waiting"
+    assert not suspend_env.main.updates
+    assert suspend_env.sqs.delays == [600]
+    message = suspend_env.sqs.messages[0]
+    assert message["run_id"] == "run"
+    assert message["actions"] == WAIT_WORKFLOW
+    assert message["checkpoint"]["cursor"] == 2
+    assert message["checkpoint"]["state"]["waited"] is True
+
+    now = time.time()
+    monkeypatch.setattr(runner_app.time, "time", lambda: now + 600)
+    assert resume(message) == {"batchItemFailures": []}
+
+    # Completed actions are not run again
+    assert [(r["method"], r["url"]) for r in FakeSession.requests] == [
+        ("get", "https://api.example.com/v1/devices/1"),
+        ("put", "https://api.example.com/v1/devices/1"),
+    ]
+    assert FakeSession.requests[1]["json"] == {"name": "Mac"}
+    assert suspend_env.history.items[-1]["status"] == "successful"
+    seqs = [i["seq"] for i in suspend_env.history.items]
+    assert seqs == sorted(set(seqs))
+    assert rebuild_history_states(suspend_env.history.items)[-2]["state"]["waited"]
+
+
+def test_runner_long_wait_is_continued(suspend_env, monkeypatch):
+    now = time.time()
+    clock = [now]
+    monkeypatch.setattr(runner_app.time, "time", lambda: clock[0])
+
+    make_runner(
+        source_input={"device": {"id": 1}, "wait": 2000},
+        actions=WAIT_WORKFLOW,
+        resumable=True,
+    ).run()
+
+    # A continuation is delayed for at most 15 minutes and suspends the run again until the
+    # wait is over
+    for elapsed in (900, 1800, 2000):
+        clock[0] = now + elapsed
+        resume(suspend_env.sqs.messages[-1])
+
+    assert suspend_env.sqs.delays == [900, 900, 200]
+    assert len(FakeSession.requests) == 2
+    assert suspend_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_wait_in_place(suspend_env, monkeypatch):
+    waits = []
+    monkeypatch.setattr(runner_app.time, "sleep", waits.append)
+
+    # Short waits, and waits in runs that are not resumable (iterator items), are not suspended
+    make_runner(
+        source_input={"device": {"id": 1}, "wait": 5}, actions=WAIT_WORKFLOW
+    ).run()
+    make_runner(
+        source_input={"device": {"id": 1}, "wait": 60}, actions=WAIT_WORKFLOW
+    ).run()
+
+    assert waits == [5, 60]
+    assert not suspend_env.sqs.messages
+    assert len(FakeSession.requests) == 4
+
+
+def test_async_runner_wait_suspends(suspend_env):
+    runner = AsyncWorkflowRunnerV1(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input={"device": {"id": 1}, "wait": 600},
+        actions=WAIT_WORKFLOW,
+        resumable=True,
+    )
+    asyncio.run(asyncio.wait_for(runner.run(), 5))
+
+    assert suspend_env.sqs.delays == [600]
+    assert suspend_env.sqs.messages[0]["checkpoint"]["cursor"] == 2
+    assert suspend_env.history.items[-1]["status"] == "waiting"
+
+
+@pytest.mark.parametrize("runner_class", [WorkflowRunnerV1, AsyncWorkflowRunnerV1])
+def test_runner_long_backoff_suspends(suspend_env, monkeypatch, runner_class):
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = responses(
+        FakeResponse(status_code=503, headers={"Retry-After": "120"}),
+        FakeResponse(body={"id": 1, "name": "Mac"}),
+    )
+    runner = runner_class(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input={"device": {"id": 1}},
+        actions=[get_device_action(max_retries=1)],
+        resumable=True,
+    )
+    result = runner.run()
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+    # The run is suspended for the backoff and the action is retried when it resumes
+    assert len(FakeSession.requests) == 1
+    assert 120 <= suspend_env.sqs.delays[0] <= 124
+    message = suspend_env.sqs.messages[0]
+    assert message["checkpoint"]["cursor"] == 0
+    assert message["checkpoint"]["progress"] == {"retry_attempt": 1}
+    assert suspend_env.history.items[-1]["reason"]["reason"] == "retry"
+
+    now = time.time()
+    monkeypatch.setattr(runner_app.time, "time", lambda: now + 125)
+    resume(message)
+
+    assert len(FakeSession.requests) == 2
+    assert suspend_env.history.items[-1]["status"] == "successful"
+
+
+@pytest.mark.parametrize("runner_class", [WorkflowRunnerV1, AsyncWorkflowRunnerV1])
+def test_runner_branch_wait_suspends(suspend_env, monkeypatch, runner_class):
+    for i in (2, 3):
+        FakeSession.responses[f"https://api.example.com/v1/devices/{i}"] = FakeResponse(
+            body={"name": f"Device {i}"}
+        )
+    action = branch_action(
+        (1, None, 2, "waited"), (2, None, 3, "other"), exclusive=False
+    )
+    action["parameters"]["branches"][0]["actions"].insert(
+        0,
+        {"type": "Flexli:CoreV1:Wait", "order": 0, "parameters": {"seconds": 600}},
+    )
+    result = runner_class(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input={"device": {"id": 1}},
+        # The next action's history update has the merged state
+        actions=[
+            action,
+            {"type": "Flexli:CoreV1:Wait", "order": 2, "parameters": {"seconds": 0}},
+        ],
+        resumable=True,
+    ).run()
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+    # The waiting branch is suspended with the run, after the other branch completes
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/3"
+    ]
+    assert suspend_env.sqs.delays == [600]
+    message = suspend_env.sqs.messages[0]
+    assert message["checkpoint"]["cursor"] == 0
+    assert message["checkpoint"]["reason"] == "branch"
+    waiting, completed = message["checkpoint"]["progress"]["branches"]
+    assert waiting["checkpoint"]["cursor"] == 1
+    assert completed["status"] == "successful"
+    assert suspend_env.history.items[-1]["status"] == "waiting"
+
+    now = time.time()
+    monkeypatch.setattr(runner_app.time, "time", lambda: now + 600)
+    assert resume(message) == {"batchItemFailures": []}
+
+    # Only the suspended branch is resumed, as the same nested run
+    assert [r["url"] for r in FakeSession.requests] == [
+        "https://api.example.com/v1/devices/3",
+        "https://api.example.com/v1/devices/2",
+    ]
+    assert suspend_env.history.items[-1]["status"] == "successful"
+    branch_updates = [
+        i
+        for i in suspend_env.history.items
+        if i.get("nested_run_id") == waiting["run_id"]
+    ]
+    assert branch_updates[-1]["status"] == "successful"
+    # Both branches' changes are merged
+    root_states = [
+        i["state"]
+        for i in rebuild_history_states(suspend_env.history.items)
+        if "nested_run_id" not in i and "state" in i
+    ]
+    assert root_states[-1] == {
+        "device": {"id": 1},
+        "waited": "Device 2",
+        "other": "Device 3",
+    }
+
+
+def test_runner_branch_wait_in_place(suspend_env, monkeypatch):
+    waits = []
+    monkeypatch.setattr(runner_app.time, "sleep", waits.append)
+    action = branch_action((1, None, 2, "waited"))
+    action["parameters"]["branches"][0]["actions"].insert(
+        0,
+        {"type": "Flexli:CoreV1:Wait", "order": 0, "parameters": {"seconds": 60}},
+    )
+
+    # Branches of a run that is not resumable (an iterator item) are not suspended
+    make_runner(source_input={"device": {"id": 1}}, actions=[action]).run()
+
+    assert waits == [60]
+    assert not suspend_env.sqs.messages
+    assert suspend_env.history.items[-1]["status"] == "successful"
+
+
+def lambda_context(remaining_seconds: float) -> SimpleNamespace:
+    return SimpleNamespace(
+        get_remaining_time_in_millis=lambda: int(remaining_seconds * 1000)
+    )
+
+
+def test_run_deadline():
+    deadline = runner_app.run_deadline(lambda_context(900))
+    assert deadline - time.monotonic() == pytest.approx(900, abs=1)
+    assert runner_app.run_deadline(SimpleNamespace()) is None
+
+
+def test_lambda_handler_checkpoints_at_deadline(suspend_env):
+    body = {
+        "tenant_id": "tenant",
+        "workflow_id": "workflow",
+        "workflow_version": 1,
+        "run_id": "run",
+        "source_input": {
+            "device": {"id": 1},
+            "transform": {"device_id": "::device.id"},
+        },
+        "actions": WAIT_WORKFLOW[:1] + WAIT_WORKFLOW[2:],
+    }
+
+    # Too little time is left to start the run
+    response = runner_app.lambda_handler(
+        {"Records": [sqs_record("1", json.dumps(body))]}, lambda_context(10)
+    )
+
+    assert response == {"batchItemFailures": []}
+    assert not FakeSession.requests
+    assert suspend_env.sqs.delays == [0]
+    checkpoint = suspend_env.sqs.messages[0]["checkpoint"]
+    assert checkpoint["cursor"] == 0
+    assert checkpoint["state"] == {"device_id": 1}
+    assert suspend_env.history.items[-1]["reason"]["reason"] == "deadline"
+
+    runner_app.lambda_handler(
+        {"Records": [sqs_record("2", json.dumps(suspend_env.sqs.messages[0]))]},
+        lambda_context(900),
+    )
+    assert len(FakeSession.requests) == 2
+    assert suspend_env.history.items[-1]["status"] == "successful"
+
+
+def test_runner_checkpoints_at_deadline(suspend_env):
+    runner = make_runner(
+        source_input={"device": {"id": 1}},
+        actions=WAIT_WORKFLOW[:1] + WAIT_WORKFLOW[2:],
+        resumable=True,
+        deadline=time.monotonic() + 600,
+    )
+
+    def deadline_reached(request):
+        runner.deadline = time.monotonic() + runner_app.CHECKPOINT_MARGIN
+        return FakeResponse(body={"id": 1, "name": "Mac"})
+
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = deadline_reached
+    runner.run()
+
+    # The run is suspended after the action that was running at the deadline
+    assert len(FakeSession.requests) == 1
+    message = suspend_env.sqs.messages[0]
+    assert message["checkpoint"]["cursor"] == 1
+    assert message["checkpoint"]["state"]["device"]["name"] == "Mac"
+
+    resume(message)
+    assert [r["method"] for r in FakeSession.requests] == ["get", "put"]
+
+
+@pytest.mark.parametrize("runner_class", [WorkflowRunnerV1, AsyncWorkflowRunnerV1])
+@pytest.mark.parametrize("max_concurrency", [1, 2])
+def test_runner_iterator_checkpoints_at_deadline(
+    suspend_env, runner_class, max_concurrency
+):
+    runner = runner_class(
+        tenant_id="tenant",
+        workflow_id="workflow",
+        workflow_version=1,
+        run_id="run",
+        source_input={"devices": [{"id": i} for i in range(6)]},
+        actions=[iterator_action(max_concurrency=max_concurrency)],
+        resumable=True,
+        deadline=time.monotonic() + 600,
+    )
+
+    def deadline_reached(request):
+        runner.deadline = time.monotonic() + runner_app.CHECKPOINT_MARGIN
+        return FakeResponse(body={"id": 2})
+
+    FakeSession.responses["https://api.example.com/v1/devices/2"] = deadline_reached
+    result = runner.run()
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+    # Items that did not start before the deadline are run when the run resumes
+    first_run = {r["url"] for r in FakeSession.requests}
+    assert "https://api.example.com/v1/devices/5" not in first_run
+    message = suspend_env.sqs.messages[0]
+    assert message["checkpoint"]["cursor"] == 0
+    remaining = message["checkpoint"]["progress"]["remaining_items"]
+    assert 5 in remaining
+
+    resume(message)
+
+    urls = [r["url"] for r in FakeSession.requests]
+    assert sorted(urls) == [f"https://api.example.com/v1/devices/{i}" for i in range(6)]
+    assert len(FakeSession.requests) - len(first_run) == len(remaining)
+    assert suspend_env.history.items[-1]["status"] == "successful"
+
+
+def test_compiled_workflow_is_shared_by_runs(runner_env, monkeypatch):
+    monkeypatch.setattr(runner_app, "workflow_plan_cache", LRUCache())
+    FakeSession.responses["https://api.example.com/v1/devices/1"] = FakeResponse(
+        body={"id": 1, "name": "Mac"}
+    )
+    actions = [
+        {
+            "connector_id": "connector",
+            "type": "GetDevice",
+            "order": 2,
+            "parameters": {"device_id": "::device.id"},
+            "transform": {"device.name": "::name"},
+        },
+        {"type": "Flexli:CoreV1:Wait", "order": 1, "parameters": {"seconds": 0}},
+    ]
+    snapshot = copy.deepcopy(actions)
+
+    workflow = compile_workflow("tenant", "workflow", 1, actions)
+    assert compile_workflow("tenant", "workflow", "1", []) is workflow
+    assert [a.type for a in workflow.actions] == ["Flexli:CoreV1:Wait", "GetDevice"]
+    assert workflow.actions[0].core_action_name == "wait"
+
+    runners = [
+        make_runner(source_input={"device": {"id": 1}}, actions=workflow)
+        for _ in range(3)
+    ]
+    for runner in runners:
+        runner.run()
+        assert runner.state["device"] == {"id": 1, "name": "Mac"}
+
+    # Runs step through the shared actions with their own cursor and never modify them
+    assert actions == snapshot
+    assert len(FakeSession.requests) == 3
+
+    # The connector action template is matched again for a refreshed connector
+    action = workflow.actions[1]
+    connector = ConnectorIndex.from_connector(CONNECTOR)
+    template = action.connector_template(connector)
+    assert action.connector_template(connector) is template
+    refreshed = ConnectorIndex.from_connector(copy.deepcopy(CONNECTOR))
+    assert action.connector_template(refreshed) is not None
+    assert action._connector_template[0] is refreshed
+
+
+def test_compiled_workflow_core_actions_by_runner_class():
+    actions = [{"type": "Flexli:CoreV1:Wait", "order": 1, "parameters": {}}]
+
+    sync_workflow = CompiledWorkflow(actions)
+    async_workflow = CompiledWorkflow(
+        actions, core_actions_class=AsyncWorkflowRunnerV1.core_actions_class
+    )
+
+    for workflow in (sync_workflow, async_workflow):
+        core_actions = workflow.core_actions_class(runner=None)
+        result = workflow.actions[0].core_action(core_actions)(seconds=0)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
+        assert result == {}
@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+
+import pytest
+
+from apis.models import NotFound
+import database.workflows as workflows
+from database.workflows import (
+    delete_workflow_version,
+    read_workflow_definition,
+    read_workflow_definitions,
+)
+
+
+class FakeWorkflowsTable:
+    """Serves ``BatchGetItem`` from ``items`` keyed by ``(pk, sk)``. The first request returns
+    ``unprocessed`` keys as unprocessed.
+    """
+
+    def __init__(self, unprocessed: int = 0):
+        self.items = {}
+        self.requests = []
+        self.unprocessed = unprocessed
+        self.meta = SimpleNamespace(client=self)
+
+    def put(self, workflow_id: str, version: int):
+        self.items[(f"T#tenant#W#{workflow_id}", f"V#{version}")] = {
+            "pk": f"T#tenant#W#{workflow_id}",
+            "sk": f"V#{version}",
+            "id": workflow_id,
+            "version": version,
+            "actions": [{"type": "Flexli:CoreV1:Wait", "order": 1}],
+        }
+
+    def query(self, **kwargs):
+        return {"Count": 1}
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop((Key["pk"], Key["sk"]))
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[workflows.TABLE_NAME]["Keys"]
+        assert len(keys) <= 100
+        self.requests.append(keys)
+
+        unprocessed, self.unprocessed = keys[: self.unprocessed], 0
+        found = [
+            self.items[(k["pk"], k["sk"])]
+            for k in keys[len(unprocessed) :]
+            if (k["pk"], k["sk"]) in self.items
+        ]
+        return {
+            "Responses": {workflows.TABLE_NAME: found},
+            "UnprocessedKeys": (
+                {workflows.TABLE_NAME: {"Keys": unprocessed}} if unprocessed else {}
+            ),
+        }
+
+
+@pytest.fixture
+def workflows_table(monkeypatch):
+    table = FakeWorkflowsTable()
+    monkeypatch.setattr(workflows, "dynamodb_table", table)
+    workflows.workflow_definition_cache.clear()
+    yield table
+    workflows.workflow_definition_cache.clear()
+
+
+def test_read_workflow_definitions_batches_misses(workflows_table):
+    for i in range(150):
+        workflows_table.put(f"w{i}", 1)
+
+    keys = [("tenant", f"w{i}", 1) for i in range(150)] + [("tenant", "missing", 1)]
+    versions = read_workflow_definitions(keys)
+
+    assert len(versions) == 150
+    assert versions[("tenant", "w0", 1)]["id"] == "w0"
+    assert [len(r) for r in workflows_table.requests] == [100, 51]
+
+    # Versions are cached: only the version that was not found is read again
+    read_workflow_definitions(keys)
+    assert len(workflows_table.requests) == 3
+    assert workflows_table.requests[-1] == [{"pk": "T#tenant#W#missing", "sk": "V#1"}]
+
+
+def test_read_workflow_definitions_retries_unprocessed_keys(
+    workflows_table, monkeypatch
+):
+    monkeypatch.setattr(workflows.time, "sleep", lambda seconds: None)
+    workflows_table.put("a", 1)
+    workflows_table.put("b", 2)
+    workflows_table.unprocessed = 1
+
+    versions = read_workflow_definitions([("tenant", "a", 1), ("tenant", "b", 2)])
+
+    assert set(versions) == {("tenant", "a", 1), ("tenant", "b", 2)}
+    assert len(workflows_table.requests) == 2
+
+
+def test_read_workflow_definition(workflows_table):
+    workflows_table.put("a", 1)
+
+    # Versions from messages and items may be strings or ``Decimal``
+    assert read_workflow_definition("tenant", "a", "1")["id"] == "a"
+    assert read_workflow_definition("tenant", "a", 1) is read_workflow_definition(
+        "tenant", "a", 1
+    )
+    with pytest.raises(NotFound):
+        read_workflow_definition("tenant", "a", 2)
+
+
+def test_delete_workflow_version_evicts_cached_version(workflows_table):
+    workflows_table.put("a", 1)
+    read_workflow_definition("tenant", "a", 1)
+
+    delete_workflow_version("tenant", "a", "1")
+
+    with pytest.raises(NotFound):
+        read_workflow_definition("tenant", "a", 1)